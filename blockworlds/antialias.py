@@ -34,6 +34,48 @@ def partial_volume(mesh, r0, n):
     b2 = np.mean(mu_prod <= 0, axis=0)
     return 0.5*(b1+b2)
 
+def partial_volume_exact(r0, n):
+    """
+    Exact version of partial_volume(mesh_eval, r0, n), vectorized over
+    planes:  the volume of the unit cube centered on the origin on the side
+        np.dot(r-r0, n) < 0
+    is a piecewise cubic in the plane offset (Scardovelli & Zaleski 2000,
+    J. Comput. Phys. 164, 228-237)
+    :param r0: np.array of shape (N, 3) or (3,) with components (x0, y0, z0)
+    :param n: np.array of shape (N, 3) or (3,) with components (nx, ny, nz)
+    :return: fractional volumes (between 0 and 1), of shape (N, ) or ()
+    """
+    r0, n = np.asarray(r0, dtype=float), np.asarray(n, dtype=float)
+    # Reflect the cube so that all components of n are non-negative, and
+    # move its corner to the origin: the region is then np.dot(m, x) < alpha
+    # for x in [0,1]^3, normalized so that the components of m sum to 1
+    m = np.abs(n)
+    msum = np.sum(m, axis=-1)
+    alpha = (np.sum(r0*n, axis=-1) + 0.5*msum)/msum
+    m = np.sort(m, axis=-1)/msum[...,np.newaxis]
+    m1, m2, m3 = m[...,0], m[...,1], m[...,2]
+    # The volume is symmetric about alpha = 1/2, so only do the lower half
+    alpha = np.clip(alpha, 0.0, 1.0)
+    upper = alpha > 0.5
+    a = np.where(upper, 1.0 - alpha, alpha)
+    m12 = m1 + m2
+    m123 = 6.0*m1*m2*m3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        V1 = a**3/m123
+        V2 = a*(a-m1)/(2*m2*m3) + m1**2/(6*m2*m3)
+        V3 = (a**2*(3*m12 - a) + m1**2*(m1 - 3*a) + m2**2*(m2 - 3*a))/m123
+        V4 = (a**2*(3 - 2*a) + m1**2*(m1 - 3*a) + m2**2*(m2 - 3*a)
+              + m3**2*(m3 - 3*a))/m123
+        V5 = (2*a - m12)/(2*m3)
+    # Pick the branch; each condition is only reached when its denominator
+    # is nonzero, even for planes parallel to faces or edges of the cube
+    V = np.where(m3 < m12, V4, V5)
+    V = np.where(a < np.minimum(m12, m3), V3, V)
+    V = np.where(a < m2, V2, V)
+    V = np.where(a < m1, V1, V)
+    V = np.where(upper, 1.0 - V, V)
+    return np.clip(V, 0.0, 1.0)
+
 def generate_test_data():
     """
     Generate a few specific test data instances for an anti-aliasing model
@@ -62,9 +104,9 @@ def generate_unit_vectors(N, uniform_omega=True):
         # which is the statistically unbiased way of doing things
         # dA = cos(theta)*dtheta*dphi, theta = 0 at the equator
         # z = sin(theta) -> dA = -dz
-        nz = np.random.uniform(size=(N,)) - 0.5
+        nz = 2*np.random.uniform(size=(N,)) - 1
         phi = 2*np.pi*np.random.uniform(size=(N,))
-        nx, ny = np.sin(phi), np.cos(phi)
+        nx, ny = np.sqrt(1-nz**2)*np.sin(phi), np.sqrt(1-nz**2)*np.cos(phi)
         n = np.vstack([[nx],[ny],[nz]]).T
     else:
         # This way of doing it will concentrate them at the cube's corners,
@@ -87,9 +129,34 @@ def generate_random_data(N, uniform_omega=True):
     n = generate_unit_vectors(N, uniform_omega=uniform_omega)
     # Generate partial volumes
     pars = np.hstack([r0, n])
-    pV = np.array([partial_volume(mesh_eval, r0[i], n[i]) for i in range(N)])
+    pV = partial_volume_exact(r0, n)
     return pars, pV
 
+def preprocess_features(rawpars, N_features=3):
+    """
+    Preprocess the raw features into a version useful for prediction
+    :param rawpars: np.array of shape (N, 6), cf. generate_random_data(N)
+    :param N_features: number of features to return (1, 2, or 3)
+    :return: np.array of shape (N, N_features), suitable for fitting
+    """
+    r0, n = rawpars[:,:3], rawpars[:,3:]
+    n = n/np.sqrt(np.sum(n**2, axis=1))[:,np.newaxis]
+    p = np.zeros(shape=(len(r0), 3))
+    # feature 1 = dot product of r0 into n, the primary predictor
+    p[:,0] = np.sum(r0*n, axis=1)
+    # feature 2 = tangent of angle with nearest face of cube
+    # this differentiates between face-on, edge-on, and corner-on cases
+    if N_features >= 2:
+        z = np.max(np.abs(n), axis=1)
+        p[:,1] = np.sqrt(1-z**2)/z
+    # feature 3 = sine of azimuthal angle for further direction detail
+    # (zero for face-on planes, where the azimuth is undefined)
+    if N_features >= 3:
+        x = np.min(np.abs(n), axis=1)
+        s = np.sqrt(1-z**2)
+        p[:,2] = np.divide(x, s, out=np.zeros(len(s)), where=(s > 0))
+    return p[:,:N_features]
+
 class GaussianProcessAntialiasing:
 
     def __init__(self, N_features=3, nu=1.5):
@@ -110,22 +177,9 @@ class GaussianProcessAntialiasing:
         """
         Preprocess the raw features into a version useful for GP prediction
         :param rawpars: np.array of shape (N, 6), cf. generate_random_data(N)
-        :return: np.array of shape (N, 2), suitable for fitting
+        :return: np.array of shape (N, N_features), suitable for fitting
         """
-        r0, n = rawpars[:,:3], rawpars[:,3:]
-        p = np.zeros(shape=(len(r0), 3))
-        # feature 1 = dot product of r0 into n, the primary predictor
-        p[:,0] = np.sum(r0*n, axis=1)
-        # feature 2 = tangent of angle with nearest face of cube
-        # this differentiates between face-on, edge-on, and corner-on cases
-        if self.N_features >= 2:
-            z = np.max(np.abs(n), axis=1)
-            p[:,1] = np.sqrt(1-z**2)/z
-        # feature 3 = sine of azimuthal angle for further direction detail
-        if self.N_features >= 3:
-            x = np.min(np.abs(n), axis=1)
-            p[:,2] = x/np.sqrt(1-z**2)
-        return p[:,:self.N_features]
+        return preprocess_features(rawpars, self.N_features)
 
     def fit(self, pars, pV):
         """
@@ -172,6 +226,124 @@ class GaussianProcessAntialiasing:
         Y[Y > 1] = 1.0
         return Y.ravel()
 
+class TabulatedAntialiasing:
+    """
+    Partial volume model tabulated on a regular grid over the three
+    features of preprocess_features(), with trilinear interpolation; fitted
+    once from a slower model, then cheap enough to use per voxel per step
+    """
+
+    # Ranges of the features for planes through the unit cube
+    pmax = (0.5*np.sqrt(3), np.sqrt(2), np.sqrt(0.5))
+
+    def __init__(self, shape=(257, 33, 17)):
+        """
+        :param shape: number of grid points along each feature axis
+        """
+        self.axes = [np.linspace(-pmax, pmax, Ni) if i == 0 else
+                     np.linspace(0.0, pmax, Ni) for i, (pmax, Ni)
+                     in enumerate(zip(self.pmax, shape))]
+        self.table = None
+
+    def _grid_rawpars(self):
+        """
+        Invert preprocess_features() at every grid point, choosing r0
+        parallel to n; grid points that don't correspond to any plane
+        still give some valid (r0, n), so the table is filled everywhere
+        :return: np.array of shape (np.prod(shape), 6)
+        """
+        p0, p1, p2 = np.meshgrid(*self.axes, indexing='ij')
+        z = 1.0/np.sqrt(1.0 + p1**2)
+        s = np.sqrt(1.0 - z**2)
+        x = p2*s
+        y = np.sqrt(np.maximum(s**2 - x**2, 0.0))
+        n = np.array([x.ravel(), y.ravel(), z.ravel()]).T
+        r0 = p0.ravel()[:,np.newaxis]*n
+        return np.hstack([r0, n])
+
+    def fit(self, model=None, chunk=10000):
+        """
+        Fill the table from another partial volume model
+        :param model: GaussianProcessAntialiasing instance with 3 features,
+            or None to tabulate partial_volume_exact()
+        :param chunk: number of grid points to pass to model at once
+        :return: nothing (yet)
+        """
+        shape = tuple(len(ax) for ax in self.axes)
+        rawpars = self._grid_rawpars()
+        if model is None:
+            pV = partial_volume_exact(rawpars[:,:3], rawpars[:,3:])
+        else:
+            # Chunk the predictions to keep the GP's kernel matrices small
+            pV = np.concatenate([model.predict(rawpars[i:i+chunk])
+                                 for i in range(0, len(rawpars), chunk)])
+        self.table = pV.reshape(shape)
+
+    def save(self, fname):
+        """
+        :param fname: filename for np.savez
+        """
+        np.savez(fname, table=self.table, *self.axes)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        :param fname: filename written by save()
+        :return: TabulatedAntialiasing instance
+        """
+        with np.load(fname) as data:
+            obj = cls(shape=data['table'].shape)
+            obj.axes = [data['arr_{}'.format(i)] for i in range(3)]
+            obj.table = data['table']
+        return obj
+
+    def predict_features(self, X):
+        """
+        Trilinear interpolation into the table
+        :param X: np.array of shape (N, 3) from preprocess_features()
+        :return: np.array of shape (N, )
+        """
+        idx, wts = [ ], [ ]
+        for j, ax in enumerate(self.axes):
+            u = (X[:,j] - ax[0])/(ax[1] - ax[0])
+            u = np.clip(u, 0, len(ax) - 1)
+            i = np.minimum(u.astype(int), len(ax) - 2)
+            idx.append(i)
+            wts.append(u - i)
+        (i, j, k), (u, v, w) = idx, wts
+        T = self.table
+        Y = ((1-u)*((1-v)*((1-w)*T[i,j,k] + w*T[i,j,k+1])
+                    + v*((1-w)*T[i,j+1,k] + w*T[i,j+1,k+1]))
+             + u*((1-v)*((1-w)*T[i+1,j,k] + w*T[i+1,j,k+1])
+                  + v*((1-w)*T[i+1,j+1,k] + w*T[i+1,j+1,k+1])))
+        return np.clip(Y, 0.0, 1.0)
+
+    def predict(self, rawpars):
+        """
+        Same interface as GaussianProcessAntialiasing.predict()
+        :param rawpars: np.array of shape (N, 6), cf. generate_random_data
+        :return: np.array of shape (N, )
+        """
+        return self.predict_features(preprocess_features(rawpars, 3))
+
+    def __call__(self, r0, n):
+        """
+        Same interface as partial_volume_exact()
+        :param r0: np.array of shape (N, 3)
+        :param n: np.array of shape (N, 3)
+        :return: np.array of shape (N, )
+        """
+        return self.predict(np.hstack([r0, n]))
+
+    def error_report(self, rawpars, pV):
+        """
+        :param rawpars: np.array of shape (N, 6), cf. generate_random_data
+        :param pV: np.array of shape (N, ) of reference partial volumes
+        :return: (rms, max) absolute errors of the tabulated model
+        """
+        resids = self.predict(rawpars) - pV
+        return np.sqrt(np.mean(resids**2)), np.max(np.abs(resids))
+
 def compare_antialiasing(N_features_gp=3):
     """
     Demo different functional forms for antialiasing
@@ -213,7 +385,7 @@ def compare_antialiasing(N_features_gp=3):
     for ni in n:
         x = np.dot(r0, ni)
         X = np.array([np.concatenate([r0i, ni]) for r0i in r0])
-        y = np.array([partial_volume(mesh_eval, r0i, ni) for r0i in r0])
+        y = partial_volume_exact(r0, ni)
         resids1.extend(y - parpV1(x))
         resids2.extend(y - parpV2(x))
         resids3.extend(y - gp.predict(X))
@@ -277,6 +449,33 @@ def accelerate_gp_antialiasing():
     plt.legend()
     plt.show()
 
+def compare_tabulated_antialiasing(fname=None):
+    """
+    Tabulate the GP and the exact partial volumes, and see how well and how
+    fast the tables reproduce them
+    :param fname: optional filename in which to save the exact table
+    :return: nothing (yet)
+    """
+    Xtrain, Ytrain = generate_random_data(1000, uniform_omega=True)
+    gp = GaussianProcessAntialiasing(N_features=3)
+    profile_timer(gp.fit, Xtrain, Ytrain)
+    tab_gp, tab_exact = TabulatedAntialiasing(), TabulatedAntialiasing()
+    profile_timer(tab_gp.fit, gp)
+    profile_timer(tab_exact.fit)
+    if fname is not None:
+        tab_exact.save(fname)
+    # Residuals against the models they were fitted to
+    rawpars, pV = generate_random_data(100000)
+    pV_gp = profile_timer(gp.predict, rawpars)
+    for label, tab, ref in [("GP table vs GP", tab_gp, pV_gp),
+                            ("exact table vs exact", tab_exact, pV),
+                            ("exact table vs GP", tab_exact, pV_gp)]:
+        print("resids({}) rms, max = {:.3g}, {:.3g}"
+              .format(label, *tab.error_report(rawpars, ref)))
+    # Throughput at a realistic number of voxels
+    rawpars, pV = generate_random_data(1000000)
+    profile_timer(tab_exact.predict, rawpars)
+
 
 if __name__ == "__main__":
     compare_antialiasing(N_features_gp=3)
@@ -11,9 +11,19 @@ discretization needed to solve the sensor forward model problem.
 # Imports after one of the SimPEG tensor mesh gravity forward model examples
 
 import numpy as np
+import scipy.fft
+import scipy.sparse
+import scipy.constants as constants
 import matplotlib as mpl
 import matplotlib.pyplot as plt
+import hashlib
+import os
+import tempfile
 import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 from discretize import TensorMesh, TreeMesh
 from discretize.utils import mkvc
@@ -55,17 +65,71 @@ def baseline_tensor_mesh(N, delta, centering="CCC"):
     hx = hy = hz = [(delta, N),]
     return TensorMesh([hx, hy, hz], centering)
 
-def baseline_octree_mesh(N, delta):
+def padding_widths(delta, width, growth=1.3):
+    """
+    Widths of padding cells growing geometrically away from a core mesh
+    :param delta: width of the core cells
+    :param width: total width of the padding
+    :param growth: ratio of the widths of successive padding cells
+    :return: np.array of cell widths, starting next to the core, scaled
+        so that they add up to exactly the given width; the number of
+        cells is the largest that keeps every cell at least delta wide,
+        so padding narrower than a core cell is left out altogether
+    """
+    if width < delta:
+        return np.zeros(0)
+    # Scaling the widths by width/sum(h) keeps the first one >= delta as
+    # long as sum(h) <= growth*width
+    n = 1
+    while np.sum(delta*growth**np.arange(1, n + 2)) <= growth*width:
+        n += 1
+    h = delta*growth**np.arange(1, n + 1)
+    return h*(width/np.sum(h))
+
+def padded_tensor_mesh(N, delta, pad_width, growth=1.3, centering="CCC",
+                       pad_top=True):
+    """
+    Set up a tensor mesh with a uniform core of N^3 cubes, surrounded by
+    padding cells that grow geometrically outwards, to keep the edges of the
+    volume away from the survey without paying for fine cells everywhere.
+    Axes centered on zero are padded on both sides; axes that are positive
+    or negative are only padded away from zero (so e.g. with "CCN" nothing
+    is added above the surface at z = 0).
+    :param N: length of one edge of the cubical core in cells
+    :param delta: length of one edge of a core cell
+    :param pad_width: width of the padding on each padded side
+    :param growth: ratio of the widths of successive padding cells
+    :param centering: a three-letter code specifying whether each axis is
+        positive ('P'), negative ('N'), or centered ('C')
+    :param pad_top: if False, never pad above the core, e.g. to keep
+        sensors on top of the core outside the mesh
+    :return: TensorMesh instance
+    """
+    pad = padding_widths(delta, pad_width, growth)
+    core = delta*np.ones(N)
+    h, x0 = [ ], [ ]
+    for axis, c in enumerate(centering):
+        lo = pad[::-1] if c in "CN" else np.zeros(0)
+        hi = pad if c in "CP" else np.zeros(0)
+        if axis == 2 and not pad_top:
+            hi = np.zeros(0)
+        h.append(np.concatenate([lo, core, hi]))
+        x0.append({'C': -0.5*N*delta, 'N': -N*delta, 'P': 0.0}[c] - np.sum(lo))
+    return TensorMesh(h, np.array(x0))
+
+def baseline_octree_mesh(N, delta, centering="CCC"):
     """
     Set up a basic regular Cartesian octree mesh as a default; this can then
     be refined once we specify model features or voxelizations, so it is NOT
     currently finalized
     :param N: length of one edge of a cubical volume in cells
     :param delta: length of one edge of a mesh cube
+    :param centering: a three-letter code specifying whether each axis is
+        positive ('P'), negative ('N'), or centered ('C')
     :return: TreeMesh instance
     """
     h = delta * np.ones(N)
-    mesh = TreeMesh([h, h, h], x0="CCC")
+    mesh = TreeMesh([h, h, h], x0=centering)
     mesh.refine(3, finalize=False)
     return mesh
 
@@ -86,6 +150,127 @@ def refine_octree_surface(mesh, f):
         mesh, surf, octree_levels=[1,1,1], method="surface", finalize=False
     )
 
+def refine_octree_gfunc(mesh, gfunc, *args, min_level=3, tol=0.0):
+    """
+    Refine an octree mesh to its finest level wherever rock properties
+    change across a cell, so that interfaces of any shape get fine cells
+    and the rest of the volume stays at min_level.  Each cell is tested at
+    its center and corners, and the children of cells that fail the test
+    are tested in turn, so features that slip between the test points of
+    the coarsest cells can be missed
+    :param mesh: TreeMesh instance to refine (not yet finalized)
+    :param gfunc: geology function mapping a np.array of (x,y,z) positions
+        (shape = (N, 3)) to a set of rock properties (density contrast)
+    :param *args: arguments to pass to gfunc
+    :param min_level: octree level at which to start looking for interfaces
+    :param tol: smallest change in rock properties that counts
+    :return: TreeMesh instance
+    """
+    corners = np.array([[i, j, k] for i in (-1, 1)
+                        for j in (-1, 1) for k in (-1, 1)])
+    offsets = 0.5*np.vstack([np.zeros((1, 3)), corners])
+    # Regular grid of cells at min_level to start from
+    nsub = 2**(mesh.max_level - min_level)
+    w = np.array([hi[0] for hi in mesh.h]) * nsub
+    axes = [mesh.x0[i] + (np.arange(len(mesh.h[i])//nsub) + 0.5)*w[i]
+            for i in range(3)]
+    centers = np.array([mkvc(a) for a in np.meshgrid(*axes, indexing='ij')]).T
+    for level in range(min_level, mesh.max_level + 1):
+        pts = centers[:,np.newaxis,:] + offsets*w
+        vals = gfunc(pts.reshape(-1, 3), *args).reshape(len(centers), -1)
+        centers = centers[np.ptp(vals, axis=1) > tol]
+        if level == mesh.max_level or len(centers) == 0:
+            break
+        # Split each cut cell into its eight children
+        w = 0.5*w
+        centers = (centers[:,np.newaxis,:] + 0.5*corners*w).reshape(-1, 3)
+    if len(centers) > 0:
+        levels = mesh.max_level * np.ones(len(centers), dtype=int)
+        mesh.insert_cells(centers, levels, finalize=False)
+    return mesh
+
+def mesh_cell_widths(mesh):
+    """
+    Widths of every cell of a mesh, in the same order as mesh.gridCC
+    :param mesh: discretize.mesh instance
+    :return: np.array of shape (mesh.nC, 3)
+    """
+    if hasattr(mesh, 'h_gridded'):
+        return np.asarray(mesh.h_gridded)
+    hh = np.meshgrid(*mesh.h, indexing='ij')
+    return np.array([mkvc(hi) for hi in hh]).T
+
+
+class VoxelSampler:
+    """
+    Volume-averaged voxelization of a geology function on meshes whose cells
+    vary in size, such as padded_tensor_mesh:  cells wider than a target
+    spacing are split into equal sub-cells, the geology is evaluated at their
+    centers, and each cell gets the average over its sub-cells.  The sample
+    points are set up once and reused, so caches keyed on them keep working.
+    """
+
+    def __init__(self, mesh, spacing, max_subdivisions=8, ind_active=None):
+        """
+        :param mesh: discretize.mesh instance
+        :param spacing: target distance between samples; cells no wider
+            than this are sampled once, at their centers
+        :param max_subdivisions: most sub-cells along any axis of one cell,
+            or None for no limit; a warning is issued if the limit leaves
+            sub-cells wider than spacing
+        :param ind_active: optional boolean np.array of shape (mesh.nC, )
+            of the cells to voxelize; the others are left out
+        """
+        centers, widths = mesh.gridCC, mesh_cell_widths(mesh)
+        if ind_active is not None:
+            centers, widths = centers[ind_active], widths[ind_active]
+        nsub = np.maximum(np.ceil(widths/spacing*(1 - 1e-9)).astype(int), 1)
+        if max_subdivisions is not None and np.any(nsub > max_subdivisions):
+            warnings.warn("VoxelSampler: cells up to {:.3g} wide are split "
+                          "into at most {} sub-cells, so their samples are "
+                          "further apart than {:.3g}".format(
+                              np.max(widths), max_subdivisions, spacing))
+            nsub = np.minimum(nsub, max_subdivisions)
+        # Group the cells by how they're subdivided, so that each group's
+        # sub-cell centers can be laid out with one broadcast
+        points, sub_widths, owner, weight = [ ], [ ], [ ], [ ]
+        groups, inverse = np.unique(nsub, axis=0, return_inverse=True)
+        for g, (nx, ny, nz) in enumerate(groups):
+            idx = np.flatnonzero(inverse.ravel() == g)
+            u = [(np.arange(n) + 0.5)/n - 0.5 for n in (nx, ny, nz)]
+            offsets = np.array(np.meshgrid(*u, indexing='ij')).reshape(3, -1).T
+            w = widths[idx]
+            points.append((centers[idx,np.newaxis,:]
+                           + offsets[np.newaxis,:,:]*w[:,np.newaxis,:]
+                           ).reshape(-1, 3))
+            sub_widths.append(np.repeat(w/(nx, ny, nz), len(offsets), axis=0))
+            owner.append(np.repeat(idx, len(offsets)))
+            weight.append(np.full(len(idx)*len(offsets), 1.0/len(offsets)))
+        self.points = np.concatenate(points)
+        self.widths = np.concatenate(sub_widths)
+        owner, weight = np.concatenate(owner), np.concatenate(weight)
+        self.averager = scipy.sparse.csr_matrix(
+            (weight, (owner, np.arange(len(owner)))),
+            shape=(len(centers), len(owner)))
+
+    def average(self, values):
+        """
+        :param values: np.array of shape (M, ) or (K, M) of values at the
+            sample points
+        :return: np.array of shape (Ncells, ) or (K, Ncells) of averages
+        """
+        return np.asarray(self.averager @ np.asarray(values).T).T
+
+    def __call__(self, gfunc, *args, **kwargs):
+        """
+        :param gfunc: geology function mapping a np.array of positions
+            (shape = (M, 3)) to rock properties
+        :param *args: arguments to pass to gfunc
+        :param **kwargs: keyword arguments to pass to gfunc
+        :return: np.array of volume-averaged rock properties, one per cell
+        """
+        return self.average(gfunc(self.points, *args, **kwargs))
+
 # ============================================================================
 #        Procedures to construct and manipulate gravity survey objects
 # ============================================================================
@@ -168,7 +353,7 @@ def plot_model_slice(mesh, model, ax=None):
         ax=ax,
         ind=int(mesh.hy.size / 2),
         grid=True,
-        clim=(np.min(model), np.max(model)),
+        clim=(np.nanmin(model), np.nanmax(model)),
         pcolorOpts={"cmap": "viridis"},
     )
     quadmeshimg = plot_objects[0]
@@ -230,19 +415,1016 @@ def analytic_forward_gravity_sphere(survey, R, rho, r0=(0, 0, 0)):
                                                  r0[0], r0[1], r0[2], rho)
     return grav
 
+# ============================================================================
+#          Procedures to set up forward models and cache sensitivities
+# ============================================================================
+
+def sensitivity_cache_key(mesh, survey, ind_active=None):
+    """
+    Fingerprint everything that determines a gravity sensitivity matrix, so
+    that identical mesh/survey combinations can share one stored copy
+    :param mesh: discretize.mesh instance
+    :param survey: gravity survey geometry
+    :param ind_active: optional boolean np.array of shape (mesh.nC, )
+        marking the cells included in the forward model
+    :return: hex digest string
+    """
+    if ind_active is None:
+        ind_active = np.ones(mesh.nC, dtype=bool)
+    sha = hashlib.sha1()
+    sha.update(mesh.__class__.__name__.encode())
+    for arr in (mesh.gridCC, mesh.vol, survey.receiver_locations):
+        sha.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    sha.update(np.packbits(np.asarray(ind_active, dtype=bool)).tobytes())
+    for rx in survey.source_field.receiver_list:
+        sha.update(str(rx.components).encode())
+    return sha.hexdigest()
+
+def survey_cache_key(survey):
+    """
+    Fingerprint the receiver geometry of a gravity survey
+    :param survey: gravity survey geometry
+    :return: hex digest string
+    """
+    sha = hashlib.sha1()
+    locs = survey.receiver_locations
+    sha.update(np.ascontiguousarray(locs, dtype=np.float64).tobytes())
+    for rx in survey.source_field.receiver_list:
+        sha.update(str(rx.components).encode())
+    return sha.hexdigest()
+
+def load_cached_sensitivities(fwd, cache_dir, ind_active=None):
+    """
+    Attach a sensitivity matrix to a gravity simulation from an on-disk cache,
+    computing and storing it first if it isn't there yet.  The matrix comes
+    back as a read-only np.memmap, so every process using the same mesh and
+    survey shares a single copy through the OS page cache.
+    :param fwd: SimPEG gravity Simulation3DIntegral instance
+    :param cache_dir: directory in which to keep cached matrices
+    :param ind_active: boolean np.array of active cells used to build fwd
+    :return: np.memmap of shape (Nsensors, Nactive)
+    """
+    key = sensitivity_cache_key(fwd.mesh, fwd.survey, ind_active)
+    fname = os.path.join(cache_dir, "G_{}.npy".format(key))
+    if not os.path.exists(fname):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a private temporary file and rename it into place, so
+        # that workers racing on the same matrix never see a partial file
+        tmpfname = "{}.{}.tmp".format(fname, os.getpid())
+        with open(tmpfname, 'wb') as f:
+            np.save(f, np.asarray(fwd.G))
+        os.replace(tmpfname, fname)
+    G = np.load(fname, mmap_mode='r')
+    # SimPEG computes G on first use unless it has already been stored in
+    # this attribute, so handing it the memory map skips the computation
+    fwd._G = G
+    return G
+
+class SharedArrays:
+    """
+    A set of named np.arrays in multiprocessing.shared_memory, published
+    once by one process and attached zero-copy by any others.  Pickling an
+    instance only sends the names of the shared memory blocks, so passing
+    one to a worker process (e.g. through a Pool initializer) attaches the
+    worker to the same memory instead of copying the arrays
+    """
+
+    def __init__(self, spec, segments, owner=False):
+        """
+        Use publish() or attach() instead of calling this directly
+        :param spec: dict mapping array names to (block name, shape, dtype)
+        :param segments: dict mapping array names to SharedMemory instances
+        :param owner: whether this instance created the blocks
+        """
+        self.spec = spec
+        self.segments = segments
+        self.owner = owner
+        self.arrays = { }
+        for name, (shmname, shape, dtype) in spec.items():
+            self.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype),
+                                           buffer=segments[name].buf)
+
+    @classmethod
+    def publish(cls, **arrays):
+        """
+        :param **arrays: np.arrays to copy into shared memory, by name
+        :return: SharedArrays instance owning the new blocks
+        """
+        spec, segments = { }, { }
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            spec[name] = (shm.name, arr.shape, arr.dtype.str)
+            segments[name] = shm
+        return cls(spec, segments, owner=True)
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        :param spec: the spec attribute of a published SharedArrays
+        :return: SharedArrays instance viewing the same memory
+        """
+        segments = { }
+        for name, (shmname, shape, dtype) in spec.items():
+            # Only the publisher should ever unlink the blocks; worker
+            # processes share their parent's resource tracker, so attaching
+            # there is safe, and newer Pythons let us opt out of tracking
+            try:
+                shm = shared_memory.SharedMemory(name=shmname, track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name=shmname)
+            segments[name] = shm
+        return cls(spec, segments, owner=False)
+
+    def __getstate__(self):
+        return self.spec
+
+    def __setstate__(self, spec):
+        attached = SharedArrays.attach(spec)
+        self.__dict__.update(attached.__dict__)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def close(self):
+        """
+        Detach this process from the shared memory
+        """
+        self.arrays = { }
+        for shm in self.segments.values():
+            shm.close()
+
+    def unlink(self):
+        """
+        Free the shared memory (publisher only, once all users are done)
+        """
+        self.close()
+        if self.owner:
+            for shm in self.segments.values():
+                shm.unlink()
+            self.owner = False
+
+def publish_sensitivities(fwdmodel):
+    """
+    Publish the sensitivity matrix, cell centers and receiver locations of
+    a DiscreteGravity instance in shared memory, so that DiscreteGravity
+    instances in worker processes can use them without their own copies
+    :param fwdmodel: DiscreteGravity instance with an integral forward model
+    :return: SharedArrays instance with arrays 'G', 'gridCC', 'locations'
+    """
+    return SharedArrays.publish(
+        G=np.asarray(fwdmodel.fwd.G), gridCC=fwdmodel.mesh.gridCC,
+        locations=fwdmodel.survey.receiver_locations)
+
+def build_forward_model(mesh, survey, cache_dir=None, engine="integral",
+                        ind_active=None):
+    """
+    Set up a gravity forward model on a mesh
+    :param mesh: discretize.mesh instance
+    :param survey: gravity survey geometry
+    :param cache_dir: optional directory for the on-disk sensitivity cache;
+        if None, sensitivities are computed and kept in RAM as usual
+    :param engine: which forward model to use:
+        'integral' = SimPEG Simulation3DIntegral, dense sensitivity matrix
+        'fft' = FFTGravity (regular meshes and sensor grids only)
+        'compressed' = CompressedGravity with its default settings
+        'streaming' = StreamingGravity with its default settings
+        'auto' = 'fft' if the mesh and survey allow it, else 'integral'
+        or a function engine(mesh, survey, ind_active=None) returning a
+        forward model, e.g. functools.partial(CompressedGravity, tol=1e-5)
+    :param ind_active: optional boolean np.array of shape (mesh.nC, )
+        marking the cells included in the forward model (e.g. not air, and
+        not of fixed density); models then have one entry per active cell
+    :return: forward model instance with a dpred(model) method
+    """
+    kwargs = { } if ind_active is None else dict(ind_active=ind_active)
+    if callable(engine):
+        return engine(mesh, survey, **kwargs)
+    if engine == "auto":
+        use_fft = FFTGravity.is_compatible(mesh, survey)
+        engine = "fft" if use_fft else "integral"
+    if engine == "fft":
+        return FFTGravity(mesh, survey, **kwargs)
+    elif engine == "compressed":
+        return CompressedGravity(mesh, survey, cache_dir=cache_dir, **kwargs)
+    elif engine == "streaming":
+        return StreamingGravity(mesh, survey, cache_dir=cache_dir, **kwargs)
+    elif engine != "integral":
+        raise ValueError("unknown forward model engine '{}'".format(engine))
+    if ind_active is None:
+        ind_active = np.ones(mesh.nC, dtype=bool)
+    ind_active = np.asarray(ind_active, dtype=bool)
+    model_map = maps.IdentityMap(nP=int(np.sum(ind_active)))
+    fwd = gravity.simulation.Simulation3DIntegral(
+        survey=survey,
+        mesh=mesh,
+        rhoMap=model_map,
+        actInd=ind_active,
+        store_sensitivities="ram",
+    )
+    if cache_dir is not None:
+        load_cached_sensitivities(fwd, cache_dir, ind_active)
+    return fwd
+
+def forward_adjoint(fwd, data, chunk=256):
+    """
+    Apply the transpose of a linear gravity forward model, which maps data
+    residuals back onto the mesh for gradients by the adjoint method
+    :param fwd: forward model from build_forward_model
+    :param data: np.array of shape (Nsensors, )
+    :param chunk: number of sensors to process at once, so that a float32
+        sensitivity matrix is never upcast all in one go
+    :return: np.array of shape (Nactive, ), one entry per active cell
+    """
+    if hasattr(fwd, 'rmatvec'):
+        return fwd.rmatvec(data)
+    G = fwd.G
+    result = np.zeros(G.shape[1])
+    for i in range(0, G.shape[0], chunk):
+        result += np.asarray(G[i:i+chunk]).T @ data[i:i+chunk]
+    return result
+
+def dpred_batch(fwd, models, chunk=64):
+    """
+    Predict the data of many models with matrix-matrix products, so that a
+    dense sensitivity matrix is streamed through memory once per chunk of
+    models rather than once per model
+    :param fwd: forward model from build_forward_model
+    :param models: np.array of shape (M, Nactive) of densities
+    :param chunk: number of models per product
+    :return: np.array of shape (M, Nsensors)
+    """
+    models = np.atleast_2d(models)
+    if hasattr(fwd, 'dpred_batch'):
+        return np.concatenate([fwd.dpred_batch(models[i:i+chunk])
+                               for i in range(0, len(models), chunk)])
+    G = fwd.G
+    result = np.zeros((len(models), G.shape[0]))
+    for i in range(0, len(models), chunk):
+        # Cast the models rather than G, so G is never upcast in one go
+        X = models[i:i+chunk].T.astype(G.dtype)
+        result[i:i+chunk] = np.asarray(G @ X).T
+    return result
+
+class FFTGravity:
+    """
+    Gravity forward model (gz) for a TensorMesh with uniform cells in x and
+    y, observed on a regular grid of sensors at constant height.  The kernel
+    is then translation-invariant in x and y, so instead of storing a dense
+    sensitivity matrix we convolve each horizontal layer of the model with
+    its kernel using 2-D FFTs:  O(N^3 log N) time and O(N^3) memory.
+    """
+
+    def __init__(self, mesh, survey, ind_active=None):
+        """
+        :param mesh: discretize.TensorMesh instance (see is_compatible)
+        :param survey: gravity survey geometry (see is_compatible)
+        :param ind_active: optional boolean np.array of shape (mesh.nC, )
+            of active cells; inactive cells are zero in the convolution
+        """
+        layout = self.sensor_layout(mesh, survey)
+        if layout is None:
+            raise ValueError("FFTGravity needs a TensorMesh with uniform "
+                             "cells in x and y, and a regular grid of sensors "
+                             "at constant z aligned with those cells")
+        self.mesh, self.survey = mesh, survey
+        self.ind_active = ind_active
+        (xs0, ys0, zs), (sx, sy), (Nsx, Nsy), (ix, iy) = layout
+        nx, ny, nz = mesh.vnC
+        dx, dy = mesh.hx[0], mesh.hy[0]
+        # Output lattice has the cell spacing, and sensors every (sx, sy)
+        # lattice points; pad to avoid wrap-around in the convolution
+        Jx, Jy = sx*(Nsx-1) + 1, sy*(Nsy-1) + 1
+        self.shape = (scipy.fft.next_fast_len(nx + Jx - 1, real=True),
+                      scipy.fft.next_fast_len(ny + Jy - 1, real=True))
+        self.sensor_index = (sx*ix, sy*iy)
+        # Cell i seen from output lattice point j spans offsets i-j to i-j+1
+        # (in cells), with i-j from -(J-1) to n-1; evaluate the primitive
+        # at the corresponding node coordinates relative to the sensors
+        xn = mesh.vectorNx[0] - xs0 + np.arange(-(Jx-1), nx+1)*dx
+        yn = mesh.vectorNy[0] - ys0 + np.arange(-(Jy-1), ny+1)*dy
+        zn = mesh.vectorNz - zs
+        F = _prism_gz_primitive(xn[:,None,None], yn[None,:,None],
+                                zn[None,None,:])
+        # Corner sums along each axis give the response of each cell, which
+        # is reversed in x and y to turn the correlation into a convolution;
+        # the sign and units (mGal for g/cc) follow SimPEG, with +z upwards
+        K = F[1:] - F[:-1]
+        K = K[:,1:] - K[:,:-1]
+        K = K[:,:,1:] - K[:,:,:-1]
+        K = -K[::-1,::-1] * constants.G * 1e8
+        # K[a, b, k] is now the response at lattice point j to the cell
+        # i = j - (px[a], py[b]) in layer k; wrap these into the FFT grid
+        px = np.arange(-(nx-1), Jx)
+        py = np.arange(-(ny-1), Jy)
+        Kpad = np.zeros(self.shape + (nz,))
+        Kpad[np.ix_(px % self.shape[0], py % self.shape[1])] = K
+        self.kernel_fft = scipy.fft.rfft2(Kpad, axes=(0, 1))
+
+    @staticmethod
+    def sensor_layout(mesh, survey, rtol=1e-6):
+        """
+        Work out whether a mesh and survey are compatible with FFTGravity
+        :param mesh: discretize.mesh instance
+        :param survey: gravity survey geometry
+        :param rtol: tolerance relative to the cell size for alignment tests
+        :return: None if incompatible, otherwise a tuple containing the
+            origin (xs0, ys0, zs) of the sensor grid, the sensor spacing
+            (sx, sy) in cells, the sensor grid dimensions (Nsx, Nsy), and the
+            grid indices (ix, iy) of each receiver
+        """
+        if not isinstance(mesh, TensorMesh):
+            return None
+        dx, dy = mesh.hx[0], mesh.hy[0]
+        if not (np.allclose(mesh.hx, dx, rtol=rtol, atol=0)
+                and np.allclose(mesh.hy, dy, rtol=rtol, atol=0)):
+            return None
+        locs = survey.receiver_locations
+        if not np.allclose(locs[:,2], locs[0,2], rtol=0, atol=rtol*dx):
+            return None
+        layout = [ ]
+        for x, delta in ((locs[:,0], dx), (locs[:,1], dy)):
+            # Spacing must be a whole number of cells
+            xu = np.unique(np.round(x/(rtol*delta)))*(rtol*delta)
+            step = np.diff(xu)
+            stride = np.round(step/delta) if len(step) else np.array([1.0])
+            if np.any(stride < 1) or not np.allclose(
+                    step, stride*delta, rtol=0, atol=10*rtol*delta):
+                return None
+            if not np.all(stride == stride[0]):
+                return None
+            idx = np.round((x - xu[0])/(stride[0]*delta)).astype(int)
+            layout.append((xu[0], int(stride[0]), len(xu), idx))
+        (xs0, sx, Nsx, ix), (ys0, sy, Nsy, iy) = layout
+        # Every point of the Nsx x Nsy grid must be sampled exactly once
+        if len(locs) != Nsx*Nsy or len(np.unique(ix*Nsy + iy)) != len(locs):
+            return None
+        return (xs0, ys0, locs[0,2]), (sx, sy), (Nsx, Nsy), (ix, iy)
+
+    @staticmethod
+    def is_compatible(mesh, survey):
+        return FFTGravity.sensor_layout(mesh, survey) is not None
+
+    def dpred(self, model):
+        """
+        :param model: np.array of shape (mesh.nC, ) of densities (g/cc),
+            or (Nactive, ) if ind_active was given
+        :return: np.array of gz readings (mGal) in survey order
+        """
+        return self.dpred_batch(np.asarray(model)[np.newaxis])[0]
+
+    def dpred_batch(self, models):
+        """
+        :param models: np.array of shape (M, mesh.nC), or (M, Nactive)
+        :return: np.array of shape (M, Nsensors) of gz readings
+        """
+        M = len(models)
+        if self.ind_active is not None:
+            models, active = np.zeros((M, self.mesh.nC)), models
+            models[:,self.ind_active] = active
+        nx, ny, nz = self.mesh.vnC
+        rho = np.reshape(models, (M, nz, ny, nx)).transpose(0, 3, 2, 1)
+        rho_fft = scipy.fft.rfft2(rho, s=self.shape, axes=(1, 2))
+        # Sum the layers in Fourier space so only one inverse FFT is needed
+        gz_fft = np.einsum('mijk,ijk->mij', rho_fft, self.kernel_fft)
+        gz = scipy.fft.irfft2(gz_fft, s=self.shape, axes=(1, 2))
+        return gz[(slice(None), ) + tuple(self.sensor_index)]
+
+    def rmatvec(self, data):
+        """
+        Transpose of dpred, for gradients by the adjoint method
+        :param data: np.array of shape (Nsensors, ) in survey order
+        :return: np.array of shape (mesh.nC, ), or (Nactive, )
+        """
+        gz = np.zeros(self.shape)
+        np.add.at(gz, self.sensor_index, data)
+        # Correlating with the kernel is the adjoint of convolving with it
+        gz_fft = scipy.fft.rfft2(gz)
+        rho_fft = np.conj(self.kernel_fft) * gz_fft[:,:,np.newaxis]
+        rho = scipy.fft.irfft2(rho_fft, s=self.shape, axes=(0, 1))
+        nx, ny, nz = self.mesh.vnC
+        rho = mkvc(rho[:nx,:ny,:])
+        return rho if self.ind_active is None else rho[self.ind_active]
+
+
+def _log_plus(a, r):
+    """
+    Numerically stable log(a + r) for r = sqrt(a^2 + b^2) >= |a|
+    """
+    b2 = r**2 - a**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(a >= 0, np.log(a + r), np.log(b2/(r - a)))
+
+def _prism_gz_primitive(x, y, z):
+    """
+    Primitive of the vertical gravity of a uniform rectangular prism, whose
+    corner sums give the response of a prism (Nagy 1966, Blakely 1996);
+    coordinates are those of the prism corners relative to the sensor
+    :return: np.array broadcast from x, y, z
+    """
+    x, y, z = np.broadcast_arrays(x, y, z)
+    r = np.sqrt(x**2 + y**2 + z**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = np.where(x == 0, 0.0, x*_log_plus(y, r))
+        t2 = np.where(y == 0, 0.0, y*_log_plus(x, r))
+        t3 = np.where(z == 0, 0.0, z*np.arctan(x*y/(z*r)))
+    return t1 + t2 - t3
+
+
+def prism_gz_sensitivities(locations, centers, widths):
+    """
+    Dense block of the gz sensitivity matrix, from the exact response of
+    rectangular prisms; the sign and units (mGal for g/cc) follow SimPEG
+    :param locations: np.array of shape (M, 3) of receiver locations
+    :param centers: np.array of shape (N, 3) of cell centers
+    :param widths: np.array of shape (N, 3) of cell widths
+    :return: np.array of shape (M, N)
+    """
+    lo = centers - 0.5*widths
+    hi = centers + 0.5*widths
+    G = np.zeros((len(locations), len(centers)))
+    for sx, x in ((1, hi[:,0]), (-1, lo[:,0])):
+        for sy, y in ((1, hi[:,1]), (-1, lo[:,1])):
+            for sz, z in ((1, hi[:,2]), (-1, lo[:,2])):
+                G += sx*sy*sz*_prism_gz_primitive(
+                    x[np.newaxis,:] - locations[:,0,np.newaxis],
+                    y[np.newaxis,:] - locations[:,1,np.newaxis],
+                    z[np.newaxis,:] - locations[:,2,np.newaxis])
+    return -G * constants.G * 1e8
+
+def _spatial_blocks(x, size):
+    """
+    Partition points into spatially compact groups of roughly equal size
+    :param x: np.array of shape (N, D) of positions
+    :param size: typical number of points per group
+    :return: list of np.arrays of indices into x
+    """
+    xmin, ext = x.min(axis=0), np.ptp(x, axis=0)
+    ext[ext == 0] = 1.0
+    nblocks = max(1, int(np.ceil(len(x)/size)))
+    edge = (np.prod(ext)/nblocks)**(1.0/x.shape[1])
+    tile = np.minimum(np.floor((x - xmin)/edge), np.ceil(ext/edge) - 1)
+    tiles, inverse = np.unique(tile.astype(int), axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    splits = np.cumsum(np.bincount(inverse.ravel()))[:-1]
+    return np.split(order, splits)
+
+def _bbox_distance(lo0, hi0, lo1, hi1):
+    """
+    :return: distance between two axis-aligned bounding boxes
+    """
+    gap = np.maximum(0, np.maximum(lo0 - hi1, lo1 - hi0))
+    return np.sqrt(np.sum(gap**2))
+
+
+class CompressedGravity:
+    """
+    Gravity forward model (gz) with a block-compressed sensitivity matrix,
+    for meshes too large for a dense one.  Receivers and cells are grouped
+    into spatially compact blocks; blocks of G coupling groups that are far
+    apart compared to their size are smooth, and are stored as truncated
+    SVDs, while the rest are stored densely.  No dense G is ever formed:
+    each block is evaluated from the exact prism formula, compressed, and
+    discarded, so the exact truncation error of every block is known.
+
+    Each reading gets an error budget of tol times the gz of a unit-density
+    box filling the mesh, which (since the cells tile that box) is at most
+    the L1 norm of its row of G, shared equally among the cell blocks.  If
+    some cells are inactive they no longer tile the box, so the row sums
+    of G are instead computed exactly in an extra pass over the blocks.  The
+    rank of each far block is the smallest for which, in every row, the L1
+    norm of the truncation error fits in its share.  For any model with
+    |rho| <= rho_max, the error in each reading is then at most
+    error_l1*rho_max, which is in turn at most tol times the largest
+    reading any such model can produce.
+    """
+
+    def __init__(self, mesh, survey, tol=1e-4, eta=1.0, chunk_size=256,
+                 block_cells=4096, dtype=np.float64, cache_dir=None,
+                 ind_active=None):
+        """
+        :param mesh: discretize.mesh instance
+        :param survey: gravity survey geometry
+        :param tol: relative truncation tolerance for far blocks (see above)
+        :param eta: admissibility parameter; a block is far if the distance
+            between the bounding boxes of its receivers and cells exceeds
+            eta times the larger of their diameters
+        :param chunk_size: typical number of receivers per block
+        :param block_cells: typical number of cells per block
+        :param dtype: floating-point type in which to store the blocks
+        :param cache_dir: optional directory in which to keep the compressed
+            matrix; if given, it is loaded as read-only memory maps, so it
+            need not fit in RAM and is shared between processes
+        :param ind_active: optional boolean np.array of shape (mesh.nC, )
+            of cells to include; models then have one entry per active cell
+        """
+        self.mesh, self.survey = mesh, survey
+        if ind_active is None:
+            ind_active = np.ones(mesh.nC, dtype=bool)
+        self.ind_active = np.asarray(ind_active, dtype=bool)
+        self.nactive = int(np.sum(self.ind_active))
+        self.tol, self.eta = tol, eta
+        self.chunk_size, self.block_cells = chunk_size, block_cells
+        self.dtype = np.dtype(dtype)
+        if cache_dir is None:
+            arrays = self._compress()
+        else:
+            arrays = self._load_or_compress(cache_dir)
+        self._unpack(arrays)
+
+    def _compress(self):
+        """
+        Evaluate and compress every block of the sensitivity matrix
+        :return: dict of np.arrays in the packed layout read by _unpack
+        """
+        locs = self.survey.receiver_locations
+        centers = self.mesh.gridCC[self.ind_active]
+        widths = mesh_cell_widths(self.mesh)[self.ind_active]
+        rchunks = _spatial_blocks(locs[:,:2], self.chunk_size)
+        cblocks = _spatial_blocks(centers, self.block_cells)
+        cbox = [(np.min(centers[c] - 0.5*widths[c], axis=0),
+                 np.max(centers[c] + 0.5*widths[c], axis=0)) for c in cblocks]
+        near_cells, near_G, U_chunks, zslices = [ ], [ ], [ ], [ ]
+        V_blocks = [[ ] for cb in cblocks]
+        zpos = [[ ] for cb in cblocks]
+        error_l1, row_l1 = np.zeros(len(locs)), np.zeros(len(locs))
+        if np.all(self.ind_active):
+            lo = np.min(centers - 0.5*widths, axis=0)
+            hi = np.max(centers + 0.5*widths, axis=0)
+            budget = prism_gz_sensitivities(
+                locs, 0.5*(lo + hi)[np.newaxis], (hi - lo)[np.newaxis])[:,0]
+        else:
+            budget = np.zeros(len(locs))
+            for rc in rchunks:
+                for cb in cblocks:
+                    budget[rc] += np.sum(prism_gz_sensitivities(
+                        locs[rc], centers[cb], widths[cb]), axis=1)
+        budget = np.abs(budget)*self.tol/len(cblocks)
+        nz = 0
+        for rc in rchunks:
+            rlo, rhi = locs[rc].min(axis=0), locs[rc].max(axis=0)
+            rdiam = np.sqrt(np.sum((rhi - rlo)**2))
+            cells, G, U_all, z0 = [ ], [ ], [ ], nz
+            for b, (cb, (clo, chi)) in enumerate(zip(cblocks, cbox)):
+                A = prism_gz_sensitivities(locs[rc], centers[cb], widths[cb])
+                row_l1[rc] += np.sum(np.abs(A), axis=1)
+                diam = max(rdiam, np.sqrt(np.sum((chi - clo)**2)))
+                if _bbox_distance(rlo, rhi, clo, chi) > self.eta*diam:
+                    lowrank = self._truncate(A, budget[rc])
+                    if lowrank is not None:
+                        U, V, E = lowrank
+                        error_l1[rc] += np.sum(np.abs(E), axis=1)
+                        U_all.append(U)
+                        V_blocks[b].append(V)
+                        zpos[b].append(nz + np.arange(len(V)))
+                        nz += len(V)
+                        continue
+                cells.append(cb)
+                G.append(A)
+            near_cells.append(np.concatenate(cells) if cells
+                              else np.zeros(0, dtype=int))
+            near_G.append(np.hstack(G) if G else np.zeros((len(rc), 0)))
+            U_chunks.append(np.hstack(U_all) if U_all
+                            else np.zeros((len(rc), 0)))
+            zslices.append((z0, nz))
+        # Stack the right factors of each cell block, so that a matvec
+        # projects each block of the model onto all its factors at once
+        V_stacked = [np.vstack(V) if V else np.zeros((0, len(cb)))
+                     for V, cb in zip(V_blocks, cblocks)]
+        zpos = [np.concatenate(zp) if zp else np.zeros(0, dtype=int)
+                for zp in zpos]
+        ivecs = rchunks + near_cells + cblocks + zpos
+        fvecs = [A.ravel() for A in near_G + U_chunks + V_stacked]
+        return dict(
+            counts=np.array([len(rchunks), len(cblocks), nz]),
+            zslices=np.array(zslices, dtype=np.int64).reshape(-1, 2),
+            ilens=np.array([len(v) for v in ivecs], dtype=np.int64),
+            ints=np.concatenate(ivecs).astype(np.int64),
+            floats=np.concatenate(fvecs).astype(self.dtype),
+            error_l1=error_l1, row_l1=row_l1)
+
+    def _truncate(self, A, target):
+        """
+        Truncated SVD of a far block to the tolerance (see class docstring)
+        :param A: np.array of shape (M, N)
+        :param target: np.array of shape (M, ) of allowed L1 norms of the
+            rows of the truncation error
+        :return: None if the factors wouldn't be smaller than A, otherwise
+            the factors U (M, k) and V (k, N) and the error A - U @ V
+        """
+        u, s, vt = np.linalg.svd(A, full_matrices=False)
+        # Start from a Frobenius-norm estimate of the rank and increase it
+        # until every row meets its L1 bound
+        tail = np.sqrt(np.cumsum(s[::-1]**2))[::-1]
+        k = max(1, int(np.sum(tail > np.sqrt(np.sum(target**2)))))
+        while k*(A.shape[0] + A.shape[1]) < A.size:
+            U, V = u[:,:k]*s[:k], vt[:k]
+            E = A - U @ V
+            if np.all(np.sum(np.abs(E), axis=1) <= target):
+                return U, V, E
+            k += max(1, k//4)
+        return None
+
+    def _unpack(self, arrays):
+        """
+        Set up views into the packed arrays for dpred and rmatvec
+        :param arrays: dict of np.arrays (or memory maps) from _compress
+        """
+        nr, nb, self.nz = [int(n) for n in arrays['counts']]
+        self.error_l1 = np.asarray(arrays['error_l1'])
+        self.row_l1 = np.asarray(arrays['row_l1'])
+        ilens = np.asarray(arrays['ilens'])
+        isplit = np.split(arrays['ints'], np.cumsum(ilens)[:-1])
+        rows, near_cells = isplit[:nr], isplit[nr:2*nr]
+        cells, zpos = isplit[2*nr:2*nr+nb], isplit[2*nr+nb:]
+        zslices = [tuple(z) for z in np.asarray(arrays['zslices'])]
+        shapes = ([(len(rc), len(nc)) for rc, nc in zip(rows, near_cells)]
+                  + [(len(rc), z1 - z0) for rc, (z0, z1) in zip(rows, zslices)]
+                  + [(len(zp), len(cb)) for zp, cb in zip(zpos, cells)])
+        flens = np.array([a*b for a, b in shapes], dtype=np.int64)
+        fsplit = np.split(arrays['floats'], np.cumsum(flens)[:-1])
+        mats = [f.reshape(shape) for f, shape in zip(fsplit, shapes)]
+        self.chunks = list(zip(rows, near_cells, mats[:nr],
+                               mats[nr:2*nr], zslices))
+        self.blocks = list(zip(cells, zpos, mats[2*nr:]))
+        self.stored_size = int(np.sum(flens))
+
+    def _load_or_compress(self, cache_dir):
+        """
+        Load the compressed matrix for this mesh, survey and compression
+        settings from an on-disk cache, compressing and storing it first if
+        it isn't there yet
+        :param cache_dir: directory in which to keep compressed matrices
+        :return: dict of read-only np.memmaps in the layout of _compress
+        """
+        settings = (self.tol, self.eta, self.chunk_size,
+                    self.block_cells, self.dtype.str)
+        key = hashlib.sha1("{}{}".format(sensitivity_cache_key(
+            self.mesh, self.survey, self.ind_active), settings).encode()
+            ).hexdigest()
+        dname = os.path.join(cache_dir, "Gc_{}".format(key))
+        if not os.path.exists(dname):
+            arrays = self._compress()
+            # Same trick as load_cached_sensitivities:  write to a private
+            # temporary directory and rename it into place
+            tmpdname = "{}.{}.tmp".format(dname, os.getpid())
+            os.makedirs(tmpdname, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmpdname, name + ".npy"), arr)
+            try:
+                os.replace(tmpdname, dname)
+            except OSError:
+                # Another process got there first
+                for name in arrays:
+                    os.remove(os.path.join(tmpdname, name + ".npy"))
+                os.rmdir(tmpdname)
+        names = ['counts', 'zslices', 'ilens', 'ints', 'floats',
+                 'error_l1', 'row_l1']
+        return {name: np.load(os.path.join(dname, name + ".npy"),
+                              mmap_mode='r') for name in names}
+
+    @property
+    def compression_ratio(self):
+        """
+        Number of entries in the dense G over the number actually stored
+        """
+        return self.nactive*len(self.error_l1)/max(1, self.stored_size)
+
+    @property
+    def max_relative_error(self):
+        """
+        Largest error in any reading for any model with |rho| <= rho_max,
+        relative to the largest reading any such model can produce
+        """
+        return np.max(self.error_l1)/np.max(self.row_l1)
+
+    def dpred_error_bound(self, model):
+        """
+        :param model: np.array of shape (Nactive, ) of densities (g/cc)
+        :return: np.array of bounds on the error of each reading of
+            dpred(model) compared to the dense forward model
+        """
+        return self.error_l1*np.max(np.abs(model))
+
+    def dpred(self, model):
+        """
+        :param model: np.array of shape (Nactive, ) of densities (g/cc)
+        :return: np.array of gz readings (mGal) in survey order
+        """
+        return self.dpred_batch(np.asarray(model)[np.newaxis])[0]
+
+    def dpred_batch(self, models):
+        """
+        :param models: np.array of shape (M, Nactive) of densities (g/cc)
+        :return: np.array of shape (M, Nsensors) of gz readings
+        """
+        X = np.asarray(models).T
+        z = np.zeros((self.nz, X.shape[1]))
+        for cells, zpos, V in self.blocks:
+            z[zpos] = V @ X[cells]
+        gz = np.zeros((len(self.error_l1), X.shape[1]))
+        for rows, near_cells, G, U, (z0, z1) in self.chunks:
+            gz[rows] = G @ X[near_cells] + U @ z[z0:z1]
+        return gz.T
+
+    def rmatvec(self, data):
+        """
+        Transpose of dpred, for gradients by the adjoint method
+        :param data: np.array of shape (Nsensors, ) in survey order
+        :return: np.array of shape (Nactive, )
+        """
+        data = np.asarray(data)
+        z = np.zeros(self.nz)
+        rho = np.zeros(self.nactive)
+        for rows, near_cells, G, U, (z0, z1) in self.chunks:
+            rho[near_cells] += G.T @ data[rows]
+            z[z0:z1] = U.T @ data[rows]
+        for cells, zpos, V in self.blocks:
+            rho[cells] += V.T @ z[zpos]
+        return rho
+
+def relative_gravity_loglike(pred, data, sigdata):
+    """
+    Independent Gaussian log likelihood of gravity data, with the mean of
+    the residuals removed since only relative gravity is measured
+    :param pred: np.array of predicted gravity readings
+    :param data: np.array of observed gravity readings
+    :param sigdata: standard deviation of the noise in the data
+    :return: float
+    """
+    resids = pred - data
+    resids = resids - resids.mean()
+    return -0.5*np.sum(resids**2/sigdata**2 + np.log(2*np.pi*sigdata**2))
+
+
+class StreamingGravity:
+    """
+    Gravity forward model (gz) that streams its sensitivity matrix through
+    memory a block of receivers at a time, for surveys too large for a
+    dense G.  The blocks are computed once from the exact prism formula
+    and written to disk, either to a single .npy file in a cache directory
+    or to an anonymous temporary file, which is then read back as a memory
+    map; peak memory is O(chunk_size x nC).
+    """
+
+    def __init__(self, mesh, survey, chunk_size=1024, cache_dir=None,
+                 dtype=np.float32, ind_active=None):
+        """
+        :param mesh: discretize.mesh instance
+        :param survey: gravity survey geometry
+        :param chunk_size: number of receivers per block
+        :param cache_dir: optional directory in which to keep G on disk
+            between runs; if None, G goes to a temporary file (in the
+            default directory of the tempfile module, e.g. $TMPDIR) that
+            is deleted along with this instance
+        :param dtype: floating-point type in which to store G
+        :param ind_active: optional boolean np.array of shape (mesh.nC, )
+            of cells to include; models then have one entry per active cell
+        """
+        self.mesh, self.survey = mesh, survey
+        if ind_active is None:
+            ind_active = np.ones(mesh.nC, dtype=bool)
+        self.ind_active = np.asarray(ind_active, dtype=bool)
+        self.nactive = int(np.sum(self.ind_active))
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.nsensors = len(survey.receiver_locations)
+        self.centers = mesh.gridCC[self.ind_active]
+        self.widths = mesh_cell_widths(mesh)[self.ind_active]
+        self.G = None
+        if cache_dir is not None:
+            self.G = self._load_or_build(cache_dir)
+        else:
+            self.G = self._build_temporary()
+
+    def _chunk(self, i):
+        """
+        :param i: index of the first receiver in the block
+        :return: np.array of shape (chunk_size, Nactive) of sensitivities
+        """
+        if self.G is not None:
+            return np.asarray(self.G[i:i+self.chunk_size])
+        locs = self.survey.receiver_locations[i:i+self.chunk_size]
+        return prism_gz_sensitivities(
+            locs, self.centers, self.widths).astype(self.dtype)
+
+    def chunks(self):
+        """
+        :return: iterator over (slice of receivers, block of G) pairs
+        """
+        for i in range(0, self.nsensors, self.chunk_size):
+            yield slice(i, i + self.chunk_size), self._chunk(i)
+
+    def _load_or_build(self, cache_dir):
+        """
+        Load G from an on-disk cache, writing it out block by block first
+        if it isn't there yet
+        :param cache_dir: directory in which to keep the matrix
+        :return: read-only np.memmap of shape (Nsensors, Nactive)
+        """
+        key = sensitivity_cache_key(self.mesh, self.survey, self.ind_active)
+        fname = os.path.join(cache_dir, "G_{}_{}.npy".format(
+            key, self.dtype.str.strip('<>=|')))
+        if not os.path.exists(fname):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Same trick as load_cached_sensitivities:  write to a private
+            # temporary file and rename it into place
+            tmpfname = "{}.{}.tmp".format(fname, os.getpid())
+            G = np.lib.format.open_memmap(
+                tmpfname, mode='w+', dtype=self.dtype,
+                shape=(self.nsensors, self.nactive))
+            for rows, Gi in self.chunks():
+                G[rows] = Gi
+            G.flush()
+            del G
+            os.replace(tmpfname, fname)
+        return np.load(fname, mmap_mode='r')
+
+    def _build_temporary(self):
+        """
+        Write G block by block to an anonymous temporary file, which the
+        operating system removes once it's closed
+        :return: np.memmap of shape (Nsensors, Nactive)
+        """
+        self._tmpfile = tempfile.TemporaryFile()
+        G = np.memmap(self._tmpfile, dtype=self.dtype, mode='w+',
+                      shape=(self.nsensors, self.nactive))
+        for rows, Gi in self.chunks():
+            G[rows] = Gi
+        G.flush()
+        return G
+
+    def dpred(self, model):
+        """
+        :param model: np.array of shape (Nactive, ) of densities (g/cc)
+        :return: np.array of gz readings (mGal) in survey order
+        """
+        return self.dpred_batch(np.asarray(model)[np.newaxis])[0]
+
+    def dpred_batch(self, models):
+        """
+        :param models: np.array of shape (M, Nactive) of densities (g/cc)
+        :return: np.array of shape (M, Nsensors) of gz readings
+        """
+        X = np.asarray(models).T
+        gz = np.zeros((self.nsensors, X.shape[1]))
+        for rows, Gi in self.chunks():
+            gz[rows] = Gi @ X.astype(Gi.dtype, copy=False)
+        return gz.T
+
+    def rmatvec(self, data):
+        """
+        Transpose of dpred, for gradients by the adjoint method
+        :param data: np.array of shape (Nsensors, ) in survey order
+        :return: np.array of shape (Nactive, )
+        """
+        rho = np.zeros(self.nactive)
+        for rows, Gi in self.chunks():
+            rho += Gi.T @ data[rows]
+        return rho
+
+    def log_likelihood(self, model, data, sigdata):
+        """
+        Same as relative_gravity_loglike(self.dpred(model), data, sigdata),
+        but reduced block by block as the predictions are made
+        :param model: np.array of shape (Nactive, ) of densities (g/cc)
+        :param data: np.array of observed gravity readings
+        :param sigdata: standard deviation of the noise in the data, either
+            a float or an np.array of shape (Nsensors, )
+        :return: float
+        """
+        sigdata = np.broadcast_to(sigdata, (self.nsensors, ))
+        # Sums over receivers of 1/s^2, r, r/s^2, r^2/s^2, and log(2 pi s^2)
+        S0, Sr, S1, S2, Slog = 0.0, 0.0, 0.0, 0.0, 0.0
+        for rows, Gi in self.chunks():
+            r, ivar = Gi @ model - data[rows], 1.0/sigdata[rows]**2
+            S0, Sr = S0 + np.sum(ivar), Sr + np.sum(r)
+            S1, S2 = S1 + np.sum(r*ivar), S2 + np.sum(r**2*ivar)
+            Slog += np.sum(np.log(2*np.pi*sigdata[rows]**2))
+        # Sum of (r - rbar)^2/s^2 with rbar the mean residual
+        rbar = Sr/self.nsensors
+        return -0.5*(S2 - 2*rbar*S1 + rbar**2*S0 + Slog)
+
+class DenseGravity:
+    """
+    Gravity forward model from an explicit dense sensitivity matrix
+    """
+
+    def __init__(self, G):
+        """
+        :param G: np.array of shape (Nsensors, Nactive)
+        """
+        self.G = G
+
+    def dpred(self, model):
+        return self.G @ model
+
+    def rmatvec(self, data):
+        return self.G.T @ data
+
+def _cell_keys(mesh, scale):
+    """
+    :param mesh: discretize.mesh instance
+    :param scale: length below which cell positions and sizes are the same
+    :return: np.array of shape (mesh.nC, ) of hashable, sortable cell keys
+    """
+    k = np.round(np.hstack([mesh.gridCC, mesh_cell_widths(mesh)])/scale)
+    k = np.ascontiguousarray(k.astype(np.int64))
+    return k.view(np.dtype((np.void, k.itemsize*k.shape[1]))).ravel()
+
+def reuse_sensitivities(mesh, survey, old_mesh=None, old_G=None):
+    """
+    Sensitivity matrix of a mesh that shares many of its cells with an
+    earlier one, e.g. an octree mesh rebuilt around interfaces that have
+    moved:  each column depends only on the position and size of its cell,
+    so the columns of cells in the old mesh are copied over, and only the
+    new cells are computed (with prism_gz_sensitivities)
+    :param mesh: discretize.mesh instance
+    :param survey: gravity survey geometry
+    :param old_mesh: optional earlier mesh over the same survey
+    :param old_G: sensitivity matrix of old_mesh, e.g. from an earlier call
+    :return: np.array of shape (Nsensors, mesh.nC), and the number of
+        columns that had to be computed
+    """
+    locations = survey.receiver_locations
+    widths = mesh_cell_widths(mesh)
+    G = np.zeros((len(locations), mesh.nC))
+    new = np.ones(mesh.nC, dtype=bool)
+    if old_mesh is not None:
+        scale = 1e-6*np.min(widths)
+        common, inew, iold = np.intersect1d(
+            _cell_keys(mesh, scale), _cell_keys(old_mesh, scale),
+            return_indices=True)
+        G[:,inew] = old_G[:,iold]
+        new[inew] = False
+    if np.any(new):
+        G[:,new] = prism_gz_sensitivities(
+            locations, mesh.gridCC[new], widths[new])
+    return G, int(np.sum(new))
 
 class DiscreteGravity:
     """
     Run regular gravity model on a single mesh
     """
 
-    def __init__(self, mesh, survey, gfunc):
+    def __init__(self, mesh, survey, gfunc, cache_dir=None, engine="integral",
+                 incremental=False, max_changed_fraction=0.1,
+                 max_incremental_updates=100, antialias=None, shared=None,
+                 ind_active=None, fixed_density=0.0, background_density=None,
+                 subsample=None, gfunc_batch=None):
         """
         Initialize the problem
         :param mesh: discretize.mesh instance
         :param survey: SimPEG.gravity.Gravity.Survey instance
         :param gfunc: geology function mapping a np.array of (x,y,z) positions
             (shape = (N, 3)) to a set of rock properties (density contrast)
+        :param cache_dir: optional directory for an on-disk sensitivity cache
+            shared between runs and processes (see build_forward_model)
+        :param engine: 'integral', 'fft', 'compressed', 'streaming', 'auto',
+            or a function returning a forward model (see build_forward_model)
+        :param incremental: if True, calc_gravity() updates the data of the
+            last committed model using only the cells that have changed;
+            use commit() and rollback() to accept or reject proposals
+        :param max_changed_fraction: fraction of changed cells above which
+            an incremental update falls back to the full forward model
+        :param max_incremental_updates: number of incremental updates after
+            which the full forward model is rerun, to flush rounding error
+        :param antialias: optional partial volume model pvfunc(r0, n), e.g.
+            antialias.partial_volume_exact or an instance of
+            antialias.TabulatedAntialiasing; if given, gfunc is also passed
+            keyword arguments pvfunc and cell_widths (as accepted by
+            implicit.GeoHistory.rockprops) so that cells cut by interfaces
+            get volume-weighted rock properties
+        :param shared: optional SharedArrays instance (see
+            publish_sensitivities) holding the sensitivity matrix 'G' for
+            this mesh and survey, and optionally the cell centers 'gridCC';
+            the forward model then runs against the shared buffers (only
+            with engine='integral' and no cache_dir)
+        :param ind_active: optional boolean np.array of shape (mesh.nC, )
+            marking the cells whose rock properties come from gfunc; the
+            rest (e.g. air above the surface) are dropped from the forward
+            model, and gfunc is only evaluated on the active cells
+        :param fixed_density: density of the inactive cells, as a float or an
+            np.array with one entry per inactive cell; their (constant)
+            gravity is calculated once and added to every prediction
+        :param background_density: optional reference density subtracted
+            from the active cells, so that the data are those of density
+            contrasts; either a float, or 'mean' to use the (volume-weighted)
+            mean density of each model.  Uses the cached response of a
+            unit-density model, so needs no extra forward pass per model.
+        :param subsample: optional sample spacing for meshes with large
+            cells, e.g. the padding of padded_tensor_mesh; cells wider than
+            this get the average of gfunc over sub-cells (see VoxelSampler)
+            instead of its value at their centers
+        :param gfunc_batch: optional function like gfunc, but taking a stack
+            of parameter vectors after gfunc's arguments and returning rock
+            properties of shape (M, N), e.g. GeoHistory.rockprops_batch;
+            needed by calc_gravity_batch()
         """
         # Set all the initial stuff up
         self.survey = survey
@@ -250,17 +1432,74 @@ class DiscreteGravity:
         self.gfunc = gfunc
         # Initialize a gravity simulation object to cache sensitivities and
         # make MCMC that much faster
-        self.model_map = maps.IdentityMap(mesh=mesh, nP=mesh.nC)
-        self.ind_active = np.array([True for i in range(mesh.nC)])
-        self.fwd = gravity.simulation.Simulation3DIntegral(
-            survey=self.survey,
-            mesh=self.mesh,
-            rhoMap=self.model_map,
-            actInd=self.ind_active,
-            store_sensitivities="ram",
-        )
+        self.gridCC = None
+        self.ind_active = ind_active
+        if ind_active is not None:
+            self.ind_active = np.asarray(ind_active, dtype=bool)
+        if shared is None:
+            self.fwd = build_forward_model(
+                mesh, survey, cache_dir=cache_dir, engine=engine,
+                ind_active=ind_active)
+        else:
+            if engine != "integral" or cache_dir is not None:
+                raise ValueError("shared sensitivities only work with the "
+                                 "'integral' engine and no cache_dir")
+            nactive = (mesh.nC if self.ind_active is None
+                       else int(np.sum(self.ind_active)))
+            if shared['G'].shape != (survey.nD, nactive):
+                raise ValueError("shared G has shape {}, expected {}"
+                                 .format(shared['G'].shape,
+                                         (survey.nD, nactive)))
+            self.fwd = build_forward_model(mesh, survey, ind_active=ind_active)
+            self.fwd._G = shared['G']
+            if 'gridCC' in shared:
+                self.gridCC = shared['gridCC']
+        if self.ind_active is not None:
+            # Keep one array of active cell centers, so that gfunc sees the
+            # same points every time (see implicit.WarpCache)
+            gridCC = self.mesh.gridCC if self.gridCC is None else self.gridCC
+            self.gridCC = gridCC[self.ind_active]
+        self.shared = shared
+        self.gfunc_batch = gfunc_batch
         self.voxmodel = None
         self.fwd_data = None
+        self.antialias = antialias
+        self.cell_widths = None
+        self.sampler = None
+        if subsample is not None:
+            self.sampler = VoxelSampler(mesh, subsample,
+                                        ind_active=self.ind_active)
+            self.cell_widths = self.sampler.widths
+        elif antialias is not None:
+            self.cell_widths = mesh_cell_widths(mesh)
+            if self.ind_active is not None:
+                self.cell_widths = self.cell_widths[self.ind_active]
+        # Constant parts of the data:  the inactive cells, and the response
+        # of a unit-density model for the background correction
+        self.fixed_response = 0.0
+        if self.ind_active is not None and np.any(fixed_density != 0):
+            fixed_fwd = build_forward_model(
+                mesh, survey, cache_dir=cache_dir, engine=engine,
+                ind_active=~self.ind_active)
+            nfixed = np.sum(~self.ind_active)
+            fixed = np.broadcast_to(fixed_density, (nfixed, ))
+            self.fixed_response = fixed_fwd.dpred(np.array(fixed, dtype=float))
+        self.background_density = background_density
+        self.background_response = None
+        self.volume_weights = np.asarray(mesh.vol)
+        if self.ind_active is not None:
+            self.volume_weights = self.volume_weights[self.ind_active]
+        self.volume_weights = self.volume_weights/np.sum(self.volume_weights)
+        if background_density is not None:
+            ones = np.ones(len(self.volume_weights))
+            self.background_response = self.fwd.dpred(ones)
+        # State of the last accepted model for incremental updates
+        self.incremental = incremental
+        self.max_changed_fraction = max_changed_fraction
+        self.max_incremental_updates = max_incremental_updates
+        self.committed_voxmodel = None
+        self.committed_fwd_data = None
+        self.updates_since_full = self.pending_updates = 0
 
     def calc_voxmodel(self, *args):
         """
@@ -268,7 +1507,14 @@ class DiscreteGravity:
         :param *args: arguments to pass to gfunc
         :return: np.array of voxelized rock properties
         """
-        self.voxmodel = self.gfunc(self.mesh.gridCC, *args)
+        gridCC = self.mesh.gridCC if self.gridCC is None else self.gridCC
+        kwargs = { }
+        if self.antialias is not None:
+            kwargs = dict(pvfunc=self.antialias, cell_widths=self.cell_widths)
+        if self.sampler is None:
+            self.voxmodel = self.gfunc(gridCC, *args, **kwargs)
+        else:
+            self.voxmodel = self.sampler(self.gfunc, *args, **kwargs)
         return self.voxmodel
 
     def calc_gravity(self, *args):
@@ -278,32 +1524,437 @@ class DiscreteGravity:
         """
         # The baseline action is to just evaluate the rock properties directly
         # at the centers of the mesh, which will almost certainly not give
-        # very good convergence behavior; if/when we sort out anti-aliasing
-        # for rectilinear meshes, we should include it here
+        # very good convergence behavior; with antialias set, cells cut by
+        # interfaces get partial-volume averages instead, which converges
+        # much faster with mesh size
+        self.calc_voxmodel(*args)
+        if self.incremental and self.committed_voxmodel is not None:
+            self.fwd_data = self._incremental_dpred()
+        else:
+            self.fwd_data = self.dpred(self.voxmodel)
+            self.pending_updates = 0
+            if self.incremental:
+                # Nothing to update from yet, so this becomes the baseline
+                self.commit()
+        return self.fwd_data
+
+    def calc_log_likelihood(self, data, sigdata, *args):
+        """
+        Log likelihood of gravity data (see relative_gravity_loglike); with
+        a StreamingGravity forward model the predictions are reduced block
+        by block without ever holding all of G
+        :param data: np.array of observed gravity readings
+        :param sigdata: standard deviation of the noise in the data
+        :param *args: arguments to pass to gfunc
+        :return: float
+        """
+        if self.incremental or not hasattr(self.fwd, 'log_likelihood'):
+            return relative_gravity_loglike(
+                self.calc_gravity(*args), data, sigdata)
         self.calc_voxmodel(*args)
-        self.fwd_data = self.fwd.dpred(self.voxmodel)
+        self.fwd_data = None
+        offset = self.background_offset(self.mean_density(self.voxmodel))
+        return self.fwd.log_likelihood(self.voxmodel, data - offset, sigdata)
+
+    def background_offset(self, mean_density):
+        """
+        Part of the data not computed by the forward model:  the gravity of
+        the inactive cells, less that of the background density
+        :param mean_density: mean density of the active cells of the model
+            (used if background_density is 'mean')
+        :return: float or np.array of shape (Nsensors, )
+        """
+        offset = self.fixed_response
+        if self.background_density is None:
+            return offset
+        if isinstance(self.background_density, str):
+            rho_bg = mean_density
+        else:
+            rho_bg = self.background_density
+        return offset - rho_bg*self.background_response
+
+    def dpred(self, model):
+        """
+        :param model: np.array of densities of the active cells
+        :return: np.array of gravity readings, including background_offset()
+        """
+        offset = self.background_offset(self.mean_density(model))
+        return self.fwd.dpred(model) + offset
+
+    def rmatvec(self, data):
+        """
+        Transpose of dpred() (less its constant part), for gradients by the
+        adjoint method
+        :param data: np.array of shape (Nsensors, )
+        :return: np.array with one entry per active cell
+        """
+        model = forward_adjoint(self.fwd, data)
+        if isinstance(self.background_density, str):
+            model -= (np.dot(self.background_response, data)
+                      * self.volume_weights)
+        return model
+
+    def dpred_batch(self, models, chunk=64):
+        """
+        Same as dpred() for a stack of models, using matrix-matrix products
+        (see the module-level dpred_batch)
+        :param models: np.array of shape (M, Nactive) of densities
+        :param chunk: number of models per product
+        :return: np.array of shape (M, Nsensors) of gravity readings
+        """
+        models = np.atleast_2d(models)
+        pred = dpred_batch(self.fwd, models, chunk) + self.fixed_response
+        if self.background_density is not None:
+            if isinstance(self.background_density, str):
+                rho_bg = models @ self.volume_weights
+            else:
+                rho_bg = np.full(len(models), self.background_density)
+            pred -= rho_bg[:,np.newaxis]*self.background_response
+        return pred
+
+    def calc_voxmodel_batch(self, P, *args):
+        """
+        Voxelized rock properties for a stack of parameter vectors
+        :param P: np.array of shape (M, Npars) of parameter vectors
+        :param *args: arguments to pass to gfunc_batch before P
+        :return: np.array of shape (M, Nactive)
+        """
+        if self.gfunc_batch is None:
+            raise ValueError("calc_voxmodel_batch() needs gfunc_batch")
+        if self.antialias is not None:
+            raise ValueError("batch voxelization can't antialias")
+        if self.sampler is not None:
+            return self.sampler.average(
+                self.gfunc_batch(self.sampler.points, *args, P))
+        gridCC = self.mesh.gridCC if self.gridCC is None else self.gridCC
+        return self.gfunc_batch(gridCC, *args, P)
+
+    def calc_gravity_batch(self, P, *args, chunk=64):
+        """
+        Gravity for a stack of parameter vectors, e.g. for prior or
+        posterior predictive checks; models are voxelized and run through
+        the forward model chunk by chunk, so memory stays O(chunk x nC).
+        Does not touch self.voxmodel, self.fwd_data or the incremental state.
+        :param P: np.array of shape (M, Npars) of parameter vectors
+        :param *args: arguments to pass to gfunc_batch before P
+        :param chunk: number of models to voxelize and predict at once
+        :return: np.array of shape (M, Nsensors) of gravity readings
+        """
+        P = np.atleast_2d(P)
+        return np.concatenate([
+            self.dpred_batch(self.calc_voxmodel_batch(P[i:i+chunk], *args),
+                             chunk)
+            for i in range(0, len(P), chunk)])
+
+    def mean_density(self, model):
+        """
+        :param model: np.array of densities of the active cells
+        :return: volume-weighted mean density
+        """
+        return np.dot(self.volume_weights, model)
+
+    def _incremental_dpred(self):
+        """
+        Calculate the data for self.voxmodel from the committed model,
+        using only the sensitivities of the cells that have changed
+        :return: np.array of gravity readings
+        """
+        vox0, data0 = self.committed_voxmodel, self.committed_fwd_data
+        changed = np.flatnonzero(self.voxmodel != vox0)
+        if (getattr(self.fwd, 'G', None) is None
+                or len(changed) > self.max_changed_fraction*len(vox0)
+                or self.updates_since_full >= self.max_incremental_updates):
+            self.pending_updates = 0
+            return self.dpred(self.voxmodel)
+        self.pending_updates = self.updates_since_full + 1
+        delta = self.voxmodel[changed] - vox0[changed]
+        offset0 = self.background_offset(self.mean_density(vox0))
+        offset = self.background_offset(self.mean_density(self.voxmodel))
+        return data0 + np.dot(self.fwd.G[:,changed], delta) + offset - offset0
+
+    def commit(self):
+        """
+        Accept the current model as the base for incremental updates
+        """
+        self.committed_voxmodel = self.voxmodel
+        self.committed_fwd_data = self.fwd_data
+        self.updates_since_full = self.pending_updates
+
+    def rollback(self):
+        """
+        Reject the current model and go back to the last committed one
+        """
+        self.voxmodel = self.committed_voxmodel
+        self.fwd_data = self.committed_fwd_data
+        self.pending_updates = self.updates_since_full
+
+    def calc_unit_responses(self, ufunc, *args):
+        """
+        Rock properties enter the forward model linearly, so for a fixed
+        geometry the gravity signal is a weighted sum of the signals of the
+        individual rock units; calculate those once per geometry so that
+        proposals changing only densities can use calc_gravity_densities()
+        :param ufunc: function mapping a np.array of (x,y,z) positions
+            (shape = (N, 3)) to the fraction of each position belonging
+            to each of K rock units (shape = (K, N)), for instance
+            GeoHistory.unit_indicators
+        :param *args: arguments to pass to ufunc
+        :return: np.array of shape (K, Nsensors) of unit-density responses
+        """
+        gridCC = self.mesh.gridCC if self.gridCC is None else self.gridCC
+        if self.sampler is None:
+            self.unit_voxmodels = ufunc(gridCC, *args)
+        else:
+            self.unit_voxmodels = self.sampler(ufunc, *args)
+        self.unit_data = np.array([self.fwd.dpred(u)
+                                   for u in self.unit_voxmodels])
+        self.unit_means = [self.mean_density(u) for u in self.unit_voxmodels]
+        return self.unit_data
+
+    def calc_gravity_densities(self, densities):
+        """
+        Gravity for new unit densities on the geometry last passed to
+        calc_unit_responses(), at a cost of O(K x Nsensors); the voxel model
+        is not recalculated, so self.voxmodel is reset to None
+        :param densities: np.array of shape (K, ) of unit densities
+        :return: np.array of gravity readings
+        """
+        self.voxmodel = None
+        self.fwd_data = (np.dot(densities, self.unit_data)
+                         + self.background_offset(
+                             np.dot(densities, self.unit_means)))
         return self.fwd_data
 
     def plot_model_slice(self, **kwargs):
-        plot_model_slice(self.mesh, self.voxmodel, **kwargs)
+        model = self.voxmodel
+        if self.ind_active is not None:
+            model = np.full(self.mesh.nC, np.nan)
+            model[self.ind_active] = self.voxmodel
+        plot_model_slice(self.mesh, model, **kwargs)
 
     def plot_gravity(self, **kwargs):
         plot_gravity(self.survey, self.fwd_data, **kwargs)
 
 
+def nested_parent_index(N, ratio):
+    """
+    Map the cells of a cubical tensor mesh onto those of a nested coarser
+    mesh with the same extent, as set up by baseline_tensor_mesh
+    :param N: length of one edge of the fine mesh in cells
+    :param ratio: ratio of coarse to fine cell sizes (must divide N)
+    :return: np.array of shape (N**3, ) giving, for each fine cell, the
+        index of the coarse cell that contains it
+    """
+    Nc = N // ratio
+    i = np.arange(N) // ratio
+    ix, iy, iz = np.meshgrid(i, i, i, indexing='ij')
+    return mkvc(ix + Nc*iy + Nc**2*iz)
+
+class RichardsonExtrapolator:
+    """
+    Batched Richardson extrapolation f(h) = f0 + c*h^alpha over a fixed set
+    of mesh sizes.  Everything that depends only on h and alpha is worked
+    out up front for a fine grid of alphas, so a fit is a few small tensor
+    contractions with no Python loops, cheap enough to run per likelihood
+    """
+
+    def __init__(self, h, alphas=None):
+        """
+        :param h: np.array of shape (L, ) of mesh block sizes
+        :param alphas: np.array of convergence orders to consider
+            (default = 401 values spaced logarithmically over [0.32, 3.2])
+        """
+        if alphas is None:
+            alphas = 10**np.linspace(-0.5, 0.5, 401)
+        self.h = np.asarray(h, dtype=float)
+        self.alphas = np.asarray(alphas, dtype=float)
+        if len(self.h) < 2:
+            raise ValueError("Richardson extrapolation needs at least "
+                             "two mesh sizes")
+        # Scale h to keep the regressions well conditioned; c absorbs this
+        hs = self.h/np.max(self.h)
+        X = np.stack([np.ones((len(self.alphas), len(hs))),
+                      hs[np.newaxis,:]**self.alphas[:,np.newaxis]], axis=-1)
+        # Row 0 of each pseudoinverse maps the data straight to f0, and
+        # each residual maker maps the data to the regression residuals
+        pinv = np.linalg.pinv(X)
+        self.hs = hs
+        self.f0_weights = pinv[:,0,:]
+        self.resid_maker = np.eye(len(hs)) - X @ pinv
+        self.dof = len(hs) - 2
+
+    def _explained(self, FF, alpha):
+        """
+        :param FF: np.array of shape (M, L, L) of data cross products
+            summed over the sensors
+        :param alpha: np.array of shape (M, K) of convergence orders
+        :return: np.array of shape (M, K) of the sums of squares explained
+            by the h^alpha term, i.e. the total squared residuals up to a
+            constant that doesn't depend on alpha
+        """
+        x = self.hs**alpha[...,np.newaxis]
+        dx = x - np.mean(x, axis=-1, keepdims=True)
+        return np.sum(dx*(dx @ FF), axis=-1)/np.sum(dx**2, axis=-1)
+
+    def _refine_alpha(self, FF, i, niter=2, dalpha=1e-4):
+        """
+        Newton iterations for the best alpha, starting from the best grid
+        point and kept between its neighbours
+        :param FF: np.array of shape (M, L, L) of data cross products
+        :param i: np.array of shape (M, ) of indices of the best grid points
+        :param niter: number of Newton iterations
+        :param dalpha: step for finite differences in alpha
+        :return: np.array of shape (M, ) of refined alphas
+        """
+        lo = self.alphas[np.maximum(i-1, 0)]
+        hi = self.alphas[np.minimum(i+1, len(self.alphas)-1)]
+        alpha, steps = self.alphas[i], np.array([-dalpha, 0.0, dalpha])
+        for it in range(niter):
+            q = self._explained(FF, alpha[:,np.newaxis] + steps)
+            d1 = (q[:,2] - q[:,0])/(2*dalpha)
+            d2 = (q[:,2] - 2*q[:,1] + q[:,0])/dalpha**2
+            # We're maximizing q, so only step where it's locally concave
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.where(d2 < 0, -d1/d2, 0.0)
+            alpha = np.clip(alpha + step, lo, hi)
+        return alpha
+
+    def _regress(self, F, alpha):
+        """
+        Closed-form least squares fit of f = f0 + c*h^alpha
+        :param F: np.array of shape (L, M, S) of gravity readings
+        :param alpha: np.array of shape (M, ) of convergence orders
+        :return: tuple (f0, c, x) with f0 and c of shape (M, S), and
+            x = h^alpha of shape (M, L)
+        """
+        x = self.hs[np.newaxis,:]**alpha[:,np.newaxis]
+        xm = np.mean(x, axis=1)
+        dx = x - xm[:,np.newaxis]
+        c = np.einsum('ml,lms->ms', dx, F)/np.sum(dx**2, axis=1)[:,np.newaxis]
+        f0 = np.mean(F, axis=0) - c*xm[:,np.newaxis]
+        return f0, c, x
+
+    def fit(self, f, full_cov=False, dalpha=1e-3):
+        """
+        Fit the extrapolation for every sensor (and every parameter sample)
+        at once.  The convergence order alpha is shared by all sensors of a
+        sample; f0 comes with a discretization-error covariance made up of
+        the regression variance at the best alpha, plus the uncertainty in
+        alpha from the curvature of its profile likelihood propagated
+        through df0/dalpha.  With only two mesh sizes every alpha fits
+        exactly, so f0 and its covariance come from averaging over the grid
+        :param f: np.array of shape (L, S) or (L, M, S) of gravity readings
+            for the L mesh sizes, (M samples and) S sensors
+        :param full_cov: if True, return the full (S, S) covariance between
+            sensors instead of only its diagonal
+        :param dalpha: step for finite differences in alpha
+        :return: tuple (f0, cov, alpha) with f0 of shape ([M,] S), cov of
+            shape ([M,] S) or ([M,] S, S), and the best alpha of shape ([M])
+            (NaN if alpha is unconstrained)
+        """
+        f = np.asarray(f, dtype=float)
+        batched = (f.ndim == 3)
+        F = f if batched else f[:,np.newaxis,:]
+        if F.shape[0] != len(self.h):
+            raise ValueError("expected readings for {} mesh sizes, got {}"
+                             .format(len(self.h), F.shape[0]))
+        M, S = F.shape[1:]
+        if self.dof == 0:
+            f0_a = np.einsum('al,lms->ams', self.f0_weights, F)
+            f0 = np.mean(f0_a, axis=0)
+            df0 = f0_a - f0[np.newaxis]
+            alpha = np.full(M, np.nan)
+            if full_cov:
+                cov = np.einsum('ams,amt->mst', df0, df0)/len(self.alphas)
+            else:
+                cov = np.mean(df0**2, axis=0)
+        else:
+            # Total squared residuals on the alpha grid, from the quadratic
+            # form of the residual makers on the data cross products
+            FF = np.einsum('kms,lms->mkl', F, F)
+            rss = np.einsum('akl,mkl->ma', self.resid_maker, FF)
+            alpha = self._refine_alpha(FF, np.argmin(rss, axis=1))
+            f0, c, x = self._regress(F, alpha)
+            # Regression variance of f0 for each sensor at the best alpha
+            resid = F - f0 - c*x.T[:,:,np.newaxis]
+            sigma2 = np.sum(resid**2, axis=0)/self.dof
+            xm = np.mean(x, axis=1)
+            Sxx = np.sum((x - xm[:,np.newaxis])**2, axis=1)
+            var_reg = sigma2*(1.0/len(self.hs) + xm**2/Sxx)[:,np.newaxis]
+            # Variance of alpha from the profile likelihood of alpha with
+            # the noise level marginalized out, -log L = (ndof/2) log(rss)
+            FFtot = (np.trace(FF, axis1=1, axis2=2)
+                     - np.sum(FF, axis=(1,2))/len(self.hs))
+            steps = np.array([-dalpha, 0.0, dalpha])
+            q = self._explained(FF, alpha[:,np.newaxis] + steps)
+            nll = 0.5*S*self.dof*np.log(
+                np.maximum(FFtot[:,np.newaxis] - q, 1e-300))
+            curv = (nll[:,2] - 2*nll[:,1] + nll[:,0])/dalpha**2
+            var_alpha = np.where(curv > 0, 1.0/np.maximum(curv, 1e-300),
+                                 np.ptp(self.alphas)**2/12)
+            J = (self._regress(F, alpha + dalpha)[0]
+                 - self._regress(F, alpha - dalpha)[0])/(2*dalpha)
+            if full_cov:
+                cov = (var_alpha[:,np.newaxis,np.newaxis]
+                       * np.einsum('ms,mt->mst', J, J))
+                cov[:,np.arange(S),np.arange(S)] += var_reg
+            else:
+                cov = var_alpha[:,np.newaxis]*J**2 + var_reg
+        if not batched:
+            f0, cov, alpha = f0[0], cov[0], alpha[0]
+        return f0, cov, alpha
+
+# TensorMesh and forward model pairs shared by all RichardsonGravity
+# instances, keyed by (L, dL, survey_cache_key(survey), pad_width, growth,
+# cache_dir); least recently used pairs are dropped beyond the size limit
+_richardson_meshxfwd = OrderedDict()
+richardson_cache_size = 8
+
+def clear_richardson_cache():
+    """
+    Drop the meshes and forward models shared by RichardsonGravity
+    instances, to free their sensitivity matrices; instances that already
+    hold them keep working
+    :return: nothing
+    """
+    _richardson_meshxfwd.clear()
+
 class RichardsonGravity:
     """
     Run gravity on different meshes, then solve for the infinite resolution
     limit with appropriate uncertainty attached
     """
 
-    def __init__(self, L, dL, survey, gfunc):
+    def __init__(self, L, dL, survey, gfunc, cache_dir=None, max_workers=None,
+                 nested=False, pad_width=0.0, growth=1.3, gfunc_batch=None,
+                 pad_subdivisions=2):
         """
         :param L: lateral extent of square survey area in meters
         :param dL: list of mesh block sizes in meters
         :param survey: gravity survey geometry
         :param gfunc: geology function mapping a np.array of (x,y,z) positions
             (shape = (N, 3)) to a set of rock properties (density contrast)
+        :param cache_dir: optional directory for an on-disk sensitivity cache
+            shared between runs and processes (see build_forward_model)
+        :param max_workers: number of threads used to evaluate the meshes
+            concurrently (default = one per mesh)
+        :param nested: if True, only the finest mesh gets a sensitivity
+            matrix; the coarser meshes must have block sizes that are the
+            finest one times powers of 2 and the same extent, so that their
+            voxels can be spread onto the finest mesh instead
+        :param pad_width: if > 0, pad each mesh by this width on every side
+            except the top, with cells growing geometrically from its block
+            size (see padded_tensor_mesh); the padding is voxelized by
+            volume averages over sub-cells (see VoxelSampler)
+        :param growth: ratio of the widths of successive padding cells
+        :param gfunc_batch: optional batch version of gfunc (see
+            DiscreteGravity), needed by calc_gravity_batch()
+        :param pad_subdivisions: most sub-cells along any axis of a padding
+            cell, or None to sample the padding at the block size; the
+            default keeps the number of gfunc evaluations within a small
+            multiple of the number of cells, rather than growing with the
+            padded volume, while the padding is far enough from the survey
+            for its coarser sampling not to matter
         """
         # Set all the initial stuff up
         self.survey = survey
@@ -311,21 +1962,86 @@ class RichardsonGravity:
         self.dL = list(sorted(dL)[::-1])
         self.survey = survey
         self.gfunc = gfunc
-        # Make a TensorMesh and forward model pair for each set of parameters
-        self.meshxfwd = [ ]
-        for dLi in self.dL:
-            NL = 2*int(L/dLi)
-            mesh = baseline_tensor_mesh(NL, dLi)
-            model_map = maps.IdentityMap(mesh=mesh, nP=mesh.nC)
-            ind_active = np.array([True for i in range(mesh.nC)])
-            fwd = gravity.simulation.Simulation3DIntegral(
-                survey=survey,
-                mesh=mesh,
-                rhoMap=model_map,
-                actInd=ind_active,
-                store_sensitivities="ram",
-            )
-            self.meshxfwd.append((mesh, fwd))
+        self.gfunc_batch = gfunc_batch
+        self.max_workers = max_workers or len(self.dL)
+        self.extrapolator = RichardsonExtrapolator(self.dL)
+        self.nested = nested
+        self.pad_width, self.growth = pad_width, growth
+        self.parent_index = None
+        self._coarse_G = None
+        if nested:
+            if pad_width > 0:
+                raise ValueError("nested meshes can't be padded")
+            self._setup_nested_meshes()
+        # Make a TensorMesh and forward model pair for each set of parameters,
+        # or reuse the pair from another instance with the same setup
+        skey = survey_cache_key(survey)
+        self.meshxfwd, self.samplers = [ ], [ ]
+        for i, dLi in enumerate(self.dL):
+            if nested and i < len(self.dL) - 1:
+                self.meshxfwd.append((self.coarse_meshes[i], None))
+                self.samplers.append(None)
+                continue
+            key = (L, dLi, skey, pad_width, growth, cache_dir)
+            if key in _richardson_meshxfwd:
+                _richardson_meshxfwd.move_to_end(key)
+            else:
+                NL = 2*int(L/dLi)
+                if pad_width > 0:
+                    mesh = padded_tensor_mesh(NL, dLi, pad_width, growth,
+                                              pad_top=False)
+                else:
+                    mesh = baseline_tensor_mesh(NL, dLi)
+                fwd = build_forward_model(mesh, survey, cache_dir=cache_dir)
+                _richardson_meshxfwd[key] = (mesh, fwd)
+            self.meshxfwd.append(_richardson_meshxfwd[key])
+            while len(_richardson_meshxfwd) > richardson_cache_size:
+                _richardson_meshxfwd.popitem(last=False)
+            mesh = self.meshxfwd[-1][0]
+            if pad_width > 0:
+                # Padding cells wider than the cap are expected here
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    self.samplers.append(VoxelSampler(
+                        mesh, dLi, max_subdivisions=pad_subdivisions))
+            else:
+                self.samplers.append(None)
+
+    def _setup_nested_meshes(self):
+        """
+        Check that the meshes are nested and map each coarse mesh's cells
+        onto the cells of the finest mesh
+        """
+        NL = [2*int(self.L/dLi) for dLi in self.dL]
+        dLf, NLf = self.dL[-1], NL[-1]
+        self.coarse_meshes, self.parent_index = [ ], [ ]
+        for dLi, NLi in zip(self.dL[:-1], NL[:-1]):
+            ratio = int(round(dLi/dLf))
+            if (not np.isclose(dLi, ratio*dLf) or ratio < 2
+                    or ratio & (ratio - 1) != 0):
+                raise ValueError("nested meshes need block sizes that are "
+                                 "powers of 2 times the finest, got {} and {}"
+                                 .format(dLi, dLf))
+            if NLi*ratio != NLf:
+                raise ValueError("nested meshes need the same extent, but "
+                                 "{} cells of {} != {} cells of {}"
+                                 .format(NLi, dLi, NLf, dLf))
+            self.coarse_meshes.append(baseline_tensor_mesh(NLi, dLi))
+            self.parent_index.append(nested_parent_index(NLf, ratio))
+
+    def _calc_gravity_mesh(self, i, *args):
+        """
+        Calculate the gravity signal on a single mesh
+        :param i: index of the mesh in self.dL
+        :param *args: arguments to pass to gfunc
+        :return: np.array of gravity readings
+        """
+        mesh, sim = self.meshxfwd[i]
+        if self.samplers[i] is not None:
+            model = self.samplers[i](self.gfunc, *args)
+        else:
+            model = self.gfunc(mesh.gridCC, *args)
+        return sim.dpred(model)
 
     def _setup_calc_gravity(self, *args):
         """
@@ -333,46 +2049,135 @@ class RichardsonGravity:
         :param *args: arguments to pass to gfunc
         :return: (np.array of gravity readings, np.array of h values)
         """
-        # Set up the regression matrices
-        f, H = [ ], [ ]
-        for i in range(len(self.dL)):
-            dLi = self.dL[i]
-            mesh, sim = self.meshxfwd[i]
+        if self.nested:
+            return self._setup_calc_gravity_nested(*args)
+        # numpy releases the GIL for the heavy lifting in the voxelizations
+        # and the sensitivity products, so the meshes can run side by side
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._calc_gravity_mesh, i, *args)
+                       for i in range(len(self.dL))]
+            f = [future.result() for future in futures]
+        return f, list(self.dL)
+
+    def _setup_calc_gravity_nested(self, *args):
+        """
+        Same as _setup_calc_gravity, but for nested meshes:  each coarse
+        G column is the sum of the columns of the fine cells it contains,
+        so each coarse model can be spread onto the finest mesh and all
+        the models run through the finest G in a single product
+        :param *args: arguments to pass to gfunc
+        :return: (np.array of gravity readings, np.array of h values)
+        """
+        def voxelize(i):
+            mesh = self.meshxfwd[i][0]
             model = self.gfunc(mesh.gridCC, *args)
-            dpred = sim.dpred(model)
-            plot_gravity(self.survey, dpred)
-            f.append(dpred)
-            H.append(dLi)
-        return f, H
+            if i < len(self.parent_index):
+                model = model[self.parent_index[i]]
+            return model
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            models = list(pool.map(voxelize, range(len(self.dL))))
+        G = self.meshxfwd[-1][1].G
+        f = np.asarray(G @ np.array(models).T).T
+        return list(f), list(self.dL)
 
     def calc_gravity_powerlaw(self, *args):
         """
-        Calculate final gravity signal using Richardson extrapolation
+        Calculate final gravity signal using Richardson extrapolation; the
+        discretization-error covariance of the result (see
+        RichardsonExtrapolator.fit) is kept in self.f0_cov
         :param *args: arguments to pass to gfunc
         :return: np.array of gravity readings
         """
-        f, H = self._setup_calc_gravity(*args)
-        # The problem is a linear regression in the form
-        # f = f0 + c*h^alpha = c0*1 + c1*h^alpha = H*C
+        f = self._setup_calc_gravity(*args)[0]
         self.f = f = np.array(f)
-        H = np.array([np.ones(len(H)), H]).T
-        # Step through a bunch of alphas and find the lowest residuals
-        # This is basically maximum likelihood
-        alpha_min, C_min, rms_min = None, None, np.inf
-        for alpha in 10**np.linspace(-0.5, 0.5, 11):
-            C, res, rank, s = np.linalg.lstsq(H**alpha, f, rcond=None)
-            rms = np.sqrt(np.sum(res/C[0]**2)/np.prod(f.shape))
-            print("alpha, rms = {:.2f}, {:.2g}".format(alpha, rms))
-            if rms < rms_min:
-                alpha_min, C_min = alpha, C
-
-        # Extract f0 from C
-        f0, ch = C_min
+        f0, self.f0_cov, self.alpha = self.extrapolator.fit(f)
         return f0
 
     def calc_gravity(self, *args):
         return self.calc_gravity_powerlaw(*args)
 
+    def _voxelize_batch(self, i, P, *args):
+        """
+        Voxelize a stack of parameter vectors on a single mesh
+        :param i: index of the mesh in self.dL
+        :param P: np.array of shape (M, Npars) of parameter vectors
+        :param *args: arguments to pass to gfunc_batch before P
+        :return: np.array of shape (M, mesh.nC) of rock properties
+        """
+        mesh = self.meshxfwd[i][0]
+        if self.samplers[i] is not None:
+            sampler = self.samplers[i]
+            return sampler.average(self.gfunc_batch(sampler.points, *args, P))
+        return self.gfunc_batch(mesh.gridCC, *args, P)
+
+    def calc_gravity_batch(self, P, *args, chunk=64):
+        """
+        Richardson-extrapolated gravity for a stack of parameter vectors,
+        with one matrix-matrix product per mesh (or, for nested meshes, a
+        single one) per chunk; the discretization-error variances and the
+        best alpha of every model are kept in self.f0_cov and self.alpha
+        :param P: np.array of shape (M, Npars) of parameter vectors
+        :param *args: arguments to pass to gfunc_batch before P
+        :param chunk: number of parameter vectors to process at once
+        :return: np.array of shape (M, Nsensors) of gravity readings
+        """
+        if self.gfunc_batch is None:
+            raise ValueError("calc_gravity_batch() needs gfunc_batch")
+        P = np.atleast_2d(P)
+        f0, cov, alpha = [ ], [ ], [ ]
+        for j in range(0, len(P), chunk):
+            Pj = P[j:j+chunk]
+            models = [self._voxelize_batch(i, Pj, *args)
+                      for i in range(len(self.dL))]
+            if self.nested:
+                # Spread every coarse model onto the finest mesh, then run
+                # all of them through its G together
+                for i, idx in enumerate(self.parent_index):
+                    models[i] = models[i][:,idx]
+                fwd = self.meshxfwd[-1][1]
+                f = dpred_batch(fwd, np.concatenate(models), chunk)
+                f = f.reshape(len(self.dL), len(Pj), -1)
+            else:
+                f = np.array([dpred_batch(self.meshxfwd[i][1], models[i],
+                                          chunk)
+                              for i in range(len(self.dL))])
+            fj, covj, alphaj = self.extrapolator.fit(f)
+            f0.append(fj)
+            cov.append(covj)
+            alpha.append(alphaj)
+        self.f0_cov, self.alpha = np.concatenate(cov), np.concatenate(alpha)
+        return np.concatenate(f0)
+
+    def calc_gravity_coarse(self, *args):
+        """
+        Gravity signal on the coarsest mesh only, as a cheap approximation
+        to calc_gravity() (e.g. to screen MCMC proposals); nested meshes
+        use the coarse sensitivities in coarse_G, built on the first call
+        :param *args: arguments to pass to gfunc
+        :return: np.array of gravity readings
+        """
+        if not self.nested:
+            return self._calc_gravity_mesh(0, *args)
+        mesh = self.meshxfwd[0][0]
+        return self.coarse_G @ self.gfunc(mesh.gridCC, *args)
+
+    @property
+    def coarse_G(self):
+        """
+        Sensitivities of the coarsest nested mesh, summed once from the
+        columns of the finest G over the fine cells of each coarse cell, so
+        that calc_gravity_coarse() costs a coarse product, not a fine one
+        :return: np.array of shape (Nsensors, Ncoarse)
+        """
+        if self._coarse_G is None:
+            G = self.meshxfwd[-1][1].G
+            parent = self.parent_index[0]
+            P = scipy.sparse.csr_matrix(
+                (np.ones(len(parent)), (parent, np.arange(len(parent)))),
+                shape=(self.meshxfwd[0][0].nC, len(parent)))
+            self._coarse_G = np.asarray(P @ np.asarray(G).T).T
+        return self._coarse_G
+
 
 def main():
     """
@@ -403,6 +2208,48 @@ def main():
     plot_gravity(survey, res)
     plot_gravity(survey, resR)
 
+def compare_fft_gravity():
+    """
+    Check the FFT forward model against the integral-equation forward model
+    and against the analytic gravity of a sphere
+    :return: nothing
+    """
+    N, delta, R, rho, Ng = 40, 1.0, 10.0, 1000.0, 20
+    mesh = baseline_tensor_mesh(N, delta)
+    survey = survey_gridded_locations(N, N, Ng, Ng, 0.5*N*delta + 1.0)
+    model = gfunc_uniform_sphere(mesh.gridCC, R, rho)
+    fwd_fft = profile_timer(FFTGravity, mesh, survey)
+    fwd_int = profile_timer(build_forward_model, mesh, survey)
+    grav_fft = profile_timer(fwd_fft.dpred, model)
+    grav_int = profile_timer(fwd_int.dpred, model)
+    grav0 = analytic_forward_gravity_sphere(survey, R, rho)[2]
+    for label, grav in [("integral", grav_int), ("analytic", grav0)]:
+        res = (grav_fft - grav)/grav
+        print("mu, std resids (fft vs {}) = {:.3g} {:.3g}"
+              .format(label, np.mean(res), np.std(res)))
+    plot_gravity(survey, grav_fft - grav_int)
+
+
+def compare_compressed_gravity():
+    """
+    Check the compressed forward model against the dense one, and report
+    how much it saves and how its error compares to the guaranteed bound
+    :return: nothing
+    """
+    N, delta, R, rho, Ng = 32, 1.0, 10.0, 1000.0, 20
+    mesh = baseline_tensor_mesh(N, delta)
+    survey = survey_gridded_locations(N, N, Ng, Ng, 0.5*N*delta + 1.0)
+    model = gfunc_uniform_sphere(mesh.gridCC, R, rho)
+    fwd_cmp = profile_timer(CompressedGravity, mesh, survey, tol=1e-4,
+                            chunk_size=64, block_cells=512)
+    fwd_int = profile_timer(build_forward_model, mesh, survey)
+    grav_cmp = profile_timer(fwd_cmp.dpred, model)
+    grav_int = profile_timer(fwd_int.dpred, model)
+    print("compression ratio = {:.2f}".format(fwd_cmp.compression_ratio))
+    print("max |error|, bound = {:.3g}, {:.3g} mGal".format(
+        np.max(np.abs(grav_cmp - grav_int)),
+        np.max(fwd_cmp.dpred_error_bound(model))))
+    plot_gravity(survey, grav_cmp - grav_int)
 
 if __name__ == '__main__':
     main()
@@ -9,9 +9,17 @@ compositions of events that introduce implicit interfaces into a volume.
 
 import numpy as np
 import scipy.special
+import threading
+import weakref
+from collections import OrderedDict
 import matplotlib.pyplot as plt
+from discretize import TensorMesh
 from blockworlds import profile_timer, DiscreteGravity
 from blockworlds import baseline_tensor_mesh, survey_gridded_locations
+from blockworlds import baseline_octree_mesh, refine_octree_gfunc
+from blockworlds import padded_tensor_mesh, sensitivity_cache_key
+from blockworlds import reuse_sensitivities, DenseGravity
+from blockworlds import relative_gravity_loglike
 
 
 # ============================================================================
@@ -22,10 +30,50 @@ def l2norm(v):
     return np.sqrt(np.sum(np.atleast_2d(v**2), axis=1))
 
 def sph2xyz(th, ph):
-    thr, phr = np.radians(th), np.radians(ph)
+    # Written out rather than with np.radians so complex steps go through
+    thr, phr = th*(np.pi/180), ph*(np.pi/180)
     n = [np.cos(thr)*np.cos(phr), np.cos(thr)*np.sin(phr), np.sin(thr)]
     return np.array(n)
 
+def fault_frame(x0, y0, nth, nph, s):
+    """
+    Geometry of a planar fault; works for scalar parameters or for arrays
+    of parameters, in which case the vectors run along the last axis
+    :param x0, y0: Cartesian coordinates of a point on the fault at z = 0
+    :param nth, nph: elevation and azimuth of the fault normal (degrees)
+    :param s: slip along the fault (m)
+    :return: point r0 on the fault, unit normal n, and slip vector rdelt
+    """
+    x0, y0, s = np.asarray(x0), np.asarray(y0), np.asarray(s)
+    r0 = np.stack([x0, y0, np.zeros(x0.shape)], axis=-1)
+    n = np.moveaxis(sph2xyz(nth, nph), 0, -1)
+    # Geology in +n direction slips relative to the background
+    # Slip is vertical (+z direction) in units of meters along the fault
+    v = np.cross(np.cross([0, 0, 1], n), n)
+    vnorm = np.sqrt(np.sum(v**2, axis=-1))[...,np.newaxis]
+    rdelt = s[...,np.newaxis] * v/vnorm
+    return r0, n, rdelt
+
+def fold_frame(nth, nph, pitch):
+    """
+    Geometry of a sinusoidal fold; works for scalar parameters or for
+    arrays of parameters, in which case the vectors run along the last axis
+    :param nth, nph: elevation and azimuth of the compression axis (degrees)
+    :param pitch: pitch of the displacement relative to +z (degrees)
+    :return: fold axis n and direction v of the fold displacement
+    """
+    n = np.moveaxis(sph2xyz(nth, nph), 0, -1)
+    rpsi = (np.asarray(pitch)*(np.pi/180))[...,np.newaxis]
+    # Define an orthonormal frame for the fold
+    # n = fold axis, v0 = horizontal, v1 = vertical
+    v0 = np.cross(n, [0, 0, 1])
+    v0 /= np.sqrt(np.sum(v0**2, axis=-1))[...,np.newaxis]
+    v1 = np.cross(v0, n)
+    v1 /= np.sqrt(np.sum(v1**2, axis=-1))[...,np.newaxis]
+    # Define perturbation of positions
+    v = np.sin(rpsi)*v0 + np.cos(rpsi)*v1
+    return n, v
+
 def soft_if_then(d, y0, y1, h):
     """
     :param y0: limiting value on negative side of d
@@ -45,6 +93,254 @@ def soft_if_then(d, y0, y1, h):
     # result = result*(y1-y0) + y0                  # goes from y0 to y1
     return result
 
+def soft_if_then_grad(d, h):
+    """
+    Partial derivatives of soft_if_then(d, y0, y1, h), which is linear in
+    y0 and y1:  soft_if_then(d, y0, y1, h) = w0*y0 + w1*y1
+    :param d: np.array of shape (N, ) of signed distances
+    :param h: transition scale
+    :return: w0 and w1, and wd such that the derivative w.r.t. d is
+        wd*(y1 - y0), all np.arrays of shape (N, )
+    """
+    band = np.abs(d) <= 0.5*h
+    w0 = np.where(band, 0.5 - d/h, d < 0)
+    w1 = np.where(band, 0.5 + d/h, d > 0)
+    return w0, w1, band/h
+
+def complex_step_jacobian(f, pars, eps=1e-30):
+    """
+    Exact derivatives of a function of a few scalar parameters, by the
+    complex step method (f must be analytic and handle complex arguments,
+    as sph2xyz, fault_frame and fold_frame do)
+    :param f: function of len(pars) scalars returning a tuple of np.arrays
+    :param pars: values of the parameters
+    :return: list of np.arrays, one per output of f, each of shape
+        (len(pars), ) + output.shape
+    """
+    pars = np.asarray(pars, dtype=float)
+    derivs = [ ]
+    for k in range(len(pars)):
+        p = pars.astype(complex)
+        p[k] += 1j*eps
+        derivs.append([np.imag(o)/eps for o in f(*p)])
+    return [np.array(d) for d in zip(*derivs)]
+
+def soft_if_then_pv(d, y0, y1, aa, n):
+    """
+    Antialiased version of soft_if_then:  each point is the center of a
+    voxel, and the result is the volume-weighted average of y0 and y1 over
+    the parts of the voxel on either side of the (linearized) interface
+    :param d: np.array of shape (N, ) of signed distances
+    :param y0: limiting value on negative side of d
+    :param y1: limiting value on positive side of d
+    :param aa: AntialiasState instance for the points
+    :param n: normal to the interface in the event's own coordinates
+    :return: np.array of shape (N, )
+    """
+    f0 = aa.fraction(d, aa.gradient(n))
+    return f0*y0 + (1-f0)*y1
+
+def soft_if_then_masked(d, f0, f1, h, aa=None, n=None):
+    """
+    Narrow-band version of soft_if_then, for when y0 and y1 are expensive:
+    each branch is only evaluated where it contributes to the result, so
+    both branches only ever see the points in the transition band |d| < h/2
+    :param d: np.array of shape (N, ) of signed distances
+    :param f0: function mapping a boolean mask of shape (N, ) to the values
+        of y0 at the points selected by the mask
+    :param f1: same as f0, but for y1
+    :param h: transition scale
+    :param aa: optional AntialiasState instance; if given, the transition
+        band is the set of voxels cut by the interface, and the result is
+        that of soft_if_then_pv(d, y0, y1, aa, n)
+    :param n: normal to the interface in the event's own coordinates
+    :return: np.array of shape (N, ), equal to soft_if_then(d, y0, y1, h)
+        up to roundoff:  the blend is the same, but the branches only see
+        subsets of the points, and vectorized operations on them (such as
+        the BLAS dot products in interface()) may round differently in
+        the last bit, so results can differ by ~1e-15 relative
+    """
+    if aa is None:
+        halfwidth = 0.5*h
+    else:
+        g = aa.gradient(n)
+        halfwidth = aa.halfwidth(g)
+    need0, need1 = (d <= halfwidth), (d >= -halfwidth)
+    band = need0 & need1
+    result = np.zeros(d.shape)
+    if np.any(need0):
+        result[need0] = f0(need0)
+    y0 = result[band]
+    if np.any(need1):
+        result[need1] = f1(need1)
+    if not np.any(band):
+        return result
+    if aa is None:
+        result[band] = soft_if_then(d[band], y0, result[band], h)
+    else:
+        fb = aa.fraction(d[band], g[band])
+        result[band] = fb*y0 + (1-fb)*result[band]
+    return result
+
+class WarpCache:
+    """
+    Small LRU cache of the coordinates an event passes down to the event
+    before it.  Entries are keyed on the event's own parameters and on the
+    identity of the input points, so when only an earlier event changes,
+    the warped points (being the same objects as last time) hit the caches
+    of every event below as well.  Input arrays must not be modified in
+    place once they've been passed to rockprops.  The cache is bounded by
+    both its number of entries and the bytes it holds, and is safe to share
+    between threads (e.g. the meshes of RichardsonGravity).
+    """
+
+    def __init__(self, maxsize=16, maxbytes=2**27):
+        """
+        :param maxsize: maximum number of entries to keep
+        :param maxbytes: maximum total size of the cached arrays in bytes;
+            results larger than this are never cached
+        """
+        self.maxsize, self.maxbytes = maxsize, maxbytes
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks and weak references don't pickle; start copies out empty
+        return dict(maxsize=self.maxsize, maxbytes=self.maxbytes)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def _nbytes(value):
+        if isinstance(value, tuple):
+            return sum(np.asarray(v).nbytes for v in value)
+        return np.asarray(value).nbytes
+
+    def get(self, key, r, compute):
+        """
+        :param key: hashable key describing the transform (event parameters)
+        :param r: np.array of input points
+        :param compute: function of no arguments returning the transform
+            of r, called on a cache miss
+        :return: the cached or newly computed transform of r
+        """
+        key = (key, id(r))
+        with self._lock:
+            entry = self._entries.get(key)
+            # Entries only hold weak references to their inputs, so as not
+            # to keep them alive; a dead or different referent means that
+            # id(r) has been reused by a new array
+            if entry is not None and entry[0]() is r:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Compute outside the lock, so that threads don't wait on each other
+        value = compute()
+        nbytes = self._nbytes(value)
+        if nbytes > self.maxbytes:
+            return value
+        with self._lock:
+            # Entries whose inputs are gone can never be hit again
+            dead = [k for k, e in self._entries.items() if e[0]() is None]
+            for k in dead + [key]:
+                if k in self._entries:
+                    self.nbytes -= self._entries.pop(k)[2]
+            self._entries[key] = (weakref.ref(r), value, nbytes)
+            self.nbytes += nbytes
+            while (len(self._entries) > self.maxsize
+                   or self.nbytes > self.maxbytes):
+                self.nbytes -= self._entries.popitem(last=False)[1][2]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# ============================================================================
+#             Partial-volume antialiasing of voxelized rock properties
+# ============================================================================
+
+class AntialiasState:
+    """
+    Bookkeeping that lets events voxelize their interfaces exactly:  each
+    evaluation point is the center of a box-shaped voxel, and carries the
+    Jacobian of the map from mesh coordinates to the coordinates of the
+    event currently being evaluated (which folds distort).  An interface
+    with signed distance d and normal n in event coordinates then cuts the
+    voxel along a plane, whose partial volume comes from a model like those
+    in antialias.py
+    """
+
+    def __init__(self, pvfunc, cell_widths, jac=None):
+        """
+        :param pvfunc: partial volume model pvfunc(r0, n) giving the volume
+            of the unit cube centered on the origin on the side
+            np.dot(r-r0, n) < 0, e.g. antialias.partial_volume_exact or a
+            antialias.TabulatedAntialiasing instance
+        :param cell_widths: np.array of shape (N, 3) of voxel widths
+        :param jac: np.array of shape (N, 3, 3) of Jacobians of the event
+            coordinates w.r.t. mesh coordinates (None = identity)
+        """
+        self.pvfunc = pvfunc
+        self.cell_widths = cell_widths
+        self.jac = jac
+
+    def subset(self, idx):
+        """
+        :param idx: index or boolean mask selecting a subset of the points
+        :return: AntialiasState instance for the selected points
+        """
+        jac = None if self.jac is None else self.jac[idx]
+        return AntialiasState(self.pvfunc, self.cell_widths[idx], jac)
+
+    def warp(self, J):
+        """
+        :param J: np.array of shape (N, 3, 3) of Jacobians of a deformation
+            that maps the current event coordinates to those of the next
+            event back in time
+        :return: AntialiasState instance for the deformed coordinates
+        """
+        jac = J if self.jac is None else np.einsum('nij,njk->nik', J, self.jac)
+        return AntialiasState(self.pvfunc, self.cell_widths, jac)
+
+    def gradient(self, n):
+        """
+        :param n: gradient of a signed distance in event coordinates, as an
+            np.array of shape (3, ) or (N, 3)
+        :return: np.array of shape (N, 3) with the same gradient w.r.t.
+            coordinates that run from -1/2 to +1/2 across each voxel
+        """
+        n = np.broadcast_to(n, self.cell_widths.shape)
+        if self.jac is not None:
+            n = np.einsum('nij,ni->nj', self.jac, n)
+        return n * self.cell_widths
+
+    def halfwidth(self, g):
+        """
+        :param g: np.array of shape (N, 3) of gradients from gradient()
+        :return: np.array of shape (N, ) of the largest |d| for which the
+            interface still cuts the voxel
+        """
+        return 0.5*np.sum(np.abs(g), axis=1)
+
+    def fraction(self, d, g):
+        """
+        :param d: np.array of shape (N, ) of signed distances at the voxel
+            centers
+        :param g: np.array of shape (N, 3) of gradients from gradient()
+        :return: np.array of shape (N, ) of the fraction of each voxel on
+            the negative side of the interface
+        """
+        gnorm = l2norm(g)
+        nhat = g/gnorm[:,np.newaxis]
+        return self.pvfunc(-(d/gnorm)[:,np.newaxis]*nhat, nhat)
+
 # ============================================================================
 #                 Initial implementation of events as GeoFuncs
 # ============================================================================
@@ -91,9 +387,9 @@ class PlanarFault(GeoFunc):
         r0, n, s = p[-7:-4], p[-4:-1], p[-1]
         v = np.cross(np.cross([0, 0, 1], n), n)
         rdelt = s * v/l2norm(v)
-        g0 = self.base_gfunc(r, h, p[:-7])
-        g1 = self.base_gfunc(r + rdelt, h, p[:-7])
-        return soft_if_then(np.dot(r-r0, n), g0, g1, h)
+        g0 = lambda idx: self.base_gfunc(r[idx], h, p[:-7])
+        g1 = lambda idx: self.base_gfunc(r[idx] + rdelt, h, p[:-7])
+        return soft_if_then_masked(np.dot(r-r0, n), g0, g1, h)
 
 # ============================================================================
 #   Some machinery around probability distributions (not to reinvent pymc3!)
@@ -109,10 +405,24 @@ class LogPrior:
         for kw in kwargs:
             setattr(self, kw, kwargs[kw])
 
-    def __call__(self):
+    def __call__(self, *x):
+        """
+        :param x: Ndim arguments, each a float or an np.array of shape (M, )
+        :return: log density, a float or an np.array of shape (M, )
+        """
         pass
 
+    def grad(self, *x):
+        """
+        :return: np.array of shape (Ndim, ) of derivatives of the log
+            density w.r.t. each of its arguments
+        """
+        raise NotImplementedError
+
     def sample(self, size=1):
+        """
+        :return: np.array of shape (Ndim, size) of random draws
+        """
         pass
 
 
@@ -124,12 +434,18 @@ class UniGaussianDist(LogPrior):
     _pars = ['mean', 'std']
     Ndim = 1
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lognorm = -0.5*np.log(2*np.pi*self.std**2)
+
     def __call__(self, x):
-        lognorm = -0.5*np.log(2*np.pi*self.std**2)
-        return -0.5*((x-self.mean)/self.std)**2 + lognorm
+        return -0.5*((x-self.mean)/self.std)**2 + self.lognorm
+
+    def grad(self, x):
+        return np.array([-(x-self.mean)/self.std**2])
 
     def sample(self, size=1):
-        return np.random.normal(self.mean, self.std, size=1)
+        return np.random.normal(self.mean, self.std, size=(1, size))
 
 
 class UniformDist(LogPrior):
@@ -140,13 +456,21 @@ class UniformDist(LogPrior):
     _pars = ['mean', 'width']
     Ndim = 1
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lognorm = -np.log(self.width)
+
     def __call__(self, x):
-        lognorm = -np.log(self.width)
-        return -np.inf if np.abs(x-self.mean) > 0.5*self.width else lognorm
+        outside = np.abs(x-self.mean) > 0.5*self.width
+        return np.where(outside, -np.inf, self.lognorm)[()]
+
+    def grad(self, x):
+        return np.zeros(1)
 
     def sample(self, size=1):
         hw = 0.5*self.width
-        return np.random.uniform(self.mean - hw, self.mean + hw, size=size)
+        return np.random.uniform(self.mean - hw, self.mean + hw,
+                                 size=(1, size))
 
 
 class vMFDist(LogPrior):
@@ -165,14 +489,19 @@ class vMFDist(LogPrior):
         self.v0 /= np.sqrt(np.dot(self.v0, self.v0))
         self.v1 = np.cross(self.v0, self.gamma)
         self.v1 /= np.sqrt(np.dot(self.v1, self.v1))
+        # Use exponentially scaled Bessel function to avoid divide by zero
+        pm = 0.5*3 - 1
+        logbess = np.log(scipy.special.ive(pm, self.kappa)) + self.kappa
+        self.lognorm = (pm*np.log(self.kappa)
+                        - (pm+1)*np.log(2*np.pi) - logbess)
 
     def __call__(self, th, ph):
-        pm = 0.5*3 - 1
         x = sph2xyz(th, ph)
-        # Use exponentially scaled Bessel function to avoid divide by zero
-        logbess = np.log(scipy.special.ive(pm, self.kappa)) + self.kappa
-        lognorm = pm*np.log(self.kappa) - (pm+1)*np.log(2*np.pi) - logbess
-        return lognorm + self.kappa*np.dot(self.gamma, x)
+        return self.lognorm + self.kappa*np.dot(self.gamma, x)
+
+    def grad(self, th, ph):
+        dx = complex_step_jacobian(lambda t, p: (sph2xyz(t, p), ), [th, ph])
+        return self.kappa*np.dot(dx[0], self.gamma)
 
     def sample(self, size=1):
         """
@@ -187,11 +516,12 @@ class vMFDist(LogPrior):
                             * np.exp(-2*self.kappa)))/self.kappa
         V = 2 * np.pi * np.random.uniform(size=size)
         # Construct spherical coordinates of deviate
-        U = np.sqrt(1 - W*W)
-        vrand = W*self.gamma + U*np.cos(V)*self.v0 + U*np.sin(V)*self.v1
-        thrand = np.degrees(np.arcsin(vrand[2]))
-        phrand = np.degrees(np.arctan2(vrand[1], vrand[0]))
-        return thrand, phrand
+        U = np.sqrt(1 - W*W)[:, None]
+        vrand = (W[:, None]*self.gamma + U*np.cos(V)[:, None]*self.v0
+                 + U*np.sin(V)[:, None]*self.v1)
+        thrand = np.degrees(np.arcsin(np.clip(vrand[:, 2], -1, 1)))
+        phrand = np.degrees(np.arctan2(vrand[:, 1], vrand[:, 0]))
+        return np.array([thrand, phrand])
 
 
 # ============================================================================
@@ -203,6 +533,8 @@ class GeoEvent:
 
     _pars = [ ]
     _priors = [ ]
+    warp_cache_size = 16
+    warp_cache_bytes = 2**27
 
     def __init__(self, priors, **kwargs):
         # Check whether the priors are correctly specified
@@ -221,11 +553,16 @@ class GeoEvent:
         if sorted(ppars) != sorted(self._pars):
             raise ValueError("every variable of event {} must have exactly "
                              "one prior".format(self.__class__.__name__))
+        # Column indices of each prior's variables in the serialized vector
+        self._prior_idx = [([self._pars.index(parname) for parname in p[:-1]],
+                            p[-1]) for p in self._priors]
         # Other housekeeping
         self.set_to_prior_draw()
         self.set_kw_attrs(**kwargs)
         self.previous_event = None
         self.Npars = len(self._pars)
+        self.warp_cache = WarpCache(self.warp_cache_size,
+                                    self.warp_cache_bytes)
 
     def serialize(self):
         return np.array([getattr(self, attr) for attr in self._pars])
@@ -245,23 +582,97 @@ class GeoEvent:
     def set_previous_event(self, event):
         self.previous_event = event
 
-    def rockprops(self, r, h):
+    def warp_key(self, h):
+        """
+        :return: hashable key for this event's coordinate transforms
+        """
+        return (tuple(self.serialize()), h)
+
+    def rockprops(self, r, h, aa=None):
+        """
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :param aa: optional AntialiasState instance for the points, to
+            voxelize interfaces by partial volumes instead of smoothing
+        :return: np.array of shape (N, ) of rock properties
+        """
+        raise NotImplementedError
+
+    def interface(self, r):
+        """
+        :param r: np.array of shape (N, 3) of positions
+        :return: signed distance of each position from the interface this
+            event introduces, and the unit normal to the interface
+        """
+        raise NotImplementedError
+
+    def rockprops_and_grad(self, r, h):
+        """
+        Rock properties and their derivatives, by forward-mode
+        differentiation down the event chain (without antialiasing)
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :return: tuple of np.arrays with the rock properties (shape (N, )),
+            their gradients w.r.t. r (shape (N, 3)), and their Jacobian
+            w.r.t. the serialized parameters of this event and all the
+            events before it, this event's last (shape (N, Npars))
+        """
+        raise NotImplementedError
+
+    def rockprops_batch(self, r, h, P, m):
+        """
+        Rock properties for many parameter vectors at once
+        :param r: np.array of shape (K, 3) of positions
+        :param h: transition scale
+        :param P: np.array of shape (M, Npars) of serialized parameters for
+            this event and all the events before it, this event's last
+        :param m: np.array of shape (K, ) with the row of P for each point
+        :return: np.array of shape (K, ) of rock properties
+        """
+        raise NotImplementedError
+
+    def compile_ops(self):
+        """
+        :return: list of operations (see CompiledHistory) that apply this
+            event to the points flowing down from the events after it
+        """
         raise NotImplementedError
 
     def log_prior(self):
-        lP = 0.0
-        for p in self._priors:
-            parnames, dist = p[:-1], p[-1]
-            pars = [getattr(self, parname) for parname in parnames]
-            lP += dist(*pars)
+        return self.log_prior_batch(self.serialize()[None, :])[0]
+
+    def log_prior_batch(self, P):
+        """
+        :param P: np.array of shape (M, Npars) of serialized parameters
+        :return: np.array of shape (M, ) of log prior densities
+        """
+        lP = np.zeros(len(P))
+        for idx, dist in self._prior_idx:
+            lP += dist(*P[:, idx].T)
         return lP
 
+    def log_prior_grad(self):
+        """
+        :return: np.array of shape (Npars, ) of derivatives of log_prior()
+            w.r.t. this event's serialized parameters
+        """
+        pvec, grad = self.serialize(), np.zeros(len(self._pars))
+        for idx, dist in self._prior_idx:
+            grad[idx] = dist.grad(*pvec[idx])
+        return grad
+
+    def sample_prior(self, M):
+        """
+        :param M: number of draws
+        :return: np.array of shape (M, Npars) of serialized parameters
+        """
+        P = np.zeros((M, len(self._pars)))
+        for idx, dist in self._prior_idx:
+            P[:, idx] = dist.sample(size=M).T
+        return P
+
     def set_to_prior_draw(self):
-        for p in self._priors:
-            parnames, dist = p[:-1], p[-1]
-            vals = dist.sample(size=1)
-            for parname, val in zip(parnames, vals):
-                setattr(self, parname, val)
+        self.deserialize(*self.sample_prior(1)[0])
 
     def __str__(self):
         np = zip(self._pars, self.serialize())
@@ -269,76 +680,247 @@ class GeoEvent:
         return "{}({})".format(self.__class__.__name__, parstr)
 
 
+def _npars_before(event):
+    """
+    :return: total number of parameters of the events before this one
+    """
+    n, event = 0, event.previous_event
+    while event is not None:
+        n, event = n + event.Npars, event.previous_event
+    return n
+
+
 class BasementEvent(GeoEvent):
 
     _pars = ['density']
 
-    def rockprops(self, r, h):
+    def rockprops(self, r, h, aa=None):
         return self.density * np.ones(shape=r.shape[:-1])
 
+    def rockprops_and_grad(self, r, h):
+        N = len(r)
+        return self.density*np.ones(N), np.zeros((N, 3)), np.ones((N, 1))
+
+    def rockprops_batch(self, r, h, P, m):
+        return P[m,-1]
+
+    def compile_ops(self):
+        return [_BasementOp(self)]
+
 
 class StratLayerEvent(GeoEvent):
 
     _pars = ['thickness', 'density']
 
-    def rockprops(self, r, h):
+    def interface(self, r):
+        return r[:,2] + self.thickness, np.array([0.0, 0.0, 1.0])
+
+    def rockprops(self, r, h, aa=None):
         assert(isinstance(self.previous_event, GeoEvent))
-        rp = r + np.array([0, 0, self.thickness])
+        translate = lambda: r + np.array([0, 0, self.thickness])
+        if aa is None:
+            rp = self.warp_cache.get(self.thickness, r, translate)
+        else:
+            rp = translate()
         rho_up = self.density*np.ones(shape=r.shape[:-1])
-        rho_down = self.previous_event.rockprops(rp, h)
+        rho_down = self.previous_event.rockprops(rp, h, aa)
+        d, n = self.interface(r)
+        if aa is None:
+            return soft_if_then(d, rho_down, rho_up, h)
+        return soft_if_then_pv(d, rho_down, rho_up, aa, n)
+
+    def rockprops_and_grad(self, r, h):
+        assert(isinstance(self.previous_event, GeoEvent))
+        rp = r + np.array([0, 0, self.thickness])
+        y0, g0, J0 = self.previous_event.rockprops_and_grad(rp, h)
+        y1 = self.density*np.ones(len(r))
+        d, n = self.interface(r)
+        w0, w1, wd = soft_if_then_grad(d, h)
+        wd = wd*(y1 - y0)
+        grad_r = w0[:,np.newaxis]*g0
+        grad_r[:,2] += wd
+        J = np.zeros((len(r), J0.shape[1] + 2))
+        J[:,:-2] = w0[:,np.newaxis]*J0
+        J[:,-2] = w0*g0[:,2] + wd
+        J[:,-1] = w1
+        return w0*y0 + w1*y1, grad_r, J
+
+    def rockprops_batch(self, r, h, P, m):
+        assert(isinstance(self.previous_event, GeoEvent))
+        rp = r.copy()
+        rp[:,2] += P[m,-2]
+        rho_up = P[m,-1]
+        rho_down = self.previous_event.rockprops_batch(rp, h, P[:,:-2], m)
         return soft_if_then(rp[:,2], rho_down, rho_up, h)
 
+    def compile_ops(self):
+        return [_TranslateOp(self), _LayerOp(self)]
+
 
 class PlanarFaultEvent(GeoEvent):
 
     _pars = ['x0', 'y0', 'nth', 'nph', 's']
 
-    def rockprops(self, r, h):
-        assert(isinstance(self.previous_event, GeoEvent))
+    def geometry(self):
+        """
+        :return: point r0 on the fault, unit normal n, and slip vector rdelt
+        """
         # Point on fault specified in Cartesian coordinates; assume z0 = 0
         # since we're probably just including geologically observed faults
-        r0 = np.array([self.x0, self.y0, 0.0])
         # Unit normal to fault ("polar vector") specified with
         # nth = elevation angle (+90 = +z, -90 = -z)
         # nph = azimuthal angle (runs counterclockwise, zero in +x direction)
-        n = sph2xyz(self.nth, self.nph)
-        # Geology in +n direction slips relative to the background
-        # Slip is vertical (+z direction) in units of meters along the fault
-        v = np.cross(np.cross([0, 0, 1], n), n)
-        rdelt = self.s * v/l2norm(v)
-        g0 = self.previous_event.rockprops(r, h)
-        g1 = self.previous_event.rockprops(r + rdelt, h)
-        return soft_if_then(np.dot(r-r0, n), g0, g1, h)
+        return fault_frame(self.x0, self.y0, self.nth, self.nph, self.s)
+
+    def interface(self, r):
+        r0, n, rdelt = self.geometry()
+        return np.dot(r-r0, n), n
+
+    def split(self, r, h):
+        """
+        :return: signed distances d of points r from the fault, and the
+            points on either side of it that soft_if_then_masked will need
+            (d <= h/2 unmoved, and d >= -h/2 moved by the slip vector)
+        """
+        r0, n, rdelt = self.geometry()
+        d, n = self.interface(r)
+        return d, r[d <= 0.5*h], r[d >= -0.5*h] + rdelt
+
+    def rockprops(self, r, h, aa=None):
+        assert(isinstance(self.previous_event, GeoEvent))
+        if aa is None:
+            d, r0, r1 = self.warp_cache.get(
+                self.warp_key(h), r, lambda: self.split(r, h))
+            g0 = lambda idx: self.previous_event.rockprops(r0, h)
+            g1 = lambda idx: self.previous_event.rockprops(r1, h)
+            return soft_if_then_masked(d, g0, g1, h)
+        r0, n, rdelt = self.geometry()
+        d, n = self.interface(r)
+        # Only points near the fault need the geology on both sides of it
+        g0 = lambda idx: self.previous_event.rockprops(
+            r[idx], h, aa.subset(idx))
+        g1 = lambda idx: self.previous_event.rockprops(
+            r[idx] + rdelt, h, aa.subset(idx))
+        return soft_if_then_masked(d, g0, g1, h, aa, n)
+
+    def rockprops_and_grad(self, r, h):
+        assert(isinstance(self.previous_event, GeoEvent))
+        r0, n, rdelt = self.geometry()
+        dr0, dn, drdelt = complex_step_jacobian(fault_frame, self.serialize())
+        d, n = self.interface(r)
+        # Only points near the fault need the geology on both sides of it
+        N, Nprev = len(r), _npars_before(self)
+        y, g, J = np.zeros((2, N)), np.zeros((2, N, 3)), np.zeros((2, N, Nprev))
+        for i, (need, shift) in enumerate([(d <= 0.5*h, 0.0),
+                                           (d >= -0.5*h, rdelt)]):
+            if np.any(need):
+                y[i,need], g[i,need], J[i,need] = \
+                    self.previous_event.rockprops_and_grad(r[need] + shift, h)
+        w0, w1, wd = soft_if_then_grad(d, h)
+        wd = wd*(y[1] - y[0])
+        grad_r = (w0[:,np.newaxis]*g[0] + w1[:,np.newaxis]*g[1]
+                  + wd[:,np.newaxis]*n)
+        Jall = np.zeros((N, Nprev + self.Npars))
+        Jall[:,:Nprev] = w0[:,np.newaxis]*J[0] + w1[:,np.newaxis]*J[1]
+        # The parameters move the fault plane, and the slip on its far side
+        dd = np.dot(r - r0, dn.T) - np.dot(dr0, n)
+        Jall[:,Nprev:] = (wd[:,np.newaxis]*dd
+                          + w1[:,np.newaxis]*np.dot(g[1], drdelt.T))
+        return w0*y[0] + w1*y[1], grad_r, Jall
+
+    def rockprops_batch(self, r, h, P, m):
+        assert(isinstance(self.previous_event, GeoEvent))
+        # Work out the geometry once per parameter vector, then per point
+        r0, n, rdelt = fault_frame(*P[:,-5:].T)
+        d = np.einsum('ij,ij->i', r, n[m]) - np.sum(r0*n, axis=1)[m]
+        Pprev = P[:,:-5]
+        g0 = lambda idx: self.previous_event.rockprops_batch(
+            r[idx], h, Pprev, m[idx])
+        g1 = lambda idx: self.previous_event.rockprops_batch(
+            r[idx] + rdelt[m[idx]], h, Pprev, m[idx])
+        return soft_if_then_masked(d, g0, g1, h)
+
+    def compile_ops(self):
+        return [_FaultSplitOp(self)]
 
 
 class FoldEvent(GeoEvent):
 
     _pars = ['nth', 'nph', 'pitch', 'phase', 'wavelength', 'amplitude']
 
-    def rockprops(self, r, h):
-        assert(isinstance(self.previous_event, GeoEvent))
+    def geometry(self):
+        """
+        :return: fold axis n and direction v of the fold displacement
+        """
         # nth, nph define compression axis of fold
         # psi defines pitch, relative to an axis aligned with +z
-        n = sph2xyz(self.nth, self.nph)
-        rpsi = np.radians(self.pitch)
+        return fold_frame(self.nth, self.nph, self.pitch)
+
+    def warp(self, r):
+        """
+        :return: points r displaced by the fold
+        """
+        n, v = self.geometry()
+        rphs = np.radians(self.phase)
+        sinarg = 2*np.pi*np.dot(r, n)/self.wavelength + rphs
+        return r + self.amplitude*np.sin(sinarg)[:,np.newaxis]*v
+
+    def rockprops(self, r, h, aa=None):
+        assert(isinstance(self.previous_event, GeoEvent))
+        if aa is None:
+            rp = self.warp_cache.get(self.warp_key(None), r,
+                                     lambda: self.warp(r))
+            return self.previous_event.rockprops(rp, h)
+        n, v = self.geometry()
         rphs = np.radians(self.phase)
-        # Define an orthonormal frame for the fold
-        # n = fold axis, v0 = horizontal, v1 = vertical
-        v0 = np.cross(n, [0, 0, 1])
-        v0 /= np.sqrt(np.dot(v0, v0))
-        v1 = np.cross(v0, n)
-        v1 /= np.sqrt(np.dot(v1, v1))
-        # Define perturbation of positions
-        v = np.sin(rpsi)*v0 + np.cos(rpsi)*v1
         sinarg = 2*np.pi*np.dot(r, n)/self.wavelength + rphs
         rdelt = self.amplitude*np.sin(sinarg)[:,np.newaxis]*v
-        return self.previous_event.rockprops(r + rdelt, h)
+        # Interfaces beneath the fold see its Jacobian I + dsin v n^T
+        dsin = 2*np.pi*self.amplitude*np.cos(sinarg)/self.wavelength
+        aa = aa.warp(np.eye(3) + dsin[:,np.newaxis,np.newaxis]*np.outer(v, n))
+        return self.previous_event.rockprops(r + rdelt, h, aa)
+
+    def rockprops_and_grad(self, r, h):
+        assert(isinstance(self.previous_event, GeoEvent))
+        n, v = self.geometry()
+        dn, dv = complex_step_jacobian(fold_frame, self.serialize()[:3])
+        rphs = np.radians(self.phase)
+        s = np.dot(r, n)
+        sinarg = 2*np.pi*s/self.wavelength + rphs
+        A, sinA, cosA = self.amplitude, np.sin(sinarg), np.cos(sinarg)
+        rp = r + A*sinA[:,np.newaxis]*v
+        y, g, Jprev = self.previous_event.rockprops_and_grad(rp, h)
+        gv = np.dot(g, v)
+        # Chain rule through the Jacobian I + dsin v n^T of the fold
+        dsin = 2*np.pi*A*cosA/self.wavelength
+        grad_r = g + (dsin*gv)[:,np.newaxis]*n
+        # Derivatives of the phase of the fold w.r.t. its own parameters
+        darg = np.zeros((len(r), self.Npars))
+        darg[:,:3] = 2*np.pi*np.dot(r, dn.T)/self.wavelength
+        darg[:,3] = np.pi/180
+        darg[:,4] = -2*np.pi*s/self.wavelength**2
+        Jown = (A*cosA*gv)[:,np.newaxis]*darg
+        Jown[:,:3] += (A*sinA)[:,np.newaxis]*np.dot(g, dv.T)
+        Jown[:,5] = sinA*gv
+        return y, grad_r, np.hstack([Jprev, Jown])
+
+    def rockprops_batch(self, r, h, P, m):
+        assert(isinstance(self.previous_event, GeoEvent))
+        n, v = fold_frame(*P[:,-6:-3].T)
+        rphs, wavelength, amplitude = np.radians(P[m,-3]), P[m,-2], P[m,-1]
+        sinarg = 2*np.pi*np.einsum('ij,ij->i', r, n[m])/wavelength + rphs
+        rdelt = (amplitude*np.sin(sinarg))[:,np.newaxis]*v[m]
+        return self.previous_event.rockprops_batch(r + rdelt, h, P[:,:-6], m)
+
+    def compile_ops(self):
+        return [_FoldWarpOp(self)]
 
 
 class GeoHistory:
 
     def __init__(self):
         self.event_list = [ ]
+        self.likelihood = None
 
     def add_event(self, event):
         if len(self.event_list) == 0:
@@ -356,17 +938,525 @@ class GeoHistory:
             psub, pvec = pvec[:event.Npars], pvec[event.Npars:]
             event.deserialize(*psub)
 
-    def rockprops(self, r, h):
-        return self.event_list[-1].rockprops(r, h)
+    def rockprops(self, r, h, pvfunc=None, cell_widths=None):
+        """
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :param pvfunc: optional partial volume model (see AntialiasState);
+            if given, each position is treated as the center of a voxel and
+            interfaces are voxelized by partial volumes instead of smoothing
+        :param cell_widths: voxel widths for antialiasing, as an np.array of
+            shape (N, 3) or anything that broadcasts to it (default = h)
+        :return: np.array of shape (N, ) of rock properties
+        """
+        aa = None
+        if pvfunc is not None:
+            if cell_widths is None:
+                cell_widths = h
+            cell_widths = np.broadcast_to(cell_widths, r.shape)
+            aa = AntialiasState(pvfunc, cell_widths)
+        return self.event_list[-1].rockprops(r, h, aa)
+
+    def rockprops_batch(self, r, h, P, chunk_points=2**22):
+        """
+        Evaluate rock properties at the same positions for many different
+        parameter vectors, vectorized across the parameter vectors
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :param P: np.array of shape (M, Npars) of serialized parameter vectors
+        :param chunk_points: rough maximum number of (position, parameter)
+            pairs to evaluate at once, to keep memory use bounded
+        :return: np.array of shape (M, N) of rock properties
+        """
+        P = np.atleast_2d(P)
+        Npars = np.sum([event.Npars for event in self.event_list])
+        if P.shape[1] != Npars:
+            raise ValueError("parameter vectors have length {}, but history "
+                             "has {} parameters".format(P.shape[1], Npars))
+        M, N = len(P), len(r)
+        Mchunk = max(1, chunk_points // max(N, 1))
+        result = np.zeros((M, N))
+        for i in range(0, M, Mchunk):
+            Pi = P[i:i+Mchunk]
+            Mi = len(Pi)
+            ri, mi = np.tile(r, (Mi, 1)), np.repeat(np.arange(Mi), N)
+            gi = self.event_list[-1].rockprops_batch(ri, h, Pi, mi)
+            result[i:i+Mi] = gi.reshape(Mi, N)
+        return result
+
+    @property
+    def density_index(self):
+        """
+        Positions in the serialized parameter vector of the density of each
+        rock unit, in the same order as the rows of unit_indicators()
+        """
+        idx, i0 = [ ], 0
+        for event in self.event_list:
+            if 'density' in event._pars:
+                idx.append(i0 + event._pars.index('density'))
+            i0 += event.Npars
+        return np.array(idx)
+
+    def unit_indicators(self, r, h):
+        """
+        Since rock properties are linear in the unit densities, they can be
+        written as rockprops(r, h) = np.dot(densities, unit_indicators(r, h))
+        with densities = serialize()[density_index]; for a fixed geometry,
+        a change in densities alone then never needs a new voxelization
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :return: np.array of shape (K, N) giving the fraction of each point
+            belonging to each of the K rock units
+        """
+        didx = self.density_index
+        P = np.tile(self.serialize(), (len(didx), 1))
+        P[:,didx] = np.eye(len(didx))
+        return self.rockprops_batch(r, h, P)
+
+    def compile(self):
+        """
+        Flatten the event chain into a linear list of operations that run
+        over preallocated work buffers; the operations read the events'
+        current parameters whenever they run, so the result only needs to
+        be recompiled if events are added to the history
+        :return: CompiledHistory instance
+        """
+        ops = [ ]
+        for event in self.event_list[::-1]:
+            ops.extend(event.compile_ops())
+        return CompiledHistory(ops)
+
+    def rockprops_and_grad(self, r, h):
+        """
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :return: rock properties (shape (N, )), their gradients w.r.t. r
+            (shape (N, 3)), and their Jacobian w.r.t. the serialized
+            parameters (shape (N, Npars))
+        """
+        return self.event_list[-1].rockprops_and_grad(r, h)
 
     def logprior(self):
         return np.sum([event.log_prior() for event in self.event_list])
 
+    def logprior_batch(self, P):
+        """
+        :param P: np.array of shape (M, Npars) of serialized parameters
+        :return: np.array of shape (M, ) of log prior densities
+        """
+        P = np.atleast_2d(P)
+        lP, i = np.zeros(len(P)), 0
+        for event in self.event_list:
+            lP += event.log_prior_batch(P[:, i:i+event.Npars])
+            i += event.Npars
+        return lP
+
+    def sample_prior(self, M):
+        """
+        :param M: number of draws
+        :return: np.array of shape (M, Npars) of serialized parameters
+            drawn independently from the prior
+        """
+        return np.hstack([event.sample_prior(M) for event in self.event_list])
+
+    def logprior_grad(self):
+        """
+        :return: np.array of derivatives of logprior() w.r.t. the
+            serialized parameters
+        """
+        return np.concatenate([event.log_prior_grad()
+                               for event in self.event_list])
+
+    def set_likelihood(self, fwdmodel, data, sigdata, h):
+        """
+        Set up the likelihood used by logpost_and_grad():  independent
+        Gaussian errors on gravity data, with the mean removed since only
+        relative gravity is measured
+        :param fwdmodel: DiscreteGravity instance to calculate the data;
+            must not antialias, since the gradients don't include partial
+            volumes
+        :param data: np.array of observed gravity readings
+        :param sigdata: standard deviation of the noise in the data
+        :param h: transition scale to pass to rockprops
+        """
+        if getattr(fwdmodel, 'antialias', None) is not None:
+            raise ValueError("logpost_and_grad() has no gradients of "
+                             "antialiased voxelizations; use a fwdmodel "
+                             "without antialias")
+        self.likelihood = (fwdmodel, data, sigdata, h)
+
+    def logpost_and_grad(self, pvec):
+        """
+        Log posterior density and its gradient, for gradient-based samplers;
+        the forward model is linear, so the likelihood gradient takes one
+        adjoint pass of the data residuals back onto the mesh
+        :param pvec: np.array of serialized parameters
+        :return: (log posterior density, np.array of its gradient w.r.t.
+            the serialized parameters)
+        """
+        if self.likelihood is None:
+            raise ValueError("call set_likelihood() first")
+        fwdmodel, data, sigdata, h = self.likelihood
+        self.deserialize(pvec)
+        lP = self.logprior()
+        if not np.isfinite(lP):
+            return -np.inf, np.zeros(len(pvec))
+        gridCC = fwdmodel.gridCC
+        if gridCC is None:
+            gridCC = fwdmodel.mesh.gridCC
+        sampler = getattr(fwdmodel, 'sampler', None)
+        if sampler is None:
+            rho, grad_r, J = self.rockprops_and_grad(gridCC, h)
+        else:
+            # Volume averages are linear, so average the Jacobian too
+            rho, grad_r, J = self.rockprops_and_grad(sampler.points, h)
+            rho, J = sampler.average(rho), sampler.average(J.T).T
+        fwdmodel.voxmodel = rho
+        fwdmodel.fwd_data = fwdmodel.dpred(rho)
+        lL = relative_gravity_loglike(fwdmodel.fwd_data, data, sigdata)
+        # The residuals (less their mean) are dlL/dpred
+        resids = fwdmodel.fwd_data - data
+        resids = resids - resids.mean()
+        rho_bar = fwdmodel.rmatvec(resids/sigdata**2)
+        return lP + lL, self.logprior_grad() - np.dot(rho_bar, J)
+
     def set_to_prior_draw(self):
         for event in self.event_list:
             event.set_to_prior_draw()
 
 
+# ============================================================================
+#           Compiled execution plans for evaluating a GeoHistory
+# ============================================================================
+
+# Since soft_if_then is linear in its limiting values, the rock property at
+# any point can be written as a weighted sum over the units it ends up in.
+# A compiled plan tracks a set of "items", each with a (warped) position,
+# the index of the output point it belongs to, the weight it still carries,
+# and the density it has accumulated so far.  Operations run from the most
+# recent event back to the basement:  warps move items in place, layers
+# deposit part of each item's weight into its accumulator, and faults split
+# the items in the transition band into two copies, one on each side.
+
+
+class PlanBuffers:
+    """
+    Work space for a CompiledHistory, reused between calls and only
+    reallocated when the number of items outgrows it
+    """
+
+    def __init__(self, N):
+        """
+        :param N: number of points to be evaluated
+        """
+        self.N = N
+        self.capacity = 0
+        self.point_index = np.arange(N)
+        self.grow(N + N//4 + 1)
+
+    def grow(self, capacity):
+        """
+        Reallocate the buffers, preserving their current contents
+        :param capacity: minimum number of items the buffers should hold
+        """
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2*self.capacity)
+        old = [getattr(self, attr, None) for attr in
+               ('r', 'w', 'acc', 'idx', 'd', 't', 'mask', 'shift')]
+        self.r = np.zeros((capacity, 3))
+        self.w = np.zeros(capacity)
+        self.acc = np.zeros(capacity)
+        self.idx = np.zeros(capacity, dtype=int)
+        self.d = np.zeros(capacity)
+        self.t = np.zeros(capacity)
+        self.mask = np.zeros(capacity, dtype=bool)
+        self.shift = np.zeros(capacity, dtype=bool)
+        new = [self.r, self.w, self.acc, self.idx,
+               self.d, self.t, self.mask, self.shift]
+        for a, b in zip(old, new):
+            if a is not None:
+                b[:len(a)] = a
+        self.capacity = capacity
+
+
+class _PlanOp:
+    """
+    One step of a CompiledHistory, bound to the event it came from
+    """
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, buf, n, h):
+        """
+        :param buf: PlanBuffers instance
+        :param n: number of live items in buf
+        :param h: transition scale
+        :return: number of live items in buf after this step
+        """
+        raise NotImplementedError
+
+
+class _TranslateOp(_PlanOp):
+    """
+    Shift items vertically by the thickness of a stratigraphic layer
+    """
+
+    def __call__(self, buf, n, h):
+        buf.r[:n,2] += self.event.thickness
+        return n
+
+
+class _LayerOp(_PlanOp):
+    """
+    Deposit the density of a layer into items above its base (z = 0)
+    """
+
+    def __call__(self, buf, n, h):
+        # t = fraction of each item's weight that belongs to this layer
+        t, w = buf.t[:n], buf.w[:n]
+        np.divide(buf.r[:n,2], h, out=t)
+        t += 0.5
+        np.clip(t, 0.0, 1.0, out=t)
+        np.multiply(w, t, out=buf.d[:n])
+        buf.d[:n] *= self.event.density
+        buf.acc[:n] += buf.d[:n]
+        np.subtract(1.0, t, out=t)
+        w *= t
+        return n
+
+
+class _FaultSplitOp(_PlanOp):
+    """
+    Slip items on the +n side of a fault; duplicate items in its transition
+    band so that one copy of each sees the geology on either side
+    """
+
+    def __call__(self, buf, n, h):
+        r0, nvec, rdelt = self.event.geometry()
+        # t = fraction of each item's weight on the slipped side
+        t = buf.t[:n]
+        np.dot(buf.r[:n], nvec, out=t)
+        t -= np.dot(r0, nvec)
+        t /= h
+        t += 0.5
+        np.clip(t, 0.0, 1.0, out=t)
+        shift, band = buf.shift[:n], buf.mask[:n]
+        np.greater_equal(t, 1.0, out=shift)
+        np.greater(t, 0.0, out=band)
+        np.logical_and(band, ~shift, out=band)
+        np.logical_and(band, buf.w[:n] != 0.0, out=band)
+        nb = np.count_nonzero(band)
+        if n + nb > buf.capacity:
+            buf.grow(n + nb)
+            return self(buf, n, h)
+        # Copies in the band go to the slipped side with weight w*t
+        m = n + nb
+        np.compress(band, buf.r[:n], axis=0, out=buf.r[n:m])
+        np.compress(band, buf.w[:n], out=buf.w[n:m])
+        np.compress(band, buf.idx[:n], out=buf.idx[n:m])
+        np.compress(band, t, out=buf.d[n:m])
+        buf.w[n:m] *= buf.d[n:m]
+        buf.acc[n:m] = 0.0
+        buf.r[n:m] += rdelt
+        # Originals keep weight w*(1-t), except those that slip entirely
+        np.subtract(1.0, t, out=t)
+        np.putmask(t, shift, 1.0)
+        buf.w[:n] *= t
+        for k in range(3):
+            np.multiply(shift, rdelt[k], out=buf.d[:n])
+            buf.r[:n,k] += buf.d[:n]
+        return m
+
+
+class _FoldWarpOp(_PlanOp):
+    """
+    Displace items according to a sinusoidal fold
+    """
+
+    def __call__(self, buf, n, h):
+        nvec, v = self.event.geometry()
+        d = buf.d[:n]
+        np.dot(buf.r[:n], nvec, out=d)
+        d *= 2*np.pi/self.event.wavelength
+        d += np.radians(self.event.phase)
+        np.sin(d, out=d)
+        d *= self.event.amplitude
+        for k in range(3):
+            np.multiply(d, v[k], out=buf.t[:n])
+            buf.r[:n,k] += buf.t[:n]
+        return n
+
+
+class _BasementOp(_PlanOp):
+    """
+    Deposit whatever weight is left on each item as basement
+    """
+
+    def __call__(self, buf, n, h):
+        np.multiply(buf.w[:n], self.event.density, out=buf.d[:n])
+        buf.acc[:n] += buf.d[:n]
+        return n
+
+
+class CompiledHistory:
+    """
+    A GeoHistory flattened into a linear list of operations; produces the
+    same rock properties as GeoHistory.rockprops (up to rounding), without
+    the temporary arrays allocated at each level of the recursion
+    """
+
+    def __init__(self, ops):
+        """
+        :param ops: list of _PlanOp instances, most recent event first
+        """
+        self.ops = ops
+        self.buffers = None
+
+    def rockprops(self, r, h, out=None):
+        """
+        :param r: np.array of shape (N, 3) of positions
+        :param h: transition scale
+        :param out: optional np.array of shape (N, ) to hold the result
+        :return: np.array of shape (N, ) of rock properties
+        """
+        N = len(r)
+        if self.buffers is None or self.buffers.N != N:
+            self.buffers = PlanBuffers(N)
+        buf = self.buffers
+        # Every point starts out as one item carrying all of its weight
+        buf.r[:N] = r
+        buf.w[:N] = 1.0
+        buf.acc[:N] = 0.0
+        buf.idx[:N] = buf.point_index
+        n = N
+        for op in self.ops:
+            n = op(buf, n, h)
+        # The first N items are still the original points, in order
+        if out is None:
+            out = np.zeros(N)
+        out[:] = buf.acc[:N]
+        np.add.at(out, buf.idx[N:n], buf.acc[N:n])
+        return out
+
+    def __call__(self, r, h):
+        return self.rockprops(r, h)
+
+
+# ============================================================================
+#          Octree meshes refined around the interfaces of a GeoHistory
+# ============================================================================
+
+def history_octree_mesh(history, N, delta, h, centering="CCN",
+                        min_level=3, tol=0.0):
+    """
+    Build a finalized octree mesh with its finest cells along the layer
+    interfaces, fault planes and folded surfaces of a GeoHistory for its
+    current parameters, and coarse cells everywhere else
+    :param history: GeoHistory instance
+    :param N: length of one edge of a cubical volume in finest cells
+        (must be a power of 2)
+    :param delta: length of one edge of a finest mesh cube
+    :param h: transition scale to pass to history.rockprops
+    :param centering: a three-letter code specifying whether each axis is
+        positive ('P'), negative ('N'), or centered ('C')
+    :param min_level: octree level of the coarsest cells
+    :param tol: smallest change in rock properties that counts
+    :return: TreeMesh instance
+    """
+    mesh = baseline_octree_mesh(N, delta, centering=centering)
+    mesh.refine(min_level, finalize=False)
+    refine_octree_gfunc(mesh, history.rockprops, h,
+                        min_level=min_level, tol=tol)
+    mesh.finalize()
+    return mesh
+
+
+class OctreeGravity:
+    """
+    Run a gravity model on an octree mesh rebuilt around the interfaces of
+    a GeoHistory every time its parameters change
+    """
+
+    def __init__(self, history, survey, N, delta, centering="CCN",
+                 min_level=3, tol=0.0, antialias=None, max_cached=2,
+                 reuse_columns=True):
+        """
+        :param history: GeoHistory instance
+        :param survey: gravity survey geometry
+        :param N: length of one edge of a cubical volume in finest cells
+            (must be a power of 2)
+        :param delta: length of one edge of a finest mesh cube
+        :param centering: a three-letter code for the mesh origin
+        :param min_level: octree level of the coarsest cells
+        :param tol: smallest change in rock properties that counts
+        :param antialias: optional partial volume model to voxelize the
+            interfaces with (see DiscreteGravity)
+        :param max_cached: number of forward models of recent meshes to
+            keep, so that parameter changes that leave the mesh alone
+            (e.g. density-only proposals) reuse their sensitivities
+        :param reuse_columns: if True, a new mesh copies the sensitivity
+            columns of the cells it shares with the last mesh, and only
+            computes those of its new cells (see reuse_sensitivities);
+            if False, or for the first mesh, the mesh gets a full SimPEG
+            integral setup
+        """
+        self.history = history
+        self.survey = survey
+        self.N, self.delta, self.centering = N, delta, centering
+        self.min_level, self.tol = min_level, tol
+        self.antialias = antialias
+        self.max_cached = max_cached
+        self.reuse_columns = reuse_columns
+        self.fwdmodels = OrderedDict()
+        self.ncomputed = 0
+        self.mesh = None
+        self.fwdmodel = None
+
+    def _new_fwdmodel(self, mesh):
+        """
+        :param mesh: TreeMesh instance not seen among the cached meshes
+        :return: DiscreteGravity instance for the mesh
+        """
+        engine = "integral"
+        if self.reuse_columns and self.fwdmodel is not None:
+            G, ncomputed = reuse_sensitivities(
+                mesh, self.survey, self.fwdmodel.mesh,
+                np.asarray(self.fwdmodel.fwd.G))
+            self.ncomputed += ncomputed
+            engine = lambda mesh, survey: DenseGravity(G)
+        else:
+            self.ncomputed += mesh.nC
+        return DiscreteGravity(mesh, self.survey, self.history.rockprops,
+                               engine=engine, antialias=self.antialias)
+
+    def calc_gravity(self, h):
+        """
+        Rebuild the mesh for the current parameters and run gravity on it.
+        Refining the mesh is cheap; the sensitivities of a mesh that comes
+        out the same as one of the last max_cached meshes are reused, and
+        otherwise only the columns of cells that weren't in the last mesh
+        are computed (unless reuse_columns is False).  Moving an interface
+        then costs in proportion to the cells refined around it, which
+        self.ncomputed counts.
+        :param h: transition scale to pass to history.rockprops
+        :return: np.array of gravity readings
+        """
+        mesh = history_octree_mesh(
+            self.history, self.N, self.delta, h, centering=self.centering,
+            min_level=self.min_level, tol=self.tol)
+        key = sensitivity_cache_key(mesh, self.survey)
+        if key in self.fwdmodels:
+            self.fwdmodels.move_to_end(key)
+        else:
+            self.fwdmodels[key] = self._new_fwdmodel(mesh)
+            while len(self.fwdmodels) > self.max_cached:
+                self.fwdmodels.popitem(last=False)
+        self.fwdmodel = self.fwdmodels[key]
+        self.mesh = self.fwdmodel.mesh
+        return self.fwdmodel.calc_gravity(h)
+
 # ============================================================================
 #                Testing construction of non-trivial subsurfaces
 # ============================================================================
@@ -405,14 +1495,13 @@ def plot_subsurface_01():
     histpars.extend([-4000.0, 0.0, 0.0, 0.940, 0.0, 0.342, -4200.0])
     # Fault #2
     histpars.extend([+4000.0, 0.0, 0.0, 0.940, 0.0, -0.342, 4200.0])
-    fwdmodel = DiscreteGravity(mesh, survey, history[0])
-    fwdmodel.gfunc = Basement()
-    fwdmodel.edgemask = profile_timer(fwdmodel.calc_gravity, h, [1.0])
+    # Show density contrasts relative to the mean density of each model
+    fwdmodel = DiscreteGravity(mesh, survey, history[0],
+                               background_density='mean')
     for m, part_history in enumerate(history):
         fwdmodel.gfunc = part_history
         npars = np.sum([e.npars for e in history[:m+1]])
         profile_timer(fwdmodel.calc_gravity, h, histpars[:npars])
-        fwdmodel.fwd_data -= fwdmodel.edgemask * fwdmodel.voxmodel.mean()
         fig = plt.figure(figsize=(12,4))
         ax1 = plt.subplot(121)
         fwdmodel.plot_model_slice(ax=ax1)
@@ -420,18 +1509,12 @@ def plot_subsurface_01():
         fwdmodel.plot_gravity(ax=ax2)
         plt.show()
 
-def plot_subsurface_02():
+def graben_history():
     """
-    Create a basic graben geology using object-oriented API
-    :return: nothing (but plot the result)
+    Create a basic graben geology (two layers over a basement, cut by two
+    faults and then folded) using object-oriented API
+    :return: GeoHistory instance
     """
-    # Initialize basic grid parameters
-    z0, L, NL = 0.0, 10000.0, 30
-    h = L/NL
-    print("z0, L, nL, h =", z0, L, NL, h)
-    mesh = baseline_tensor_mesh(NL, h, centering='CCN')
-    survey = survey_gridded_locations(L, L, 20, 20, z0)
-    # Create the history
     history = GeoHistory()
     history.add_event(
         BasementEvent(
@@ -475,24 +1558,35 @@ def plot_subsurface_02():
              ('amplitude', UniGaussianDist(mean=300.0, std=50.0))]
         )
     )
-    print("history.pars =", history.serialize())
     # Can also set parameters all at once -- good for running MCMC
     history.set_to_prior_draw()
     history.deserialize([3.0, 1900.0, 2.5, 2500.0, 2.0,
                          -4000.0, 0.0, +20.0, 0.0, -4200.0,
                          +4000.0, 0.0, -20.0, 0.0, +4200.0,
                          -0.0, 0.0, 0.0, 0.0, 3000.0, 300.0])
+    return history
+
+def plot_subsurface_02():
+    """
+    Create a basic graben geology using object-oriented API
+    :return: nothing (but plot the result)
+    """
+    # Initialize basic grid parameters
+    z0, L, NL = 0.0, 10000.0, 30
+    h = L/NL
+    print("z0, L, nL, h =", z0, L, NL, h)
+    mesh = baseline_tensor_mesh(NL, h, centering='CCN')
+    survey = survey_gridded_locations(L, L, 20, 20, z0)
+    history = graben_history()
     print("history.pars =", history.serialize())
     print("history.prior =", history.logprior())
     # Plot a cross-section
-    fwdmodel = DiscreteGravity(mesh, survey, history.event_list[0])
-    fwdmodel.gfunc = history.event_list[0].rockprops
-    fwdmodel.edgemask = profile_timer(fwdmodel.calc_gravity, h)
+    fwdmodel = DiscreteGravity(mesh, survey, history.event_list[0].rockprops,
+                               background_density='mean')
     for m, event in enumerate(history.event_list):
         print("current event:", event)
         fwdmodel.gfunc = lambda r, h: np.array(event.rockprops(r, h))
         profile_timer(fwdmodel.calc_gravity, h)
-        fwdmodel.fwd_data -= fwdmodel.edgemask * fwdmodel.voxmodel.mean()
         fig = plt.figure(figsize=(12,4))
         ax1 = plt.subplot(121)
         fwdmodel.plot_model_slice(ax=ax1)
@@ -500,6 +1594,62 @@ def plot_subsurface_02():
         fwdmodel.plot_gravity(ax=ax2)
         plt.show()
 
+def compare_octree_mesh():
+    """
+    Compare the size and gravity of an octree mesh refined around the
+    interfaces of the graben geology to a uniform tensor mesh
+    :return: nothing
+    """
+    z0, L, NL = 0.0, 10000.0, 64
+    h = L/NL
+    survey = survey_gridded_locations(L, L, 20, 20, z0)
+    history = graben_history()
+    mesh = baseline_tensor_mesh(NL, h, centering='CCN')
+    fwdmodel = DiscreteGravity(mesh, survey, history.rockprops)
+    grav0 = profile_timer(fwdmodel.calc_gravity, h)
+    octmodel = OctreeGravity(history, survey, NL, h)
+    # The first call builds the sensitivities of the new mesh; the second
+    # finds the same mesh and reuses them
+    grav1 = profile_timer(octmodel.calc_gravity, h)
+    grav1 = profile_timer(octmodel.calc_gravity, h)
+    print("cells in tensor mesh, octree mesh = {}, {}"
+          .format(mesh.nC, octmodel.mesh.nC))
+    res = (grav1 - grav0)/np.std(grav0)
+    print("mu, std resids (octree vs tensor) = {:.3g} {:.3g}"
+          .format(np.mean(res), np.std(res)))
+    # Moving a fault changes the mesh, but only around the fault
+    pvec = history.serialize()
+    pvec[5] += 0.5*h
+    history.deserialize(pvec)
+    ncomputed = octmodel.ncomputed
+    profile_timer(octmodel.calc_gravity, h)
+    print("new sensitivity columns after moving a fault = {} of {}"
+          .format(octmodel.ncomputed - ncomputed, octmodel.mesh.nC))
+
+def compare_padded_mesh():
+    """
+    Compare a padded tensor mesh with a uniform core under the graben survey
+    to a uniform tensor mesh covering the same volume
+    :return: nothing
+    """
+    z0, L, NL = 0.0, 10000.0, 30
+    h = L/NL
+    survey = survey_gridded_locations(L, L, 20, 20, z0)
+    history = graben_history()
+    mesh = TensorMesh([[(h, 3*NL)], [(h, 3*NL)], [(h, 2*NL)]], 'CCN')
+    fwdmodel = DiscreteGravity(mesh, survey, history.rockprops,
+                               background_density='mean')
+    grav0 = profile_timer(fwdmodel.calc_gravity, h)
+    padmesh = padded_tensor_mesh(NL, h, L, centering='CCN')
+    padmodel = DiscreteGravity(padmesh, survey, history.rockprops,
+                               background_density='mean', subsample=h)
+    grav1 = profile_timer(padmodel.calc_gravity, h)
+    print("cells in uniform mesh, padded mesh = {}, {}"
+          .format(mesh.nC, padmesh.nC))
+    res = (grav1 - grav0)/np.std(grav0)
+    print("mu, std resids (padded vs uniform) = {:.3g} {:.3g}"
+          .format(np.mean(res), np.std(res)))
+
 if __name__ == "__main__":
     # plot_soft_if_then()
     # plot_subsurface_01()
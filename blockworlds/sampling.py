@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+"""
+Ensemble MCMC over the parameters of a GeoHistory
+
+The sampler keeps an ensemble of walkers and updates half of them at a time
+with an affine-invariant stretch move or a random-walk Metropolis move, so
+every walker in a half can be evaluated at once across a process pool.  Each
+worker builds its own log posterior once (from a picklable factory), and
+each walker draws from its own random stream, so runs are reproducible no
+matter how many processes they use.
+"""
+
+import numpy as np
+import multiprocessing
+from functools import partial
+from blockworlds import profile_timer, DiscreteGravity, publish_sensitivities
+from blockworlds import baseline_tensor_mesh, survey_gridded_locations
+from blockworlds import relative_gravity_loglike
+
+
+# ============================================================================
+#                 Log posterior for a GeoHistory and its data
+# ============================================================================
+
+class GeoHistoryPosterior:
+    """
+    Log posterior density for a GeoHistory given gravity data
+    """
+
+    def __init__(self, history, fwdmodel, data, sigdata, h):
+        """
+        :param history: GeoHistory instance
+        :param fwdmodel: DiscreteGravity instance (or anything else with a
+            calc_gravity(h) method); its gfunc is set to history.rockprops
+        :param data: np.array of observed gravity readings
+        :param sigdata: standard deviation of the noise in the data
+        :param h: transition scale to pass to history.rockprops
+        """
+        self.history = history
+        self.fwdmodel = fwdmodel
+        self.data = data
+        self.sigdata = sigdata
+        self.h = h
+        self.fwdmodel.gfunc = history.rockprops
+
+    def log_prior(self, theta):
+        self.history.deserialize(theta)
+        return self.history.logprior()
+
+    def log_likelihood(self, theta):
+        self.history.deserialize(theta)
+        if hasattr(self.fwdmodel, 'calc_log_likelihood'):
+            return self.fwdmodel.calc_log_likelihood(
+                self.data, self.sigdata, self.h)
+        return relative_gravity_loglike(
+            self.fwdmodel.calc_gravity(self.h), self.data, self.sigdata)
+
+    def log_likelihood_coarse(self, theta):
+        """
+        Cheap approximation to log_likelihood() on the coarsest mesh of a
+        RichardsonGravity forward model (or anything else with a
+        calc_gravity_coarse(h) method), for delayed acceptance
+        """
+        self.history.deserialize(theta)
+        return relative_gravity_loglike(
+            self.fwdmodel.calc_gravity_coarse(self.h), self.data, self.sigdata)
+
+    def __call__(self, theta):
+        lP = self.log_prior(theta)
+        if not np.isfinite(lP):
+            return -np.inf
+        return lP + self.log_likelihood(theta)
+
+    def coarse(self, theta):
+        """
+        Cheap approximation to the log posterior, for delayed acceptance
+        """
+        lP = self.log_prior(theta)
+        if not np.isfinite(lP):
+            return -np.inf
+        return lP + self.log_likelihood_coarse(theta)
+
+# ============================================================================
+#                     Proposals for updating the walkers
+# ============================================================================
+
+class EnsembleMove:
+    """
+    A proposal that updates one half of the ensemble given the other half
+    """
+
+    def propose(self, x, xc, rngs):
+        """
+        :param x: np.array of shape (K, Npars) of walkers to update
+        :param xc: np.array of shape (Kc, Npars) of complementary walkers
+        :param rngs: list of K np.random.Generator instances, one per walker
+        :return: np.array of shape (K, Npars) of proposals, and np.array of
+            shape (K, ) of log Hastings factors for the proposals
+        """
+        raise NotImplementedError
+
+
+class StretchMove(EnsembleMove):
+    """
+    Affine-invariant stretch move (Goodman & Weare 2010, Comm. App. Math.
+    Comp. Sci. 5, 65-80; Foreman-Mackey et al. 2013, PASP 125, 306-312)
+    """
+
+    def __init__(self, a=2.0):
+        """
+        :param a: scale parameter of the stretch distribution
+        """
+        self.a = a
+
+    def propose(self, x, xc, rngs):
+        K, Npars = x.shape
+        j = np.array([rng.integers(len(xc)) for rng in rngs])
+        u = np.array([rng.random() for rng in rngs])
+        # Draw z from g(z) ~ 1/sqrt(z) on [1/a, a]
+        z = ((self.a - 1)*u + 1)**2/self.a
+        xnew = xc[j] + z[:,np.newaxis]*(x - xc[j])
+        return xnew, (Npars - 1)*np.log(z)
+
+
+class RandomWalkMove(EnsembleMove):
+    """
+    Random-walk Metropolis move with a fixed Gaussian proposal; each walker
+    moves independently of the others
+    """
+
+    def __init__(self, cov):
+        """
+        :param cov: np.array of shape (Npars, Npars) of the proposal
+            covariance, or of shape (Npars, ) of proposal variances
+        """
+        cov = np.atleast_1d(cov)
+        if cov.ndim == 1:
+            cov = np.diag(cov)
+        self.chol = np.linalg.cholesky(cov)
+
+    def propose(self, x, xc, rngs):
+        eps = np.array([rng.standard_normal(x.shape[1]) for rng in rngs])
+        return x + eps @ self.chol.T, np.zeros(len(x))
+
+# ============================================================================
+#                Ensemble sampler with a pool of worker processes
+# ============================================================================
+
+# Log posterior built by each worker process from the sampler's factory
+_worker_logpost = None
+
+def _init_worker(logpost_factory):
+    """
+    Build the log posterior once per worker process
+    :param logpost_factory: picklable callable returning a log posterior
+    """
+    global _worker_logpost
+    _worker_logpost = logpost_factory()
+
+def _call_seeded(f, theta, seed):
+    """
+    Evaluate a log posterior with the global random stream seeded for this
+    evaluation, in case the log posterior uses one; the seeds come with the
+    tasks, so results don't depend on which process runs which task
+    """
+    np.random.seed(seed)
+    return f(theta)
+
+def _eval_worker(task):
+    return _call_seeded(_worker_logpost, *task)
+
+def _eval_worker_coarse(task):
+    return _call_seeded(_worker_logpost.coarse, *task)
+
+
+class EnsembleSampler:
+    """
+    Ensemble MCMC sampler whose walkers are evaluated in a process pool
+    """
+
+    def __init__(self, logpost_factory, nwalkers, moves=None,
+                 processes=None, seed=None, delayed_acceptance=False):
+        """
+        :param logpost_factory: picklable callable (e.g. a module-level
+            function or a functools.partial of one) that takes no arguments
+            and returns a callable mapping a parameter vector to its log
+            posterior density, such as a GeoHistoryPosterior; each worker
+            calls it once, so expensive setup happens once per process
+        :param nwalkers: number of walkers (an even number, at least twice
+            the number of parameters for the stretch move)
+        :param moves: list of (EnsembleMove, probability) pairs, chosen
+            from at random for each half-step (default = StretchMove())
+        :param processes: number of worker processes; None uses all cores,
+            and 1 evaluates everything in this process
+        :param seed: integer seed; each walker gets its own random stream
+            from np.random.SeedSequence(seed), so the chain doesn't depend
+            on the number of processes
+        :param delayed_acceptance: if True, screen each proposal with the
+            cheap log posterior from the coarse() method of the log
+            posterior first, and only evaluate the full log posterior for
+            proposals that pass (Christen & Fox 2005, J. Comp. Graph. Stat.
+            14, 795-810); the second-stage acceptance ratio corrects for
+            the screen, so the chain still targets the full posterior
+        """
+        if nwalkers < 4 or nwalkers % 2 != 0:
+            raise ValueError("nwalkers must be an even number >= 4")
+        if moves is None:
+            moves = [(StretchMove(), 1.0)]
+        self.logpost_factory = logpost_factory
+        self.nwalkers = nwalkers
+        self.moves = [m for m, p in moves]
+        self.move_probs = np.array([p for m, p in moves], dtype=float)
+        self.move_probs /= np.sum(self.move_probs)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.seed_seq = np.random.SeedSequence(seed)
+        self.seed = self.seed_seq.entropy
+        walker_seeds = self.seed_seq.spawn(nwalkers + 1)
+        self.rng = np.random.default_rng(walker_seeds[0])
+        self.walker_rngs = [np.random.default_rng(s) for s in walker_seeds[1:]]
+        # Seeds for the global random stream of each evaluation
+        self.task_seed_seq = self.seed_seq.spawn(1)[0]
+        self.delayed_acceptance = delayed_acceptance
+        self.pool = None
+        self.logpost = None
+        self.chain, self.logp, self.naccepted = None, None, None
+        self.logp_coarse = None
+        self.nscreened = self.nevaluated = 0
+
+    def _start(self):
+        if self.processes > 1 and self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.processes, initializer=_init_worker,
+                initargs=(self.logpost_factory, ))
+        elif self.processes == 1 and self.logpost is None:
+            self.logpost = self.logpost_factory()
+
+    def close(self):
+        """
+        Shut down the worker processes
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def evaluate(self, thetas, coarse=False):
+        """
+        :param thetas: np.array of shape (K, Npars) of parameter vectors
+        :param coarse: if True, evaluate the cheap approximation instead
+        :return: np.array of shape (K, ) of log posterior densities
+        """
+        self._start()
+        if len(thetas) == 0:
+            return np.zeros(0)
+        seeds = [ss.generate_state(1)[0]
+                 for ss in self.task_seed_seq.spawn(len(thetas))]
+        if self.pool is None:
+            # Running in this process, so leave the caller's global random
+            # stream as it was
+            f = self.logpost.coarse if coarse else self.logpost
+            state = np.random.get_state()
+            try:
+                return np.array([_call_seeded(f, theta, seed)
+                                 for theta, seed in zip(thetas, seeds)])
+            finally:
+                np.random.set_state(state)
+        f = _eval_worker_coarse if coarse else _eval_worker
+        return np.array(self.pool.map(f, list(zip(thetas, seeds))))
+
+    def _accept(self, s, xnew, logf, x, lp, lpc, rngs):
+        """
+        Decide which proposals to accept, and update the walkers in place
+        :param s: np.array of indices of the walkers being updated
+        :param xnew: np.array of shape (K, Npars) of proposals
+        :param logf: np.array of shape (K, ) of log Hastings factors
+        :param x, lp, lpc: positions, log posteriors and coarse log
+            posteriors of the whole ensemble (lpc is None unless using
+            delayed acceptance)
+        :param rngs: list of K np.random.Generator instances
+        """
+        logu = np.log([rng.random() for rng in rngs])
+        if not self.delayed_acceptance:
+            lpnew = self.evaluate(xnew)
+            accept = logu < logf + lpnew - lp[s]
+        else:
+            # Always draw both uniforms to keep the streams reproducible
+            logu2 = np.log([rng.random() for rng in rngs])
+            lpcnew = self.evaluate(xnew, coarse=True)
+            screen = logu < logf + lpcnew - lpc[s]
+            lpnew = np.full(len(s), -np.inf)
+            lpnew[screen] = self.evaluate(xnew[screen])
+            self.nscreened += len(s)
+            self.nevaluated += np.sum(screen)
+            # The screen's own acceptance ratio divides out of the second
+            # stage, so only the fine-to-coarse ratio correction remains
+            with np.errstate(invalid='ignore'):
+                accept = screen & (logu2 < (lpnew - lp[s])
+                                   - (lpcnew - lpc[s]))
+            lpc[s[accept]] = lpcnew[accept]
+        x[s[accept]], lp[s[accept]] = xnew[accept], lpnew[accept]
+        self.naccepted[s[accept]] += 1
+
+    def run(self, p0, nsteps):
+        """
+        Run the ensemble for a number of steps, continuing the current
+        chain if there is one
+        :param p0: np.array of shape (nwalkers, Npars) of starting positions
+            (ignored when continuing)
+        :param nsteps: number of steps to take
+        :return: np.array of shape (nsteps, nwalkers, Npars) of samples
+        """
+        if self.chain is None:
+            x = np.array(p0, dtype=float)
+            if x.shape[0] != self.nwalkers:
+                raise ValueError("p0 has {} walkers, expected {}"
+                                 .format(x.shape[0], self.nwalkers))
+            lp = self.evaluate(x)
+            lpc = None
+            if self.delayed_acceptance:
+                lpc = self.evaluate(x, coarse=True)
+            self.naccepted = np.zeros(self.nwalkers, dtype=int)
+        else:
+            x, lp = self.chain[-1].copy(), self.logp[-1].copy()
+            lpc = self.logp_coarse
+            if self.delayed_acceptance and lpc is None:
+                # Delayed acceptance was switched on since the last run
+                lpc = self.evaluate(x, coarse=True)
+        chain = np.zeros((nsteps, ) + x.shape)
+        logp = np.zeros((nsteps, self.nwalkers))
+        halves = [np.arange(0, self.nwalkers, 2),
+                  np.arange(1, self.nwalkers, 2)]
+        for i in range(nsteps):
+            for k in range(2):
+                s, c = halves[k], halves[1-k]
+                move = self.moves[self.rng.choice(len(self.moves),
+                                                  p=self.move_probs)]
+                rngs = [self.walker_rngs[j] for j in s]
+                xnew, logf = move.propose(x[s], x[c], rngs)
+                self._accept(s, xnew, logf, x, lp, lpc, rngs)
+            chain[i], logp[i] = x, lp
+        # Coarse log posteriors go stale while delayed acceptance is off
+        self.logp_coarse = lpc if self.delayed_acceptance else None
+        if self.chain is None:
+            self.chain, self.logp = chain, logp
+        else:
+            self.chain = np.concatenate([self.chain, chain])
+            self.logp = np.concatenate([self.logp, logp])
+        return chain
+
+    @property
+    def acceptance_fraction(self):
+        """
+        Fraction of proposals accepted by each walker so far
+        """
+        return self.naccepted / len(self.chain)
+
+    @property
+    def screen_pass_fraction(self):
+        """
+        Fraction of proposals that passed the delayed-acceptance screen,
+        i.e. that needed a full log posterior evaluation
+        """
+        return self.nevaluated / max(self.nscreened, 1)
+
+# ============================================================================
+#                   Testing on a synthetic graben geology
+# ============================================================================
+
+def graben_posterior(NL=15, Ng=10, sigdata=0.1, shared=None):
+    """
+    Log posterior for the graben geology given synthetic data generated
+    from its own default parameters
+    :param NL: length of one edge of the mesh in cells
+    :param Ng: number of sensors along one edge of the survey
+    :param sigdata: standard deviation of the noise in the data
+    :param shared: optional SharedArrays instance with the sensitivities
+        for this mesh and survey (see blockworlds.publish_sensitivities)
+    :return: GeoHistoryPosterior instance
+    """
+    from implicit import graben_history
+    z0, L = 0.0, 10000.0
+    h = L/NL
+    mesh = baseline_tensor_mesh(NL, h, centering='CCN')
+    survey = survey_gridded_locations(L, L, Ng, Ng, z0)
+    history = graben_history()
+    fwdmodel = DiscreteGravity(mesh, survey, history.rockprops,
+                               shared=shared)
+    data = fwdmodel.calc_gravity(h)
+    return GeoHistoryPosterior(history, fwdmodel, data, sigdata, h)
+
+def run_graben_sampler(nwalkers=64, nsteps=100, processes=None, seed=42):
+    """
+    Sample the graben posterior with the ensemble sampler
+    :return: nothing
+    """
+    logpost = graben_posterior()
+    theta0 = logpost.history.serialize()
+    # Scatter the walkers additively on the scale of the prior:  stretch
+    # moves stay in the affine hull of the walkers, so a parameter that
+    # starts out the same for every walker (e.g. zero) would never move
+    np.random.seed(seed)
+    scale = np.std(logpost.history.sample_prior(1000), axis=0)
+    rng = np.random.default_rng(seed)
+    p0 = theta0 + 1e-2*scale*rng.standard_normal((nwalkers, len(theta0)))
+    moves = [(StretchMove(), 0.8), (RandomWalkMove((1e-2*scale)**2), 0.2)]
+    # Workers share one copy of the sensitivities instead of making their own
+    shared = publish_sensitivities(logpost.fwdmodel)
+    factory = partial(graben_posterior, shared=shared)
+    try:
+        with EnsembleSampler(factory, nwalkers, moves=moves,
+                             processes=processes, seed=seed) as sampler:
+            chain = profile_timer(sampler.run, p0, nsteps)
+            print("acceptance fraction =",
+                  np.mean(sampler.acceptance_fraction))
+    finally:
+        shared.unlink()
+    flat = chain[nsteps//2:].reshape(-1, len(theta0))
+    print("chain.mean =", np.mean(flat, axis=0))
+    print("chain.std  =", np.std(flat, axis=0))
+
+if __name__ == "__main__":
+    run_graben_sampler()
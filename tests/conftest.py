@@ -0,0 +1,10 @@
+"""
+The blockworlds modules import each other by their flat names, so put their
+directory on the path the same way running them from there would
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'blockworlds'))
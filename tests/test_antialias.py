@@ -0,0 +1,57 @@
+"""
+Checks of the closed-form partial volumes against brute-force counting
+"""
+
+import numpy as np
+from discretize import TensorMesh
+
+import antialias
+
+
+def test_partial_volume_exact_known_cases():
+    pars, pV = antialias.generate_test_data()
+    pV_exact = antialias.partial_volume_exact(pars[:,:3], pars[:,3:])
+    assert np.allclose(pV_exact, pV, atol=1e-3)
+
+def test_partial_volume_exact_matches_fine_mesh():
+    Nfine = 64
+    hx = [(1.0/Nfine, Nfine), ]
+    mesh = TensorMesh([hx, hx, hx], "CCC")
+    rng = np.random.default_rng(0)
+    n = rng.normal(size=(25, 3))
+    n /= np.sqrt(np.sum(n**2, axis=1))[:,np.newaxis]
+    r0 = rng.uniform(-0.5, 0.5, size=(25, 3))
+    pV_exact = antialias.partial_volume_exact(r0, n)
+    pV_mesh = [antialias.partial_volume(mesh, r0[i], n[i])
+               for i in range(len(n))]
+    # Counting cell centers is good to about the fraction of cells cut
+    assert np.allclose(pV_exact, pV_mesh, atol=2e-3)
+
+def test_partial_volume_exact_symmetry():
+    rng = np.random.default_rng(1)
+    n = rng.normal(size=(100, 3))
+    r0 = rng.uniform(-0.8, 0.8, size=(100, 3))
+    pV = antialias.partial_volume_exact(r0, n)
+    assert np.all((pV >= 0) & (pV <= 1))
+    # Flipping the normal swaps the two sides of the plane
+    assert np.allclose(pV + antialias.partial_volume_exact(r0, -n), 1.0)
+
+def test_tabulated_antialiasing_error_bound():
+    table = antialias.TabulatedAntialiasing()
+    table.fit()
+    np.random.seed(2)
+    pars, pV = antialias.generate_random_data(20000)
+    rms, worst = table.error_report(pars, pV)
+    assert rms < 1e-4
+    assert worst < 2e-3
+    assert np.array_equal(table(pars[:,:3], pars[:,3:]), table.predict(pars))
+
+def test_tabulated_antialiasing_save_load(tmp_path):
+    table = antialias.TabulatedAntialiasing(shape=(65, 17, 9))
+    table.fit()
+    fname = str(tmp_path / "table.npz")
+    table.save(fname)
+    loaded = antialias.TabulatedAntialiasing.load(fname)
+    np.random.seed(3)
+    pars, pV = antialias.generate_random_data(5000)
+    assert np.array_equal(loaded.predict(pars), table.predict(pars))
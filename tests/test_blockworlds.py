@@ -0,0 +1,231 @@
+"""
+Checks of the gravity forward models against reference implementations
+"""
+
+import numpy as np
+import pytest
+
+import blockworlds as bw
+
+
+@pytest.fixture(scope="module")
+def regular_problem():
+    # A regular mesh with a sensor over every column of cells, as FFTGravity
+    # needs; N = 16 keeps the dense integral G small
+    N, delta, Ng = 16, 1.0, 16
+    mesh = bw.baseline_tensor_mesh(N, delta)
+    survey = bw.survey_gridded_locations(N, N, Ng, Ng, 0.5*N*delta + 1.0)
+    return mesh, survey
+
+def test_fft_matches_integral(regular_problem):
+    mesh, survey = regular_problem
+    fwd_fft = bw.FFTGravity(mesh, survey)
+    fwd_int = bw.build_forward_model(mesh, survey)
+    rng = np.random.default_rng(0)
+    for model in [bw.gfunc_uniform_sphere(mesh.gridCC, 5.0, 1000.0),
+                  rng.normal(size=mesh.nC)]:
+        grav_fft, grav_int = fwd_fft.dpred(model), fwd_int.dpred(model)
+        scale = np.max(np.abs(grav_int))
+        assert np.max(np.abs(grav_fft - grav_int)) < 1e-4*scale
+
+def test_fft_rmatvec_is_transpose(regular_problem):
+    mesh, survey = regular_problem
+    fwd = bw.FFTGravity(mesh, survey)
+    rng = np.random.default_rng(1)
+    m, d = rng.normal(size=mesh.nC), rng.normal(size=survey.nD)
+    assert np.isclose(np.dot(d, fwd.dpred(m)), np.dot(fwd.rmatvec(d), m),
+                      rtol=1e-10)
+
+@pytest.mark.parametrize("engine", ["integral", "fft"])
+def test_dpred_batch_matches_loop(regular_problem, engine):
+    mesh, survey = regular_problem
+    fwd = bw.build_forward_model(mesh, survey, engine=engine)
+    models = np.random.default_rng(2).normal(size=(7, mesh.nC))
+    batch = bw.dpred_batch(fwd, models, chunk=3)
+    loop = np.array([fwd.dpred(m) for m in models])
+    assert batch.shape == (7, survey.nD)
+    assert np.allclose(batch, loop, rtol=1e-5, atol=1e-6*np.abs(loop).max())
+
+def test_richardson_fit_recovers_power_law():
+    h = np.array([2.8, 2.0, 1.4, 1.0])
+    rng = np.random.default_rng(3)
+    f0 = rng.normal(size=(5, 30))
+    alpha = np.array([0.7, 1.0, 1.3, 2.0, 2.5])
+    c = rng.normal(size=(5, 30))
+    f = f0 + c*h[:,np.newaxis,np.newaxis]**alpha[:,np.newaxis]
+    fit_f0, cov, fit_alpha = bw.RichardsonExtrapolator(h).fit(f)
+    assert np.allclose(fit_alpha, alpha, rtol=1e-4)
+    assert np.allclose(fit_f0, f0, atol=1e-6)
+    assert cov.shape == f0.shape
+
+def test_richardson_fit_batch_matches_single():
+    h = np.array([2.8, 2.0, 1.4, 1.0])
+    rng = np.random.default_rng(4)
+    f = rng.normal(size=(4, 1, 20)) + h[:,np.newaxis,np.newaxis]**1.5
+    f = f + 0.01*rng.normal(size=(4, 3, 20))
+    extrap = bw.RichardsonExtrapolator(h)
+    f0, cov, alpha = extrap.fit(f)
+    for m in range(3):
+        f0_m, cov_m, alpha_m = extrap.fit(f[:,m,:])
+        assert np.allclose(f0_m, f0[m])
+        assert np.allclose(cov_m, cov[m])
+        assert np.isclose(alpha_m, alpha[m])
+
+def test_richardson_cache_keys_and_limit(tmp_path, monkeypatch):
+    L = 8.0
+    survey = bw.survey_gridded_locations(L, L, 4, 4, 5.0)
+    gfunc = bw.gfunc_uniform_sphere
+    bw.clear_richardson_cache()
+    rg1 = bw.RichardsonGravity(L, [2.0, 1.0], survey, gfunc)
+    rg2 = bw.RichardsonGravity(L, [2.0, 1.0], survey, gfunc)
+    assert rg2.meshxfwd[0][1] is rg1.meshxfwd[0][1]
+    # A different cache_dir must not get the in-RAM model of the first
+    rg3 = bw.RichardsonGravity(L, [2.0, 1.0], survey, gfunc,
+                               cache_dir=str(tmp_path))
+    assert rg3.meshxfwd[0][1] is not rg1.meshxfwd[0][1]
+    monkeypatch.setattr(bw, "richardson_cache_size", 2)
+    bw.RichardsonGravity(L, [4.0, 2.0], survey, gfunc)
+    assert len(bw._richardson_meshxfwd) == 2
+    bw.clear_richardson_cache()
+    assert len(bw._richardson_meshxfwd) == 0
+
+def test_shared_sensitivities_checks(regular_problem):
+    mesh, survey = regular_problem
+    gfunc = lambda r: np.zeros(len(r))
+    fwdmodel = bw.DiscreteGravity(mesh, survey, gfunc)
+    shared = bw.publish_sensitivities(fwdmodel)
+    try:
+        model = np.random.default_rng(5).normal(size=mesh.nC)
+        other = bw.DiscreteGravity(mesh, survey, gfunc, shared=shared)
+        assert np.allclose(other.dpred(model), fwdmodel.dpred(model))
+        with pytest.raises(ValueError):
+            bw.DiscreteGravity(mesh, survey, gfunc, shared=shared,
+                               engine='fft')
+        ind_active = mesh.gridCC[:,2] < 0
+        with pytest.raises(ValueError):
+            bw.DiscreteGravity(mesh, survey, gfunc, shared=shared,
+                               ind_active=ind_active)
+    finally:
+        shared.unlink()
+
+@pytest.mark.parametrize("delta, width", [(10.0, 6.5), (10.0, 10.0),
+                                          (10.0, 30.0), (250.0, 1e4)])
+def test_padding_widths(delta, width):
+    h = bw.padding_widths(delta, width)
+    if width < delta:
+        assert len(h) == 0
+        return
+    assert np.isclose(np.sum(h), width)
+    assert np.all(h >= delta*(1 - 1e-12))
+    assert np.all(np.diff(h) > 0)
+
+def test_voxel_sampler_subdivisions():
+    mesh = bw.padded_tensor_mesh(4, 1.0, 30.0)
+    gfunc = lambda r: r[:,0]**2
+    with pytest.warns(UserWarning):
+        bw.VoxelSampler(mesh, 1.0, max_subdivisions=2)
+    sampler = bw.VoxelSampler(mesh, 1.0, max_subdivisions=None)
+    assert np.all(sampler.widths <= 1.0 + 1e-9)
+    # The midpoint rule on sub-cells of width w is off by w^2/12
+    widths = bw.mesh_cell_widths(mesh)
+    sub = np.ceil(widths/1.0*(1 - 1e-9))
+    exact = mesh.gridCC[:,0]**2 + widths[:,0]**2/12
+    assert np.allclose(sampler(gfunc) + (widths[:,0]/sub[:,0])**2/12, exact)
+
+@pytest.mark.parametrize("kwargs", [
+    dict(),
+    dict(background_density='mean'),
+    dict(background_density=2.5),
+    dict(fixed_density=1.0, background_density='mean', active=True),
+])
+def test_discrete_gravity_dpred_batch(regular_problem, kwargs):
+    mesh, survey = regular_problem
+    kwargs = dict(kwargs)
+    if kwargs.pop('active', False):
+        kwargs['ind_active'] = mesh.gridCC[:,2] < 2.0
+    gfunc = lambda r, rho: rho*(1.0 + 0.1*r[:,0])
+    gfunc_batch = lambda r, P: P[:,:1]*(1.0 + 0.1*r[:,0])
+    fwdmodel = bw.DiscreteGravity(mesh, survey, gfunc,
+                                  gfunc_batch=gfunc_batch, **kwargs)
+    nactive = len(fwdmodel.volume_weights)
+    # Five models against 256 sensors, so a per-model offset of the wrong
+    # shape can't broadcast by accident
+    models = np.random.default_rng(6).normal(size=(5, nactive))
+    batch = fwdmodel.dpred_batch(models, chunk=2)
+    loop = np.array([fwdmodel.dpred(m) for m in models])
+    assert batch.shape == (5, survey.nD)
+    assert np.allclose(batch, loop, rtol=1e-5, atol=1e-6*np.abs(loop).max())
+    P = np.array([[1.0], [2.0], [3.0]])
+    grav = fwdmodel.calc_gravity_batch(P, chunk=2)
+    assert np.allclose(grav, [fwdmodel.calc_gravity(p[0]) for p in P],
+                       rtol=1e-5, atol=1e-6*np.abs(grav).max())
+
+def test_nested_richardson_matches_independent_meshes():
+    L = 8.0
+    survey = bw.survey_gridded_locations(L, L, 4, 4, 9.0)
+    args = (3.0, 1000.0)
+    dL = [2.0, 1.0, 0.5]
+    bw.clear_richardson_cache()
+    plain = bw.RichardsonGravity(L, dL, survey, bw.gfunc_uniform_sphere)
+    nested = bw.RichardsonGravity(L, dL, survey, bw.gfunc_uniform_sphere,
+                                  nested=True)
+    f0_plain = plain.calc_gravity(*args)
+    f0_nested = nested.calc_gravity(*args)
+    # Each level sums the finest G over the cells of a coarse block, which
+    # is the coarse G up to float32 rounding
+    for f_plain, f_nested in zip(plain.f, nested.f):
+        scale = np.max(np.abs(f_plain))
+        assert np.allclose(f_nested, f_plain, rtol=1e-4, atol=1e-5*scale)
+    assert np.allclose(f0_nested, f0_plain, rtol=1e-3,
+                       atol=1e-4*np.max(np.abs(f0_plain)))
+    bw.clear_richardson_cache()
+
+def test_nested_richardson_coarse_screen():
+    L = 8.0
+    survey = bw.survey_gridded_locations(L, L, 4, 4, 9.0)
+    args = (3.0, 1000.0)
+    dL = [2.0, 1.0, 0.5]
+    bw.clear_richardson_cache()
+    plain = bw.RichardsonGravity(L, dL, survey, bw.gfunc_uniform_sphere)
+    nested = bw.RichardsonGravity(L, dL, survey, bw.gfunc_uniform_sphere,
+                                  nested=True)
+    f_plain = plain.calc_gravity_coarse(*args)
+    f_nested = nested.calc_gravity_coarse(*args)
+    # The screen runs through the coarsest mesh's own sensitivities
+    assert nested.coarse_G.shape == (survey.nD, nested.meshxfwd[0][0].nC)
+    assert np.allclose(f_nested, f_plain, rtol=1e-4,
+                       atol=1e-5*np.max(np.abs(f_plain)))
+    bw.clear_richardson_cache()
+
+def test_streaming_keeps_blocks(regular_problem, tmp_path):
+    mesh, survey = regular_problem
+    fwd_int = bw.build_forward_model(mesh, survey)
+    model = np.random.default_rng(7).normal(size=mesh.nC)
+    grav_int = fwd_int.dpred(model)
+    scale = np.max(np.abs(grav_int))
+    for cache_dir in [None, str(tmp_path)]:
+        fwd = bw.StreamingGravity(mesh, survey, chunk_size=100,
+                                  cache_dir=cache_dir)
+        # G is built once, then read back rather than recomputed
+        assert fwd.G is not None and fwd.G.shape == (survey.nD, mesh.nC)
+        assert np.allclose(fwd.dpred(model), grav_int, atol=1e-4*scale)
+        d = np.random.default_rng(8).normal(size=survey.nD)
+        assert np.isclose(np.dot(d, fwd.dpred(model)),
+                          np.dot(fwd.rmatvec(d), model), rtol=1e-5)
+
+def test_richardson_padding_evaluations():
+    L, dL = 8.0, [2.0, 1.0]
+    survey = bw.survey_gridded_locations(L, L, 4, 4, 5.0)
+    bw.clear_richardson_cache()
+    npoints, ncells = [ ], [ ]
+    for pad_width in [8.0, 128.0]:
+        rg = bw.RichardsonGravity(L, dL, survey, bw.gfunc_uniform_sphere,
+                                  pad_width=pad_width)
+        mesh = rg.meshxfwd[-1][0]
+        npoints.append(len(rg.samplers[-1].points))
+        ncells.append(mesh.nC)
+        assert npoints[-1] <= 8*mesh.nC
+    # The padded volume grows about a thousandfold, the cells and the
+    # gfunc evaluations only with the number of padding layers
+    assert npoints[1]/npoints[0] < 2*ncells[1]/ncells[0]
+    bw.clear_richardson_cache()
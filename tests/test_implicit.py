@@ -0,0 +1,234 @@
+"""
+Checks of GeoHistory evaluation, compiled plans and gradients against the
+reference recursive implementation and finite differences
+"""
+
+import numpy as np
+import pytest
+
+import antialias
+import blockworlds as bw
+import implicit
+
+
+@pytest.fixture
+def history():
+    # Move the angles off zero, where some derivatives vanish identically
+    history = implicit.graben_history()
+    pvec = history.serialize().astype(float)
+    pvec[[7, 16, 17, 18]] = [22.0, 5.0, 10.0, 30.0]
+    history.deserialize(pvec)
+    return history
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    return rng.uniform(-5000.0, 5000.0, size=(2000, 3))
+
+def test_compiled_plan_matches_rockprops(history, points):
+    h = 250.0
+    plan = history.compile()
+    P = history.sample_prior(5)
+    for pvec in P:
+        history.deserialize(pvec)
+        assert np.allclose(plan.rockprops(points, h),
+                           history.rockprops(points, h), atol=1e-10)
+
+def test_rockprops_batch_matches_loop(history, points):
+    h = 250.0
+    P = history.sample_prior(4)
+    batch = history.rockprops_batch(points, h, P)
+    for pvec, row in zip(P, batch):
+        history.deserialize(pvec)
+        assert np.allclose(row, history.rockprops(points, h), atol=1e-10)
+
+def test_complex_step_jacobian_matches_finite_differences():
+    pars = np.array([-4000.0, 100.0, 22.0, 10.0, -4200.0])
+    derivs = implicit.complex_step_jacobian(implicit.fault_frame, pars)
+    for k in range(len(pars)):
+        eps = 1e-6*max(1.0, abs(pars[k]))
+        dp = np.zeros(len(pars))
+        dp[k] = eps
+        plus = implicit.fault_frame(*(pars + dp))
+        minus = implicit.fault_frame(*(pars - dp))
+        for d, fp, fm in zip(derivs, plus, minus):
+            assert np.allclose(d[k], (fp - fm)/(2*eps), rtol=1e-5, atol=1e-8)
+
+def test_rockprops_gradients(history, points):
+    h = 250.0
+    rho, grad_r, J = history.rockprops_and_grad(points, h)
+    assert np.allclose(rho, history.rockprops(points, h), atol=1e-10)
+    # Central differences w.r.t. position
+    eps = 1e-3
+    for k in range(3):
+        dr = np.zeros(3)
+        dr[k] = eps
+        fd = (history.rockprops(points + dr, h)
+              - history.rockprops(points - dr, h))/(2*eps)
+        assert np.allclose(grad_r[:,k], fd, rtol=1e-4, atol=1e-7)
+    # Central differences w.r.t. the serialized parameters
+    pvec = history.serialize().astype(float)
+    for k in range(len(pvec)):
+        eps = 1e-5*max(1.0, abs(pvec[k]))
+        dp = np.zeros(len(pvec))
+        dp[k] = eps
+        history.deserialize(pvec + dp)
+        rho_plus = history.rockprops(points, h)
+        history.deserialize(pvec - dp)
+        rho_minus = history.rockprops(points, h)
+        fd = (rho_plus - rho_minus)/(2*eps)
+        assert np.allclose(J[:,k], fd, rtol=1e-4, atol=1e-7), k
+    history.deserialize(pvec)
+
+def test_logprior_batch_matches_loop(history):
+    P = history.sample_prior(6)
+    lP = history.logprior_batch(P)
+    for pvec, lp in zip(P, lP):
+        history.deserialize(pvec)
+        assert np.isclose(history.logprior(), lp)
+
+def test_logprior_grad(history):
+    pvec = history.serialize().astype(float)
+    grad = history.logprior_grad()
+    for k in range(len(pvec)):
+        eps = 1e-5*max(1.0, abs(pvec[k]))
+        dp = np.zeros(len(pvec))
+        dp[k] = eps
+        history.deserialize(pvec + dp)
+        lp_plus = history.logprior()
+        history.deserialize(pvec - dp)
+        lp_minus = history.logprior()
+        if np.isfinite(lp_plus) and np.isfinite(lp_minus):
+            fd = (lp_plus - lp_minus)/(2*eps)
+            assert np.isclose(grad[k], fd, rtol=1e-4, atol=1e-8), k
+    history.deserialize(pvec)
+
+def test_logpost_gradient(history):
+    L, NL = 10000.0, 16
+    h = L/NL
+    mesh = bw.baseline_tensor_mesh(NL, h, centering='CCN')
+    survey = bw.survey_gridded_locations(L, L, NL, NL, 100.0)
+    fwdmodel = bw.DiscreteGravity(mesh, survey, history.rockprops,
+                                  engine='fft')
+    pvec = history.serialize().astype(float)
+    rng = np.random.default_rng(2)
+    data = fwdmodel.calc_gravity(h) + 0.05*rng.normal(size=survey.nD)
+    history.set_likelihood(fwdmodel, data, 0.05, h)
+    pvec = pvec*1.003
+    lp, grad = history.logpost_and_grad(pvec)
+    for k in range(len(pvec)):
+        eps = 1e-5*max(1.0, abs(pvec[k]))
+        dp = np.zeros(len(pvec))
+        dp[k] = eps
+        fd = (history.logpost_and_grad(pvec + dp)[0]
+              - history.logpost_and_grad(pvec - dp)[0])/(2*eps)
+        assert np.isclose(grad[k], fd, rtol=1e-3, atol=1e-3), k
+
+def test_octree_gravity_reuses_unchanged_mesh(history):
+    L, NL = 10000.0, 16
+    h = L/NL
+    survey = bw.survey_gridded_locations(L, L, 5, 5, 0.0)
+    octmodel = implicit.OctreeGravity(history, survey, NL, h)
+    octmodel.calc_gravity(h)
+    fwdmodel = octmodel.fwdmodel
+    # Densities don't move any interfaces, so the mesh stays the same
+    pvec = history.serialize().astype(float)
+    pvec[history.density_index] += 0.1
+    history.deserialize(pvec)
+    grav = octmodel.calc_gravity(h)
+    assert octmodel.fwdmodel is fwdmodel
+    fresh = bw.DiscreteGravity(octmodel.mesh, survey, history.rockprops)
+    assert np.allclose(grav, fresh.calc_gravity(h))
+
+def test_warp_cache_byte_bound():
+    cache = implicit.WarpCache(maxsize=100, maxbytes=10*8*3*100)
+    inputs = [np.zeros((100, 3)) for i in range(20)]
+    for r in inputs:
+        cache.get(0, r, lambda: r + 1.0)
+    assert cache.nbytes <= cache.maxbytes
+    assert len(cache._entries) == 10
+    # Entries don't keep their inputs alive, and dead ones are dropped
+    del inputs, r
+    cache.get(0, np.zeros((100, 3)), lambda: np.zeros((100, 3)))
+    assert len(cache._entries) == 1
+
+def test_warp_cache_threads(history):
+    from concurrent.futures import ThreadPoolExecutor
+    h = 250.0
+    rng = np.random.default_rng(3)
+    point_sets = [rng.uniform(-5000.0, 5000.0, size=(3000, 3))
+                  for i in range(6)]
+    for event in history.event_list:
+        event.warp_cache = implicit.WarpCache(maxsize=2)
+    expected = [history.compile().rockprops(r, h) for r in point_sets]
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        for it in range(5):
+            futures = [pool.submit(history.rockprops, r, h)
+                       for r in point_sets]
+            for future, rho in zip(futures, expected):
+                assert np.allclose(future.result(), rho, atol=1e-10)
+
+def test_masked_faults_match_unmasked(history, points):
+    # Evaluating both sides of each fault everywhere, as soft_if_then
+    # does, agrees with the narrow-band evaluation up to roundoff
+    h = 250.0
+    for event in history.event_list:
+        if not isinstance(event, implicit.PlanarFaultEvent):
+            continue
+        r0, n, rdelt = event.geometry()
+        d, n = event.interface(points)
+        prev = event.previous_event
+        expected = implicit.soft_if_then(
+            d, prev.rockprops(points, h), prev.rockprops(points + rdelt, h), h)
+        assert np.allclose(event.rockprops(points, h), expected,
+                           rtol=1e-13, atol=1e-13)
+
+def test_octree_gravity_reuses_columns(history):
+    L, NL = 10000.0, 16
+    h = L/NL
+    survey = bw.survey_gridded_locations(L, L, 5, 5, 0.0)
+    octmodel = implicit.OctreeGravity(history, survey, NL, h)
+    octmodel.calc_gravity(h)
+    ncomputed = octmodel.ncomputed
+    # Moving a fault changes the mesh only around the fault
+    pvec = history.serialize().astype(float)
+    pvec[5] += 0.5*h
+    history.deserialize(pvec)
+    grav = octmodel.calc_gravity(h)
+    assert 0 < octmodel.ncomputed - ncomputed < octmodel.mesh.nC
+    fresh = bw.DiscreteGravity(octmodel.mesh, survey, history.rockprops)
+    assert np.allclose(grav, fresh.calc_gravity(h), rtol=1e-5,
+                       atol=1e-6*np.abs(grav).max())
+
+def test_logpost_matches_log_likelihood(history):
+    L, NL = 10000.0, 16
+    h = L/NL
+    mesh = bw.baseline_tensor_mesh(NL, h, centering='CCN')
+    survey = bw.survey_gridded_locations(L, L, NL, NL, 100.0)
+    fwdmodel = bw.DiscreteGravity(mesh, survey, history.rockprops,
+                                  engine='fft', background_density='mean')
+    rng = np.random.default_rng(4)
+    data = fwdmodel.calc_gravity(h) + 0.05*rng.normal(size=survey.nD)
+    history.set_likelihood(fwdmodel, data, 0.05, h)
+
+    def logpost(pvec):
+        history.deserialize(pvec)
+        return (history.logprior()
+                + fwdmodel.calc_log_likelihood(data, 0.05, h))
+
+    # A model away from the one that made the data
+    pvec = history.serialize().astype(float)
+    pvec[[0, 1, 5, 19]] += [0.2, 100.0, 150.0, 200.0]
+    lp, grad = history.logpost_and_grad(pvec)
+    assert np.isclose(lp, logpost(pvec))
+    for k in range(len(pvec)):
+        eps = 1e-5*max(1.0, abs(pvec[k]))
+        dp = np.zeros(len(pvec))
+        dp[k] = eps
+        fd = (logpost(pvec + dp) - logpost(pvec - dp))/(2*eps)
+        assert np.isclose(grad[k], fd, rtol=1e-3, atol=1e-3), k
+    aamodel = bw.DiscreteGravity(mesh, survey, history.rockprops,
+                                 engine='fft',
+                                 antialias=antialias.partial_volume_exact)
+    with pytest.raises(ValueError):
+        history.set_likelihood(aamodel, data, 0.05, h)
@@ -0,0 +1,55 @@
+"""
+Checks of the ensemble sampler on a cheap analytic log posterior
+"""
+
+import numpy as np
+
+import sampling
+
+
+class GaussianPosterior:
+    """
+    Standard normal log density, with a wider coarse approximation and a
+    dependence on the global random stream to check how it is seeded
+    """
+
+    def __call__(self, theta):
+        return -0.5*np.sum(theta**2) + 1e-12*np.random.random()
+
+    def coarse(self, theta):
+        return -0.25*np.sum(theta**2)
+
+def test_chain_independent_of_processes():
+    p0 = np.random.default_rng(0).normal(size=(8, 3))
+    chains = [ ]
+    for processes in [1, 2]:
+        with sampling.EnsembleSampler(GaussianPosterior, 8, seed=5,
+                                      processes=processes) as sampler:
+            sampler.run(p0, 20)
+            chains.append((sampler.chain, sampler.logp))
+    assert np.array_equal(chains[0][0], chains[1][0])
+    assert np.array_equal(chains[0][1], chains[1][1])
+
+def test_switch_on_delayed_acceptance():
+    p0 = np.random.default_rng(1).normal(size=(8, 3))
+    with sampling.EnsembleSampler(GaussianPosterior, 8, seed=6,
+                                  processes=1) as sampler:
+        sampler.run(p0, 5)
+        sampler.delayed_acceptance = True
+        sampler.run(None, 5)
+        assert sampler.chain.shape == (10, 8, 3)
+        assert np.allclose(sampler.logp_coarse,
+                           -0.25*np.sum(sampler.chain[-1]**2, axis=1))
+        sampler.delayed_acceptance = False
+        sampler.run(None, 5)
+        assert sampler.logp_coarse is None
+
+def test_serial_run_leaves_global_random_state():
+    p0 = np.random.default_rng(2).normal(size=(8, 3))
+    np.random.seed(123)
+    expected = np.random.random(5)
+    np.random.seed(123)
+    with sampling.EnsembleSampler(GaussianPosterior, 8, seed=7,
+                                  processes=1) as sampler:
+        sampler.run(p0, 5)
+    assert np.array_equal(np.random.random(5), expected)